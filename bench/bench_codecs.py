@@ -0,0 +1,122 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Measure per-message parse and emit times for every message type.
+
+Each message type of the protocol version is parsed and emitted with
+mc3p's message codecs, and with a per-field reference codec that decodes
+every fixed-width field with its own read and struct.unpack_from() call,
+the way defmsg did before fields were coalesced into struct.Struct runs.
+
+With --codegen, mc3p's codecs are the generated ones from mc3p.codegen.
+
+usage: python bench/bench_codecs.py [-v VERSION] [-n COUNT] [--codegen]
+"""
+
+import sys, struct, optparse
+from time import time
+
+from samples import sample_packets
+from mc3p import messages, codegen
+from mc3p.util import Stream
+from mc3p.parsing import parse_unsigned_byte
+
+
+def reference_parse(parsem, stream):
+    msg = {'msgtype': parsem.msgtype}
+    for (name, field) in parsem.fields:
+        if field.fmt is not None:
+            msg[name] = struct.unpack_from('>' + field.fmt,
+                                           stream.read(field.size))[0]
+        else:
+            msg[name] = field.parse(stream)
+    return msg
+
+def reference_emit(parsem, msg):
+    parts = [struct.pack('>B', parsem.msgtype)]
+    for (name, field) in parsem.fields:
+        if field.fmt is not None:
+            parts.append(struct.pack('>' + field.fmt, msg[name]))
+        else:
+            parts.append(field.emit(msg[name]))
+    return ''.join(parts)
+
+
+def time_parse(parse, packet, n):
+    """Return mean seconds to parse packet, which is repeated n times."""
+    stream = Stream(capacity=len(packet) * n)
+    stream.append(packet * n)
+    t0 = time()
+    for i in xrange(n):
+        parse_unsigned_byte(stream)
+        parse(stream)
+        stream.packet_finished()
+    return (time() - t0) / n
+
+def time_emit(emit, msg, n):
+    """Return mean seconds to emit msg, or None if it cannot be emitted."""
+    try:
+        emit(msg)
+    except Exception: # Some emitters are unimplemented or broken.
+        return None
+    t0 = time()
+    for i in xrange(n):
+        emit(msg)
+    return (time() - t0) / n
+
+
+def fmt_times(new, old):
+    """Format mean times in microseconds, and the speedup of new over old."""
+    if new is None:
+        return '%8s %8s %7s' % ('n/a', 'n/a', '')
+    if old is None:
+        return '%8.2f %8s %7s' % (1e6 * new, 'n/a', '')
+    return '%8.2f %8.2f %6.2fx' % (1e6 * new, 1e6 * old, old / new)
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('-v', '--version', dest='version', type='int', default=29,
+                      help='protocol version')
+    parser.add_option('-n', '--count', dest='count', type='int', default=20000,
+                      help='messages parsed/emitted per measurement')
+    parser.add_option('--codegen', dest='codegen', action='store_true',
+                      default=False, help='use generated codecs')
+    (opts, args) = parser.parse_args()
+    if opts.codegen:
+        codegen.install(messages.protocol)
+
+    print '%-6s %-4s %-28s %8s %8s %7s %8s %8s %7s' % ('side', 'type', 'name',
+        'parse us', 'before', '', 'emit us', 'before', '')
+    for (side, msgtype, parsem, packet) in sample_packets(opts.version):
+        stream = Stream()
+        stream.append(packet[1:])
+        msg = parsem.parse(stream)
+        new_parse = time_parse(parsem.parse, packet, opts.count)
+        new_emit = time_emit(parsem.emit, msg, opts.count)
+        if hasattr(parsem, 'fields'):
+            old_parse = time_parse(lambda s: reference_parse(parsem, s),
+                                   packet, opts.count)
+            old_emit = time_emit(lambda m: reference_emit(parsem, m),
+                                 msg, opts.count)
+        else:
+            old_parse = old_emit = None # Login: no per-field reference.
+        print '%-6s 0x%02x %-28s %s %s' % (side, msgtype, (parsem.name or '')[:28],
+            fmt_times(new_parse, old_parse), fmt_times(new_emit, old_emit))
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Compare the throughput and CPU cost of mc3p's I/O engines.
+
+For every engine and session count, mc3p is started in a subprocess and
+driven by simulated clients and a simulated server living in this process.
+After logging in, the server streams 'Entity relative move' (0x1f) packets
+to every client through mc3p, keeping a fixed window of data in flight per
+session. The report shows forwarded packets per second, and the CPU used by
+the mc3p process in total, per session, and per packet.
+
+A second report shows what one iteration of the event loop costs with each
+engine when all sessions are idle, measured in this process on pairs of
+MinecraftProxy dispatchers; it is the overhead every wakeup pays per
+session, whatever the traffic.
+
+Reading the CPU time of mc3p requires /proc, so this script is Linux only.
+
+usage: python bench/bench_engines.py [-s 1,50,500] [-e ENGINES] [-t SECS]
+"""
+
+import os, sys, socket, select, subprocess, time, optparse, errno, asyncore
+
+mc3p_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, mc3p_dir)
+
+from mc3p import messages, eventloop
+from mc3p.proxy import MinecraftProxy
+
+PROTO_VERSION = 29
+cli_msgs, srv_msgs = messages.protocol[PROTO_VERSION]
+
+LOGIN_SRV = srv_msgs[0x01].emit({'msgtype': 0x01, 'eid': 1, 'reserved': u'',
+    'level_type': u'default', 'server_mode': 0, 'dimension': 0,
+    'difficulty': 1, 'world_height': 128, 'max_players': 8})
+MOVE = srv_msgs[0x1f].emit({'msgtype': 0x1f, 'eid': 42,
+                            'dx': 1, 'dy': 0, 'dz': -1})
+BLOCK_PACKETS = 512
+BLOCK = MOVE * BLOCK_PACKETS
+WINDOW = 4 # Blocks in flight per session.
+
+
+def login_cli(idx):
+    return messages.protocol[0][0][0x01].emit({'msgtype': 0x01,
+        'proto_version': PROTO_VERSION, 'username': u'c%d' % idx,
+        'nu7': u'', 'nu2': 0, 'nu8': 0, 'nu4': 0, 'nu5': 0, 'nu6': 0})
+
+
+def login_username(data):
+    """Return the username from a client login, or None if incomplete."""
+    if len(data) < 7:
+        return None
+    n = (ord(data[5]) << 8) | ord(data[6])
+    if len(data) < 7 + 2*n:
+        return None
+    return data[7:7+2*n].decode('utf-16-be')
+
+
+def cpu_seconds(pid):
+    """Return user+system CPU seconds used by process pid."""
+    with open('/proc/%d/stat' % pid) as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+class Generator(object):
+    """Simulated Minecraft server and clients, driven by epoll."""
+
+    def __init__(self, srv_port):
+        self.epoll = select.epoll()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', srv_port))
+        self.listener.listen(socket.SOMAXCONN)
+        self.listener.setblocking(0)
+        self.epoll.register(self.listener.fileno(), select.EPOLLIN)
+        self.conns = {}       # { fd -> connection state }
+        self.srv_by_name = {} # { username -> server-side state }
+        self.received = 0     # Movement packet bytes received by clients.
+
+    def connect_clients(self, port, n):
+        for idx in xrange(n):
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(login_cli(idx))
+            sock.setblocking(0)
+            self.conns[sock.fileno()] = {'sock': sock, 'client': True,
+                                         'name': u'c%d' % idx, 'skip': len(LOGIN_SRV),
+                                         'count': 0}
+            self.epoll.register(sock.fileno(), select.EPOLLIN)
+
+    def close(self):
+        for conn in self.conns.values():
+            conn['sock'].close()
+        self.listener.close()
+        self.epoll.close()
+
+    def _accept(self):
+        while True:
+            try:
+                sock, addr = self.listener.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            sock.setblocking(0)
+            self.conns[sock.fileno()] = {'sock': sock, 'client': False,
+                                         'inbuf': '', 'out': '', 'name': None}
+            self.epoll.register(sock.fileno(), select.EPOLLIN)
+
+    def _send(self, conn, data):
+        conn['out'] += data
+        try:
+            n = conn['sock'].send(conn['out'])
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            n = 0
+        conn['out'] = conn['out'][n:]
+        mask = select.EPOLLIN | (select.EPOLLOUT if conn['out'] else 0)
+        self.epoll.modify(conn['sock'].fileno(), mask)
+
+    def _drop(self, fd):
+        conn = self.conns.pop(fd)
+        self.epoll.unregister(fd)
+        conn['sock'].close()
+
+    def _read(self, fd, conn):
+        try:
+            data = conn['sock'].recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            self._drop(fd)
+        elif conn['client']:
+            skip = min(conn['skip'], len(data))
+            conn['skip'] -= skip
+            n = len(data) - skip
+            self.received += n
+            # Grant the server side one more block per block received.
+            before = conn['count'] // len(BLOCK)
+            conn['count'] += n
+            for i in xrange(conn['count'] // len(BLOCK) - before):
+                srv = self.srv_by_name.get(conn['name'])
+                if srv is not None:
+                    self._send(srv, BLOCK)
+        elif conn['name'] is None:
+            conn['inbuf'] += data
+            name = login_username(conn['inbuf'])
+            if name is not None:
+                conn['name'] = name
+                self.srv_by_name[name] = conn
+                self._send(conn, LOGIN_SRV + BLOCK * WINDOW)
+
+    def run(self, secs):
+        """Process events for secs seconds."""
+        t_end = time.time() + secs
+        while True:
+            left = t_end - time.time()
+            if left <= 0:
+                break
+            for fd, flags in self.epoll.poll(left):
+                if fd == self.listener.fileno():
+                    self._accept()
+                    continue
+                conn = self.conns.get(fd)
+                if conn is None:
+                    continue
+                if flags & select.EPOLLOUT:
+                    self._send(conn, '')
+                if flags & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                    self._read(fd, conn)
+
+
+def bench(engine, sessions, secs, srv_port=26565, mc3p_port=36565):
+    """Return (packets/s, mc3p CPU fraction) for one configuration."""
+    gen = Generator(srv_port)
+    proxy = subprocess.Popen([sys.executable, '-m', 'mc3p.proxy',
+                              '-l', 'error', '--engine', engine,
+                              '-p', str(mc3p_port),
+                              '127.0.0.1', str(srv_port)], cwd=mc3p_dir)
+    try:
+        time.sleep(1.0)
+        gen.connect_clients(mc3p_port, sessions)
+        gen.run(1.0) # Warm up.
+        rcvd0, cpu0, t0 = gen.received, cpu_seconds(proxy.pid), time.time()
+        gen.run(secs)
+        rcvd1, cpu1, t1 = gen.received, cpu_seconds(proxy.pid), time.time()
+    finally:
+        proxy.terminate()
+        proxy.wait()
+        gen.close()
+    pps = (rcvd1 - rcvd0) / len(MOVE) / (t1 - t0)
+    return pps, (cpu1 - cpu0) / (t1 - t0)
+
+
+def bench_iteration(engine, sessions, iterations=2000):
+    """Return the seconds one event loop iteration takes with idle sessions.
+
+    Returns None if the engine cannot poll that many sockets.
+    """
+    socks = []
+    for i in xrange(sessions):
+        (cli, cli_peer) = socket.socketpair()
+        (srv, srv_peer) = socket.socketpair()
+        srv_proxy = MinecraftProxy(srv, MinecraftProxy(cli))
+        socks.extend([cli_peer, srv_peer])
+    map = asyncore.socket_map
+    poll = eventloop.make_poller(engine)
+    try:
+        poll(0.0, map)
+        t0 = time.time()
+        for i in xrange(iterations):
+            poll(0.0, map)
+        return (time.time() - t0) / iterations
+    except ValueError:
+        return None # select() cannot poll fds beyond FD_SETSIZE.
+    finally:
+        for obj in map.values():
+            obj.close()
+        for sock in socks:
+            sock.close()
+        eventloop._epoll_poller = None
+
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('-s', '--sessions', dest='sessions', default='1,50,500',
+                      help='comma-delimited list of session counts')
+    parser.add_option('-e', '--engines', dest='engines',
+                      default=','.join(eventloop.ENGINES),
+                      help='comma-delimited list of I/O engines')
+    parser.add_option('-t', '--time', dest='secs', type='float', default=5.0,
+                      help='seconds to measure each configuration')
+    (opts, args) = parser.parse_args()
+
+    print '%-8s %8s %12s %8s %14s %10s' % ('engine', 'sessions', 'packets/s',
+                                           'cpu %', 'cpu %/session', 'us/packet')
+    for sessions in [int(s) for s in opts.sessions.split(',')]:
+        for engine in opts.engines.split(','):
+            pps, cpu = bench(engine, sessions, opts.secs)
+            print '%-8s %8d %12.0f %8.1f %14.3f %10.2f' % (engine, sessions,
+                pps, 100 * cpu, 100 * cpu / sessions,
+                1e6 * cpu / pps if pps else float('nan'))
+            sys.stdout.flush()
+
+    print
+    print '%-8s %8s %14s' % ('engine', 'sessions', 'us/iteration')
+    for sessions in [int(s) for s in opts.sessions.split(',')]:
+        for engine in opts.engines.split(','):
+            secs = bench_iteration(engine, sessions)
+            print '%-8s %8d %14s' % (engine, sessions,
+                                     '%.2f' % (1e6 * secs) if secs is not None else 'n/a')
+            sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
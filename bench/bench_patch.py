@@ -0,0 +1,115 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Measure the cost of re-encoding messages modified by a plugin.
+
+The simulated plugin shifts coordinates: it adds an offset to the x and z
+fields of player position (0x0b), player position & look (0x0d), named
+entity spawn (0x14), mob spawn (0x18) and map chunk (0x33) packets. Each
+packet is parsed lazily, as the proxy parses it, modified, and re-encoded
+either by emitting the whole message again, or by patching the changed
+fields into a copy of the packet's bytes. The times include parsing.
+
+usage: python bench/bench_patch.py [-n COUNT] [--codegen]
+"""
+
+import os, sys, optparse
+from time import time
+
+mc3p_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, mc3p_dir)
+
+from mc3p import messages, codegen
+from mc3p.util import Stream
+from mc3p.parsing import patch_fields
+from mc3p.proxy import parse_packet
+
+cli_msgs, srv_msgs = messages.protocol[29]
+
+MOB_SPAWN = ''.join(['\x18', '\x00\x00\x00\x07', '\x32',
+                     '\x00\x00\x01\x00', '\x00\x00\x00\x40', '\x00\x00\x02\x00',
+                     '\x00\x00\x00', '\x00\x05', '\x7f'])
+
+PACKETS = [
+    ('client', cli_msgs, cli_msgs[0x0b].emit({'msgtype': 0x0b, 'x': 10.0,
+        'y': 64.0, 'stance': 65.6, 'z': -20.0, 'on_ground': True})),
+    ('client', cli_msgs, cli_msgs[0x0d].emit({'msgtype': 0x0d, 'x': 10.0,
+        'y': 64.0, 'stance': 65.6, 'z': -20.0, 'yaw': 90.0, 'pitch': 0.0,
+        'on_ground': True})),
+    ('server', srv_msgs, srv_msgs[0x0d].emit({'msgtype': 0x0d, 'x': 10.0,
+        'stance': 65.6, 'y': 64.0, 'z': -20.0, 'yaw': 90.0, 'pitch': 0.0,
+        'on_ground': True})),
+    ('server', srv_msgs, srv_msgs[0x14].emit({'msgtype': 0x14, 'eid': 7,
+        'name': u'player', 'x': 256, 'y': 64, 'z': 512, 'rotation': 0,
+        'pitch': 0, 'curr_item': 0})),
+    ('server', srv_msgs, MOB_SPAWN),
+    ('server', srv_msgs, srv_msgs[0x33].emit({'msgtype': 0x33, 'x': 1, 'z': 2,
+        'continuous': True, 'chunk_bitmap': 0x7fff, 'add_bitmap': 0,
+        'chunk': {'size': 40000, 'data': 'x' * 40000}})),
+]
+
+
+def full_emit(msg, msg_spec):
+    return msg_spec[msg['msgtype']].emit(msg)
+
+def patch(msg, msg_spec):
+    return patch_fields(msg.parsem, msg['raw_bytes'], msg.offsets, msg, msg.changed)
+
+
+def time_rewrite(encode, side, msg_spec, packet, n):
+    """Return mean seconds to parse, modify and re-encode packet.
+
+    Returns None if the message cannot be encoded.
+    """
+    stream = Stream(capacity=len(packet) * n)
+    stream.append(packet * n)
+    t0 = time()
+    try:
+        for i in xrange(n):
+            msg = parse_packet(stream, msg_spec, side, lazy=True)
+            msg['x'] += 16
+            msg['z'] += 16
+            encode(msg, msg_spec)
+    except NotImplementedError:
+        return None
+    return (time() - t0) / n
+
+
+def fmt_time(t):
+    return '%10s' % 'n/a' if t is None else '%10.2f' % (1e6 * t)
+
+def main():
+    parser = optparse.OptionParser(usage="usage: %prog [options]")
+    parser.add_option('-n', '--count', dest='count', type='int', default=20000,
+                      help='packets rewritten per measurement')
+    parser.add_option('--codegen', dest='codegen', action='store_true',
+                      default=False, help='use generated codecs')
+    (opts, args) = parser.parse_args()
+    if opts.codegen:
+        codegen.install(messages.protocol)
+
+    print '%-6s %-4s %8s %10s %10s' % ('side', 'type', 'bytes', 'emit us', 'patch us')
+    for (side, msg_spec, packet) in PACKETS:
+        n = min(opts.count, max(100, 2**22 // len(packet)))
+        emit_t = time_rewrite(full_emit, side, msg_spec, packet, n)
+        patch_t = time_rewrite(patch, side, msg_spec, packet, n)
+        print '%-6s 0x%02x %8d %s %s' % (side, ord(packet[0]), len(packet),
+                                          fmt_time(emit_t), fmt_time(patch_t))
+        sys.stdout.flush()
+
+if __name__ == "__main__":
+    main()
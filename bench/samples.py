@@ -0,0 +1,84 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Sample messages of every type, for benchmarks."""
+
+import os, sys
+
+mc3p_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if mc3p_dir not in sys.path:
+    sys.path.insert(0, mc3p_dir)
+
+from mc3p import messages
+from mc3p.parsing import *
+
+SLOT = {'item_id': 3, 'count': 2, 'uses': 0}
+
+# Sample values for each field type.
+VALUES = {
+    MC_byte: -5,
+    MC_unsigned_byte: 200,
+    MC_short: -300,
+    MC_int: 123456,
+    MC_long: 2**40,
+    MC_float: 0.5,
+    MC_double: 1.25,
+    MC_bool: True,
+    MC_string: u'sample text',
+    MC_string8: 'sample bytes',
+    MC_slot_update: SLOT,
+    MC_slot_update2: SLOT,
+    MC_inventory: {'count': 2, 'slots': [SLOT, None]},
+    MC_inventory2: {'count': 2, 'slots': [SLOT, None]},
+    MC_chunk: {'size': 1000, 'data': 'x' * 1000},
+    MC_chunk2: {'size': 1000, 'data': 'x' * 1000},
+    MC_multi_block_change: {'coord_array': [1, 2], 'type_array': [3, 4],
+                            'metadata_array': [0, 1]},
+    MC_multi_block_change2: [1, 2, 3],
+    MC_item_data: 'item data',
+    MC_fireball_data: {'thrower_id': 0},
+}
+
+# Encoded samples for field types that cannot be emitted.
+RAW_VALUES = {
+    MC_metadata: '\x00\x05\x40\x00\x00\x00\x09\x7f',
+    MC_explosion_records: '\x00\x00\x00\x02\x01\x02\x03\x04\x05\x06',
+}
+
+LOGIN = {'msgtype': 0x01, 'proto_version': 29, 'username': u'player',
+         'nu7': u'', 'nu2': 0, 'nu8': 0, 'nu4': 0, 'nu5': 0, 'nu6': 0}
+
+
+def sample_packet(parsem):
+    """Return the encoding of a sample message for a message Parsem."""
+    if not hasattr(parsem, 'fields'):
+        return parsem.emit(LOGIN)
+    parts = [chr(parsem.msgtype)]
+    for (name, field) in parsem.fields:
+        if field in RAW_VALUES:
+            parts.append(RAW_VALUES[field])
+        else:
+            parts.append(field.emit(VALUES[field]))
+    return ''.join(parts)
+
+
+def sample_packets(version):
+    """Yield (side, msgtype, Parsem, packet) for every type in a version."""
+    for (side, msg_spec) in zip(('client', 'server'), messages.protocol[version]):
+        for msgtype, parsem in enumerate(msg_spec):
+            if parsem is not None:
+                yield (side, msgtype, parsem, sample_packet(parsem))
@@ -0,0 +1,319 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Generated parse and emit functions for message types.
+
+The Parsems built by defmsg() and defloginmsg() walk a list of field
+segments every time they parse or emit a message. generate() turns the
+message specs of a protocol table into Python source instead, with one
+straight-line parse function and one emit function per message type, and
+install() compiles it and swaps the generated functions into the message
+Parsems. Compiled code is cached on disk, keyed by a hash of the source.
+
+The proxy decodes messages lazily, as LazyMessages, so defmsg() Parsems
+also get a generated index function, which finds the offsets of the
+segments of a variable-size message, and a generated decoder per segment.
+
+The generated functions produce the same messages and bytes as the
+interpreted ones.
+"""
+
+import os, imp, marshal, hashlib, logging, tempfile
+
+from parsing import compile_fields, parse_fields, version_fields, INT
+from util import Reader
+
+logger = logging.getLogger('mc3p')
+
+SIDES = ('cli', 'srv')
+
+_installed = False
+
+
+def login_fallback_parse(tuples, stream, proto_version):
+    """Parse the rest of a login message for a version with no generated code."""
+    msg = {'msgtype': 0x01, 'proto_version': proto_version}
+    parse_fields(stream, compile_fields(version_fields(tuples, proto_version)), msg)
+    return msg
+
+
+class Generator(object):
+    """Source and namespace of a generated module."""
+
+    def __init__(self):
+        self.lines = []
+        self.namespace = {'INT': INT, 'login_fallback_parse': login_fallback_parse,
+                          'Reader': Reader, 'SETDEFAULT': dict.setdefault}
+        self.refs = {}    # { id(object) -> name in namespace }
+        self.structs = {} # { struct format -> name in namespace }
+        # [ (Parsem, parse function name, emit function name,
+        #    (index function name or None, [decoder names]) or None) ]
+        self.codecs = []
+
+    def ref(self, obj, prefix):
+        """Return the name under which obj is visible to generated code."""
+        name = self.refs.get(id(obj))
+        if name is None:
+            name = '%s%d' % (prefix, len(self.refs))
+            self.refs[id(obj)] = name
+            self.namespace[name] = obj
+        return name
+
+    def struct(self, fmt):
+        """Return the name of a module-level struct.Struct for fmt."""
+        name = self.structs.get(fmt)
+        if name is None:
+            name = 'S%d' % len(self.structs)
+            self.structs[fmt] = name
+        return name
+
+    def emit_parser(self, fname, args, segments, header):
+        """Add a function parsing segments into a message.
+
+        header is a list of (key, expression) pairs that start the message.
+        """
+        self.lines.append('def %s(%s):' % (fname, args))
+        items = list(header)
+        for (names, codec, parsem) in segments:
+            if codec is not None:
+                vars = ['f%d' % (len(items) + i) for i in xrange(len(names))]
+                self.lines.append('    %s, = %s.unpack_from(stream.read(%d))' %
+                                  (', '.join(vars), self.struct(codec.format),
+                                   codec.size))
+                items.extend(zip(names, vars))
+            else:
+                var = 'f%d' % len(items)
+                self.lines.append('    %s = %s(stream)' %
+                                  (var, self.ref(parsem.parse, 'P')))
+                items.append((names, var))
+        self.lines.append('    return {%s}' %
+                          ', '.join(['%r: %s' % item for item in items]))
+        self.lines.append('')
+
+    def emit_emitter(self, fname, args, segments, header):
+        """Add a function emitting a message described by segments.
+
+        header is a list of expressions for the values of the format
+        characters that prefix the first segment.
+        """
+        self.lines.append('def %s(%s):' % (fname, args))
+        parts = []
+        for (names, codec, parsem) in segments:
+            if codec is not None:
+                values = header + ['msg[%r]' % name for name in names]
+                parts.append('%s.pack(%s)' %
+                             (self.struct(codec.format), ', '.join(values)))
+                header = []
+            else:
+                parts.append('%s(msg[%r])' % (self.ref(parsem.emit, 'E'), names))
+        if len(parts) == 1:
+            self.lines.append('    return %s' % parts[0])
+        else:
+            self.lines.append("    return ''.join([%s])" % ', '.join(parts))
+        self.lines.append('')
+
+    def emit_indexer(self, fname, segments):
+        """Add a function skipping over segments, returning their offsets."""
+        self.lines.append('def %s(stream):' % fname)
+        for (i, (names, codec, parsem)) in enumerate(segments):
+            self.lines.append('    o%d = stream.i' % i)
+            if codec is not None:
+                self.lines.append('    stream.skip(%d)' % codec.size)
+            else:
+                self.lines.append('    %s(stream)' % self.ref(parsem.skip, 'K'))
+        self.lines.append('    return [%s]' %
+                          ', '.join(['o%d' % i for i in xrange(len(segments))]))
+        self.lines.append('')
+
+    def emit_decoder(self, fname, segment):
+        """Add a function decoding one segment into a LazyMessage.
+
+        Like parsing.segment_decoder(), it leaves fields that are set alone.
+        """
+        (names, codec, parsem) = segment
+        self.lines.append('def %s(msg, raw_bytes, offset):' % fname)
+        if codec is not None:
+            vars = ['f%d' % i for i in xrange(len(names))]
+            self.lines.append('    %s, = %s.unpack_from(raw_bytes, offset)' %
+                              (', '.join(vars), self.struct(codec.format)))
+            for (name, var) in zip(names, vars):
+                self.lines.append('    SETDEFAULT(msg, %r, %s)' % (name, var))
+        else:
+            self.lines.append('    SETDEFAULT(msg, %r, %s(Reader(raw_bytes, offset)))' %
+                              (names, self.ref(parsem.parse, 'P')))
+        self.lines.append('')
+
+    def add_message(self, parsem, suffix):
+        """Add the functions for a message Parsem built by defmsg()."""
+        parse_name, emit_name = 'parse_' + suffix, 'emit_' + suffix
+        segments = compile_fields(parsem.fields)
+        self.emit_parser(parse_name, 'stream', segments,
+                         [('msgtype', str(parsem.msgtype))])
+        self.emit_emitter(emit_name, 'msg', compile_fields(parsem.fields, 'B'),
+                          [str(parsem.msgtype)])
+        index_name = None
+        if parsem.offsets is None:
+            index_name = 'index_' + suffix
+            self.emit_indexer(index_name, segments)
+        decoder_names = []
+        for (i, segment) in enumerate(segments):
+            decoder_names.append('decode_%s_%d' % (suffix, i))
+            self.emit_decoder(decoder_names[-1], segment)
+        self.codecs.append((parsem, parse_name, emit_name, (index_name, decoder_names)))
+
+    def add_login_message(self, parsem, suffix, versions):
+        """Add the functions for a login Parsem built by defloginmsg().
+
+        Code is generated for each of versions. Login messages of other
+        versions are handled by the interpreted codec.
+        """
+        tuples = parsem.versioned_fields
+        parsers, emitters = [], []
+        for version in versions:
+            pairs = version_fields(tuples, version)
+            vparse, vemit = ('parse_%s_%d' % (suffix, version),
+                             'emit_%s_%d' % (suffix, version))
+            self.emit_parser(vparse, 'stream, proto_version', compile_fields(pairs),
+                             [('msgtype', '1'), ('proto_version', 'proto_version')])
+            self.emit_emitter(vemit, 'msg, proto_version', compile_fields(pairs, 'Bi'),
+                              ['1', 'proto_version'])
+            parsers.append('%d: %s' % (version, vparse))
+            emitters.append('%d: %s' % (version, vemit))
+        parse_name, emit_name = 'parse_' + suffix, 'emit_' + suffix
+        self.lines.extend([
+            'PARSERS_%s = {%s}' % (suffix, ', '.join(parsers)),
+            'EMITTERS_%s = {%s}' % (suffix, ', '.join(emitters)),
+            '',
+            'def %s(stream):' % parse_name,
+            '    proto_version = INT.unpack_from(stream.read(4))[0]',
+            '    parse = PARSERS_%s.get(proto_version)' % suffix,
+            '    if parse is None:',
+            '        return login_fallback_parse(%s, stream, proto_version)' %
+                self.ref(tuples, 'T'),
+            '    return parse(stream, proto_version)',
+            '',
+            'def %s(msg):' % emit_name,
+            "    proto_version = msg['proto_version']",
+            '    emit = EMITTERS_%s.get(proto_version)' % suffix,
+            '    if emit is None:',
+            '        return %s(msg)' % self.ref(parsem.emit, 'E'),
+            '    return emit(msg, proto_version)',
+            ''])
+        self.codecs.append((parsem, parse_name, emit_name, None))
+
+    def source(self):
+        header = ['# Generated by mc3p.codegen; do not edit.', '',
+                  'from struct import Struct', '']
+        for fmt, name in sorted(self.structs.items(), key=lambda x: int(x[1][1:])):
+            header.append('%s = Struct(%r)' % (name, fmt))
+        return '\n'.join(header + [''] + self.lines) + '\n'
+
+
+def generate(protocol):
+    """Generate code for every message Parsem of a protocol table.
+
+    protocol maps versions to (client msg_spec, server msg_spec) pairs, as
+    messages.protocol does. Returns (source, namespace, codecs), where
+    namespace holds the objects the source refers to, and codecs is a list
+    of (Parsem, parse function name, emit function name, lazy) tuples;
+    lazy is None for login messages, and (index function name or None,
+    [segment decoder names]) for the others.
+    """
+    gen = Generator()
+    seen = set()
+    for version in sorted(protocol):
+        for (side, msg_spec) in zip(SIDES, protocol[version]):
+            for (msgtype, parsem) in enumerate(msg_spec):
+                if parsem is None or id(parsem) in seen:
+                    continue
+                seen.add(id(parsem))
+                suffix = 'v%d_%s_0x%02x' % (version, side, msgtype)
+                if hasattr(parsem, 'versioned_fields'):
+                    gen.add_login_message(parsem, suffix, sorted(protocol))
+                elif hasattr(parsem, 'fields'):
+                    gen.add_message(parsem, suffix)
+    return (gen.source(), gen.namespace, gen.codecs)
+
+
+def load_code(source, cache_dir):
+    """Return the code object for source, using the cache in cache_dir."""
+    key = hashlib.sha1(imp.get_magic() + source).hexdigest()
+    path = os.path.join(cache_dir, 'codecs-%s' % key)
+    try:
+        with open(path + '.code', 'rb') as f:
+            return marshal.load(f)
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        pass
+    # Name the code after the cached source, so tracebacks can show it.
+    code = compile(source, path + '.py', 'exec')
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        for (ext, data) in (('.py', source), ('.code', marshal.dumps(code))):
+            # Write to a temporary file first, so that concurrent processes
+            # never see a partially written file.
+            (fd, tmp) = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path + ext)
+    except (IOError, OSError) as e:
+        logger.warn("Could not cache generated codecs in %s: %s" % (cache_dir, e))
+    return code
+
+
+def compile_codecs(protocol, cache_dir=None):
+    """Compile generated code for a protocol table.
+
+    Returns a list of (Parsem, parse, emit, lazy) tuples holding the
+    generated functions; lazy is None for login messages, and (index or
+    None, [segment decoders]) for the others. The generated code is cached
+    in cache_dir, unless it is None.
+    """
+    (source, namespace, codecs) = generate(protocol)
+    if cache_dir is None:
+        code = compile(source, '<mc3p generated codecs>', 'exec')
+    else:
+        code = load_code(source, cache_dir)
+    exec code in namespace
+    compiled = []
+    for (parsem, parse_name, emit_name, lazy) in codecs:
+        if lazy is not None:
+            (index_name, decoder_names) = lazy
+            lazy = (namespace[index_name] if index_name else None,
+                    [namespace[name] for name in decoder_names])
+        compiled.append((parsem, namespace[parse_name], namespace[emit_name], lazy))
+    return compiled
+
+
+def install(protocol, cache_dir=None):
+    """Replace the parse and emit functions of protocol's messages with generated ones.
+
+    The index functions and segment decoders used for LazyMessages are
+    replaced too.
+    """
+    global _installed
+    if _installed:
+        return
+    for (parsem, parse, emit, lazy) in compile_codecs(protocol, cache_dir):
+        parsem.parse = parse
+        parsem.emit = emit
+        if lazy is not None:
+            (index, decoders) = lazy
+            if index is not None:
+                parsem.index = index
+            parsem.decoders = decoders
+    _installed = True
@@ -0,0 +1,419 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""asyncore event loop with support for timed callbacks.
+
+The loop can be driven by one of several I/O engines:
+    select  asyncore's select()-based poller (available everywhere).
+    poll    asyncore's poll()-based poller.
+    epoll   A persistent epoll set (Linux only). Unlike the asyncore pollers,
+            which call readable() and writable() on every dispatcher on
+            every iteration, it only looks at the dispatchers that handled
+            events, were added or removed, or reported a change with
+            interest_changed(), so an iteration costs the same however many
+            sessions are idle.
+"""
+
+import asyncore, heapq, logging, traceback, select, socket, threading, collections, Queue
+from errno import EBADF, ENOENT, EINTR, EAGAIN, EWOULDBLOCK
+from time import time
+
+logger = logging.getLogger('mc3p')
+
+# Heap of pending (deadline, seqno, Timer) tuples.
+_timers = []
+_seqno = 0
+
+# Longest time to block waiting for I/O when no timer is pending.
+MAX_WAIT = 30.0
+
+# Number of threads running the functions passed to defer_to_thread().
+THREAD_POOL_SIZE = 4
+
+
+class Dispatcher(asyncore.dispatcher):
+    """An asyncore dispatcher that reports being added to and removed from
+    the socket map to the epoll engine.
+
+    Subclasses whose readable() or writable() changes other than while
+    they handle an event must call interest_changed() when it does.
+    """
+
+    def add_channel(self, map=None):
+        asyncore.dispatcher.add_channel(self, map)
+        interest_changed(self)
+
+    def del_channel(self, map=None):
+        asyncore.dispatcher.del_channel(self, map)
+        interest_changed(self)
+
+
+# The EpollPoller driving the event loop, if any.
+_epoll_poller = None
+
+def interest_changed(obj):
+    """Note that the readable() or writable() of dispatcher obj may have changed."""
+    if _epoll_poller is not None:
+        _epoll_poller.dirty.add(obj)
+
+
+class Timer(object):
+    """A callback scheduled with call_later()."""
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Prevent the callback from running, if it has not already."""
+        self.cancelled = True
+
+
+def call_later(delay, callback, *args):
+    """Call callback(*args) from the event loop after delay seconds.
+
+    Returns a Timer that may be used to cancel the call.
+    """
+    global _seqno
+    timer = Timer(time() + delay, callback, args)
+    _seqno += 1
+    heapq.heappush(_timers, (timer.deadline, _seqno, timer))
+    return timer
+
+
+class Deferred(object):
+    """A result that will be available later.
+
+    Callbacks added with add_callback() are called with the result once it
+    is set with callback(). Only the first result counts; later ones are
+    ignored, so a Deferred can race against a timeout set with
+    set_timeout(). Deferreds are not thread-safe: call callback() from the
+    event loop, or callback_from_thread() from other threads.
+    """
+
+    def __init__(self):
+        self.called = False
+        self.result = None
+        self.callbacks = []
+        self.timer = None
+        self.timed_out = False
+
+    def add_callback(self, func):
+        """Call func(result) once the result is set, or now if it is."""
+        if self.called:
+            func(self.result)
+        else:
+            self.callbacks.append(func)
+
+    def callback(self, result):
+        """Set the result, and call the callbacks. Returns False if it was already set."""
+        if self.called:
+            return False
+        self.called = True
+        self.result = result
+        if self.timer:
+            self.timer.cancel()
+        callbacks, self.callbacks = self.callbacks, None
+        for func in callbacks:
+            try:
+                func(result)
+            except Exception:
+                logger.error("Error in Deferred callback %s:\n%s" %
+                             (repr(func), traceback.format_exc()))
+        return True
+
+    def callback_from_thread(self, result):
+        """Like callback(), but may be called from any thread."""
+        call_from_thread(self.callback, result)
+
+    def set_timeout(self, delay, default):
+        """Set the result to default if it is not set within delay seconds."""
+        if not self.called:
+            self.timer = call_later(delay, self._time_out, default)
+
+    def _time_out(self, default):
+        self.timed_out = True
+        self.callback(default)
+
+    def then(self, func):
+        """Return a Deferred for func(result), which may itself return a Deferred."""
+        d = Deferred()
+        def on_result(result):
+            value = func(result)
+            if isinstance(value, Deferred):
+                value.add_callback(d.callback)
+            else:
+                d.callback(value)
+        self.add_callback(on_result)
+        return d
+
+
+# Callbacks queued by call_from_thread(), as (callback, args) pairs.
+_thread_calls = collections.deque()
+_waker = None
+
+
+class Waker(Dispatcher):
+    """Wakes the event loop from other threads, through a socketpair.
+
+    Once woken, the loop runs the callbacks queued by call_from_thread().
+    """
+
+    def __init__(self, map=None):
+        (rsock, self.wsock) = socket.socketpair()
+        self.wsock.setblocking(0)
+        Dispatcher.__init__(self, rsock, map)
+        self.woken = False
+
+    def wake(self):
+        """Make the event loop run queued callbacks soon. Thread-safe."""
+        if not self.woken:
+            self.woken = True
+            try:
+                self.wsock.send('x')
+            except socket.error as e:
+                # A full socket buffer means a wakeup is already pending.
+                if e.args[0] not in (EAGAIN, EWOULDBLOCK):
+                    raise
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error as e:
+            if e.args[0] not in (EAGAIN, EWOULDBLOCK):
+                raise
+        # Reset before running callbacks, so that callbacks queued from now
+        # on wake the loop again.
+        self.woken = False
+        run_thread_calls()
+
+    def writable(self):
+        return False
+
+    def close(self):
+        Dispatcher.close(self)
+        self.wsock.close()
+
+
+def start_waker(map=None):
+    """Create the Waker that call_from_thread() wakes the event loop with.
+
+    Must be called from the event loop thread before it polls map; run()
+    does. Callbacks queued before that run on the loop's first iteration.
+    """
+    global _waker
+    if _waker is None:
+        _waker = Waker(map)
+        if _thread_calls:
+            _waker.wake()
+
+
+def call_from_thread(callback, *args):
+    """Call callback(*args) from the event loop, as soon as possible.
+
+    Unlike call_later(), this may be called from any thread; the event loop
+    is woken if it is waiting for I/O.
+    """
+    _thread_calls.append((callback, args))
+    # start_waker() sets _waker before checking _thread_calls, so a call
+    # queued before the Waker exists is not lost.
+    waker = _waker
+    if waker is not None:
+        waker.wake()
+
+
+def run_thread_calls():
+    """Run the callbacks queued by call_from_thread()."""
+    while _thread_calls:
+        (callback, args) = _thread_calls.popleft()
+        try:
+            callback(*args)
+        except Exception:
+            logger.error("Error in callback %s:\n%s" %
+                         (repr(callback), traceback.format_exc()))
+
+
+# Functions passed to defer_to_thread(), as (func, args, default, Deferred).
+_thread_work = Queue.Queue()
+_pool = []
+_pool_lock = threading.Lock()
+
+def _pool_worker():
+    while True:
+        (func, args, default, d) = _thread_work.get()
+        try:
+            result = func(*args)
+        except Exception:
+            logger.error("Error in %s called from a thread:\n%s" %
+                         (repr(func), traceback.format_exc()))
+            result = default
+        d.callback_from_thread(result)
+
+def defer_to_thread(func, args=(), default=None):
+    """Call func(*args) on a pool thread, and return a Deferred for the result.
+
+    If func raises an exception, it is logged, and the result is default.
+    """
+    with _pool_lock:
+        if not _pool:
+            for i in range(THREAD_POOL_SIZE):
+                thread = threading.Thread(target=_pool_worker, name='mc3p-pool-%d' % i)
+                thread.daemon = True
+                thread.start()
+                _pool.append(thread)
+    d = Deferred()
+    _thread_work.put((func, args, default, d))
+    return d
+
+
+def run_timers():
+    """Run all expired timers, and return the time until the next one."""
+    now = time()
+    while _timers and _timers[0][0] <= now:
+        timer = heapq.heappop(_timers)[2]
+        if timer.cancelled:
+            continue
+        try:
+            timer.callback(*timer.args)
+        except Exception:
+            logger.error("Error in timer callback %s:\n%s" %
+                         (repr(timer.callback), traceback.format_exc()))
+    while _timers and _timers[0][2].cancelled:
+        heapq.heappop(_timers)
+    if _timers:
+        return max(0.0, _timers[0][0] - time())
+    return MAX_WAIT
+
+
+class EpollPoller(object):
+    """Poll asyncore dispatchers with a persistent epoll object.
+
+    The event mask of a dispatcher is only recomputed when it is in the
+    dirty set: after it handled an event, or when it was added, removed,
+    or passed to interest_changed(). Dispatchers that do not derive from
+    Dispatcher are picked up when the number of dispatchers in the map
+    changes, which also makes the poller re-check every dispatcher.
+    """
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.registered = {} # { fd -> (dispatcher, event mask) }
+        self.fds = {}        # { dispatcher -> registered fd }
+        self.dirty = set()   # Dispatchers whose event mask may be stale.
+
+    def _unregister(self, fd):
+        (obj, flags) = self.registered.pop(fd)
+        del self.fds[obj]
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError, ValueError) as e:
+            # Closing an fd removes it from the epoll set implicitly.
+            if getattr(e, 'errno', None) not in (EBADF, ENOENT, None):
+                raise
+
+    def _update(self, obj, map):
+        """Bring the registration of obj up to date with its state."""
+        registered = self.registered
+        fd = obj._fileno
+        old_fd = self.fds.get(obj)
+        if old_fd is not None and old_fd != fd:
+            self._unregister(old_fd)
+        if fd is None or map.get(fd) is not obj:
+            return # Removed from the map.
+        flags = 0
+        if obj.readable():
+            flags |= select.EPOLLIN | select.EPOLLPRI
+        # accepting sockets should not be writable
+        if obj.writable() and not obj.accepting:
+            flags |= select.EPOLLOUT
+        entry = registered.get(fd)
+        if entry is None:
+            self.epoll.register(fd, flags)
+        elif entry[0] is not obj:
+            # fd was closed and reused by a new dispatcher.
+            self._unregister(fd)
+            self.epoll.register(fd, flags)
+        elif entry[1] != flags:
+            self.epoll.modify(fd, flags)
+        else:
+            return
+        registered[fd] = (obj, flags)
+        self.fds[obj] = fd
+
+    def poll(self, timeout, map):
+        """Wait up to timeout seconds for events, and dispatch them."""
+        dirty = self.dirty
+        while dirty:
+            self._update(dirty.pop(), map)
+        if len(map) != len(self.registered):
+            for fd in [fd for fd in self.registered if map.get(fd) is not self.registered[fd][0]]:
+                self._unregister(fd)
+            for obj in map.values():
+                self._update(obj, map)
+        try:
+            events = self.epoll.poll(timeout)
+        except (IOError, select.error) as e:
+            if e.args[0] != EINTR:
+                raise
+            return
+        for fd, flags in events:
+            obj = map.get(fd)
+            if obj is None:
+                continue
+            # EPOLL* flags share the values of the POLL* flags readwrite expects.
+            asyncore.readwrite(obj, flags)
+            dirty.add(obj)
+
+
+ENGINES = ['select', 'poll']
+if hasattr(select, 'epoll'):
+    ENGINES.append('epoll')
+
+DEFAULT_ENGINE = ENGINES[-1]
+
+
+def make_poller(engine):
+    """Return a poll(timeout, map) function for the named I/O engine."""
+    if engine == 'select':
+        return asyncore.poll
+    elif engine == 'poll':
+        return asyncore.poll2
+    elif engine == 'epoll':
+        global _epoll_poller
+        _epoll_poller = EpollPoller()
+        return _epoll_poller.poll
+    else:
+        raise ValueError("Unsupported I/O engine '%s'" % engine)
+
+
+def _active(map):
+    """Return whether map holds dispatchers other than the Waker."""
+    return len(map) > 1 or (map and map.get(_waker._fileno) is not _waker)
+
+
+def run(map=None, engine=DEFAULT_ENGINE):
+    """Dispatch I/O events and timers until no dispatchers remain."""
+    if map is None:
+        map = asyncore.socket_map
+    start_waker(map)
+    poll = make_poller(engine)
+    timeout = run_timers()
+    while _active(map):
+        poll(timeout, map)
+        timeout = run_timers()
@@ -0,0 +1,396 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Run plugin instances in child processes.
+
+An isolated instance runs in a process forked for it when it is
+instantiated, so its handlers run on another core, and a crash only ends
+that process. The proxy writes each message the instance handles to a ring
+buffer in shared memory; the child filters it as usual, and writes the
+verdict and the modified bytes, if any, to a second ring, along with the
+messages the instance injects. A socketpair carries the wakeups both ways.
+Verdicts arrive asynchronously, as Deferreds; if one is not in by the
+instance's deadline, the message is forwarded unmodified.
+
+Handler times measured in a child are not reported by the proxy's metrics.
+"""
+
+import os, mmap, struct, socket, asyncore, errno, signal, logging, traceback, threading
+from time import sleep
+
+import messages, metrics, eventloop
+from eventloop import Deferred
+from parsing import parse_unsigned_byte
+from util import Stream, monotonic
+
+logger = logging.getLogger(__name__)
+
+# Size in bytes of each of an isolated instance's two ring buffers.
+RING_SIZE = 4 * 1024 * 1024
+
+# Seconds a child waits for room in a full response ring before giving up
+# on a record.
+RESPONSE_TIMEOUT = 1.0
+
+# Seconds a child gets to exit after its session ends, before it is killed.
+EXIT_TIMEOUT = 2.0
+
+SOURCES = ('client', 'server')
+
+# Records sent to a child: sequence number and source, then the message.
+REQUEST = struct.Struct('>IB')
+# Records sent by a child: sequence number and kind, then the bytes, if any.
+RESPONSE = struct.Struct('>IB')
+
+# Kinds of responses.
+DROP, FORWARD, MODIFIED, FROM_CLIENT, FROM_SERVER = range(5)
+
+
+class ShmRing(object):
+    """A single-producer, single-consumer queue of records in shared memory.
+
+    The ring is an anonymous shared mapping, so it is shared with processes
+    forked after it was created. The first 16 bytes hold the total number
+    of bytes ever written, and ever read; the records follow, each a 4-byte
+    length and the data. A record never wraps around the end of the buffer:
+    if it does not fit, the space left is marked as skipped, and the record
+    starts over at the beginning.
+    """
+
+    COUNTER = struct.Struct('=Q')
+    LENGTH = struct.Struct('=I')
+    TAIL, HEAD, DATA = 0, 8, 16
+    WRAP = 0xffffffff
+
+    def __init__(self, size=RING_SIZE):
+        self.buf = mmap.mmap(-1, self.DATA + size)
+        self.size = size
+
+    def _get(self, offset):
+        return self.COUNTER.unpack_from(self.buf, offset)[0]
+
+    def write(self, data):
+        """Append a record, and return True; or False if the ring is full."""
+        buf, size = self.buf, self.size
+        n = self.LENGTH.size + len(data)
+        tail = self._get(self.TAIL)
+        pos = tail % size
+        skip = size - pos if pos + n > size else 0
+        if tail + skip + n - self._get(self.HEAD) > size:
+            return False
+        if skip:
+            if skip >= self.LENGTH.size:
+                self.LENGTH.pack_into(buf, self.DATA + pos, self.WRAP)
+            pos = 0
+        start = self.DATA + pos
+        self.LENGTH.pack_into(buf, start, len(data))
+        buf[start + self.LENGTH.size:start + n] = data
+        # The tail is only moved once the record is complete.
+        self.COUNTER.pack_into(buf, self.TAIL, tail + skip + n)
+        return True
+
+    def read(self):
+        """Remove and return the records written since the last read."""
+        buf, size = self.buf, self.size
+        head = self._get(self.HEAD)
+        tail = self._get(self.TAIL)
+        records = []
+        while head < tail:
+            pos = head % size
+            if size - pos < self.LENGTH.size:
+                head += size - pos
+                continue
+            start = self.DATA + pos
+            (length,) = self.LENGTH.unpack_from(buf, start)
+            if length == self.WRAP:
+                head += size - pos
+                continue
+            start += self.LENGTH.size
+            records.append(buf[start:start + length])
+            head += self.LENGTH.size + length
+        self.COUNTER.pack_into(buf, self.HEAD, head)
+        return records
+
+    def close(self):
+        self.buf.close()
+
+
+class IsolatedPlugin(eventloop.Dispatcher):
+    """Stands in for a plugin instance that runs in a child process.
+
+    Offers the methods PluginManager calls on plugin instances. Its handler
+    returns a Deferred for each message, which the verdict of the instance
+    resolves; if the child is not done with the message within deadline
+    seconds, or is not running, the message is forwarded unmodified.
+    """
+
+    def __init__(self, id, clazz, msgtypes, argstr, proto_version,
+                 from_client, from_server, deadline, slow_threshold,
+                 ring_size=RING_SIZE):
+        self.id = id
+        self.msgtypes = msgtypes
+        self.proto_version = proto_version
+        self.from_client = from_client
+        self.from_server = from_server
+        self.deadline = deadline
+        self.requests = ShmRing(ring_size)
+        self.responses = ShmRing(ring_size)
+        self.seq = 0
+        self.pending = {} # { seq -> (Deferred, msg, source, time submitted) }
+        self.dead = False
+        self.verdict_times = metrics.registry.histogram('plugin_verdict_seconds', plugin=id)
+        self.unfiltered = metrics.registry.counter('plugin_unfiltered_total', plugin=id)
+        (sock, child_sock) = socket.socketpair()
+        self.pid = os.fork()
+        if self.pid == 0:
+            status = 0
+            try:
+                sock.close()
+                run_child(child_sock, self.requests, self.responses, clazz, id, argstr,
+                          proto_version, slow_threshold)
+            except:
+                logger.error("Isolated plugin '%s' failed:\n%s" % (id, traceback.format_exc()))
+                status = 1
+            finally:
+                os._exit(status)
+        child_sock.close()
+        eventloop.Dispatcher.__init__(self, sock)
+        logger.info("Plugin instance '%s' isolated in process %d" % (id, self.pid))
+
+    def _msgtypes(self):
+        return self.msgtypes
+
+    def _handler_for(self, msgtype):
+        if self.msgtypes is not None and msgtype not in self.msgtypes:
+            return None
+        return self.submit
+
+    def submit(self, msg, source):
+        """Send msg to the child, and return a Deferred for its verdict."""
+        if self.dead:
+            return True
+        raw_bytes = msg.get('raw_bytes')
+        if raw_bytes is None or getattr(msg, 'modified', False):
+            msg_spec = messages.protocol[self.proto_version][SOURCES.index(source)]
+            raw_bytes = msg_spec[msg['msgtype']].emit(msg)
+        self.seq = seq = (self.seq + 1) & 0xffffffff
+        if not self.requests.write(REQUEST.pack(seq, SOURCES.index(source)) + raw_bytes):
+            logger.warn("Isolated plugin '%s' is falling behind, forwarding message unfiltered"
+                        % self.id)
+            self.unfiltered.value += 1
+            return True
+        self.notify()
+        d = Deferred()
+        self.pending[seq] = (d, msg, source, monotonic())
+        d.add_callback(lambda forward: self.expired(seq))
+        d.set_timeout(self.deadline, True)
+        return d
+
+    def expired(self, seq):
+        """Called once the verdict on message seq is in, or its deadline passed."""
+        if self.pending.pop(seq, None) is not None:
+            self.unfiltered.value += 1
+            logger.debug("Isolated plugin '%s' missed its deadline" % self.id)
+
+    def notify(self):
+        try:
+            self.socket.send('\0')
+        except socket.error as e:
+            # A full socket buffer means the child has wakeups pending anyway.
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.handle_close()
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        if self.recv(4096):
+            for record in self.responses.read():
+                self.handle_response(record)
+
+    def handle_response(self, record):
+        (seq, kind) = RESPONSE.unpack_from(record)
+        data = record[RESPONSE.size:]
+        if kind == FROM_CLIENT:
+            self.from_client.put(data)
+            return
+        elif kind == FROM_SERVER:
+            self.from_server.put(data)
+            return
+        entry = self.pending.pop(seq, None)
+        if entry is None:
+            return # The deadline passed.
+        (d, msg, source, submitted) = entry
+        self.verdict_times.observe(monotonic() - submitted)
+        if kind == MODIFIED:
+            self.apply(msg, source, data)
+        d.callback(kind != DROP)
+
+    def apply(self, msg, source, data):
+        """Update the fields of msg to those of data, its modified bytes."""
+        msg_spec = messages.protocol[self.proto_version][SOURCES.index(source)]
+        stream = Stream()
+        stream.append(data)
+        msgtype = parse_unsigned_byte(stream)
+        if msgtype != msg['msgtype']:
+            logger.error("Isolated plugin '%s' changed the type of a message" % self.id)
+            return
+        for (key, val) in msg_spec[msgtype].parse(stream).iteritems():
+            msg[key] = val
+
+    def handle_close(self):
+        if not self.dead:
+            logger.error("Isolated plugin '%s' exited, forwarding its messages unfiltered"
+                         % self.id)
+        self.shutdown()
+
+    def handle_error(self):
+        logger.error("Isolated plugin '%s' caught exception:\n%s" %
+                     (self.id, traceback.format_exc()))
+        self.handle_close()
+
+    def shutdown(self):
+        """Stop the child, and forward the messages it has not filtered."""
+        if self.dead:
+            return
+        self.dead = True
+        # The child exits once the socket is closed.
+        self.close()
+        pending, self.pending = self.pending, {}
+        self.unfiltered.value += len(pending)
+        for seq in sorted(pending):
+            pending[seq][0].callback(True)
+        self.reap()
+
+    def reap(self, kill=False):
+        """Collect the exit status of the child.
+
+        If it is still running, try again in EXIT_TIMEOUT seconds, or if
+        kill is True, kill it.
+        """
+        try:
+            (pid, status) = os.waitpid(self.pid, os.WNOHANG)
+            if pid == 0 and kill:
+                logger.warn("Killing isolated plugin '%s'" % self.id)
+                os.kill(self.pid, signal.SIGKILL)
+                os.waitpid(self.pid, 0)
+                return
+        except OSError:
+            return
+        if pid == 0:
+            eventloop.call_later(EXIT_TIMEOUT, self.reap, True)
+
+    def _destroy(self):
+        self.shutdown()
+
+    def __repr__(self):
+        return "<IsolatedPlugin '%s', pid %d>" % (self.id, self.pid)
+
+
+class ResponseChannel(object):
+    """The child's end of the response ring, shared by its threads."""
+
+    def __init__(self, sock, ring):
+        self.sock = sock
+        self.ring = ring
+        self.lock = threading.Lock()
+
+    def write(self, seq, kind, data=''):
+        record = RESPONSE.pack(seq, kind) + data
+        with self.lock:
+            waited = 0.0
+            while not self.ring.write(record):
+                if waited > RESPONSE_TIMEOUT:
+                    logger.error('Response ring full, dropping a response')
+                    return
+                sleep(0.001)
+                waited += 0.001
+
+    def notify(self):
+        try:
+            self.sock.send('\0')
+        except socket.error:
+            pass # The proxy is gone; the child exits on its next read.
+
+
+class ChildQueue(object):
+    """Injection queue of an instance in a child, relayed to the proxy."""
+
+    def __init__(self, channel, kind):
+        self.channel = channel
+        self.kind = kind
+
+    def put(self, msgbytes):
+        self.channel.write(0, self.kind, msgbytes)
+        self.channel.notify()
+
+    def close(self):
+        pass
+
+
+def run_child(sock, requests, responses, clazz, id, argstr, proto_version, slow_threshold):
+    """Filter the messages in requests through an instance of clazz.
+
+    Runs in the child until the proxy closes its end of sock.
+    """
+    # Let go of the parent's sockets, so connections close when it closes them.
+    for dispatcher in asyncore.socket_map.values():
+        if dispatcher.socket is not None:
+            dispatcher.socket.close()
+    asyncore.socket_map.clear()
+    # The parent shuts the child down when it is interrupted.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    from proxy import parse_packet, encode_message
+
+    channel = ResponseChannel(sock, responses)
+    inst = clazz(proto_version, ChildQueue(channel, FROM_CLIENT),
+                 ChildQueue(channel, FROM_SERVER))
+    inst._set_id(id, slow_threshold)
+    inst.init(argstr)
+    try:
+        while sock.recv(4096):
+            for record in requests.read():
+                (seq, i) = REQUEST.unpack_from(record)
+                source = SOURCES[i]
+                msg_spec = messages.protocol[proto_version][i]
+                stream = Stream()
+                stream.append(record[REQUEST.size:])
+                try:
+                    msg = parse_packet(stream, msg_spec, source, lazy=True)
+                    forward = inst.filter(msg, source)
+                    if isinstance(forward, Deferred):
+                        # A child has no event loop to wait for the verdict on.
+                        logger.warn("Isolated plugin '%s' returned a Deferred verdict, "
+                                    "using its default" % id)
+                        forward = inst.async_default
+                    if not forward:
+                        channel.write(seq, DROP)
+                    elif msg.modified:
+                        channel.write(seq, MODIFIED, encode_message(msg, msg_spec))
+                    else:
+                        channel.write(seq, FORWARD)
+                except Exception:
+                    logger.error("Isolated plugin '%s' failed to filter a message:\n%s" %
+                                 (id, traceback.format_exc()))
+                    channel.write(seq, FORWARD)
+            channel.notify()
+    finally:
+        inst._destroy()
@@ -613,3 +613,21 @@ srv_msgs[0xca] = defmsg(0xca, "Abilities", [
     ('flying', MC_bool),
     ('allow_flying', MC_bool),
     ('instant_destroy', MC_bool)])
+
+
+### FIXED PACKET SIZES ###
+
+def packet_sizes(msg_spec):
+    """Return a table of packet sizes, indexed by msgtype.
+
+    The size of a packet whose fields all have a fixed size (including its
+    msgtype byte) is known from its msgtype alone. Entries for other
+    msgtypes are None.
+    """
+    return [1 + parsem.size if parsem and parsem.size is not None else None
+            for parsem in msg_spec]
+
+# { version -> (client packet sizes, server packet sizes) }
+fixed_sizes = {}
+for version in protocol:
+    fixed_sizes[version] = tuple(map(packet_sizes, protocol[version]))
@@ -0,0 +1,400 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+"""Process-wide metrics.
+
+The registry keeps statistics for every message type of every protocol
+version, allocated up front so that recording a packet only increments a
+few attributes: packet and byte counts, drops and modifications made by
+plugins, and histograms of parse and emit times. Other code may register
+its own named counters, histograms and gauges, with labels.
+
+MetricsListener serves the metrics over HTTP, in the Prometheus text
+exposition format. Plugins and tools read them with snapshot(), which
+returns plain data:
+
+    from mc3p import metrics
+    snap = metrics.snapshot()
+    chat = snap['msgtypes'][('client', 0x03)]
+    print chat['packets'], chat['parse_time']['p99'], chat['latency']['max']
+"""
+
+import socket, logging, traceback
+from bisect import bisect_left
+from time import time
+
+import messages, eventloop
+
+logger = logging.getLogger('mc3p')
+
+SIDES = ('client', 'server')
+
+# Upper bounds of the buckets of time histograms, in seconds: 1us to ~1s.
+TIME_BUCKETS = tuple([1e-6 * 2 ** i for i in xrange(21)])
+
+
+class Histogram(object):
+    """Distribution of observed values, in buckets with fixed upper bounds.
+
+    Values above the last bound are counted in an extra, unbounded bucket.
+    """
+    __slots__ = ('bounds', 'buckets', 'count', 'sum', 'max')
+
+    def __init__(self, bounds=TIME_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value, n=1):
+        """Record n observations of value."""
+        self.buckets[bisect_left(self.bounds, value)] += n
+        self.count += n
+        self.sum += value * n
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """Add the observations of another histogram with the same bounds."""
+        for (i, n) in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q):
+        """Estimate the q-quantile, as the upper bound of its bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for (i, n) in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                if i == len(self.bounds):
+                    return self.max
+                return min(self.bounds[i], self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+                'p50': self.quantile(0.5), 'p99': self.quantile(0.99),
+                'bounds': self.bounds, 'buckets': list(self.buckets)}
+
+
+class Counter(object):
+    """A named count; increment its value attribute directly."""
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+
+class MsgTypeStats(object):
+    """Statistics for one message type of one protocol version and side."""
+    __slots__ = ('name', 'packets', 'bytes', 'drops', 'modified',
+                 'parse_time', 'emit_time', 'plugin_time', 'latency')
+
+    def __init__(self, name):
+        self.name = name
+        self.packets = 0
+        self.bytes = 0
+        self.drops = 0     # Packets dropped by plugins.
+        self.modified = 0  # Packets modified by plugins.
+        self.parse_time = Histogram()
+        self.emit_time = Histogram()
+        self.plugin_time = Histogram()
+        # Time from reading a packet to handing its bytes to the other side's
+        # socket, which includes plugin_time.
+        self.latency = Histogram()
+
+
+class Registry(object):
+    """Holds all of a process's metrics."""
+
+    def __init__(self, protocol=None):
+        if protocol is None:
+            protocol = messages.protocol
+        self.start_time = time()
+        self.tables = {} # { (version, side) -> [MsgTypeStats or None] * 256 }
+        for version in protocol:
+            for (side, msg_spec) in zip(SIDES, protocol[version]):
+                self.tables[(version, side)] = [
+                    MsgTypeStats(parsem.name) if parsem else None
+                    for parsem in msg_spec]
+        # Named metrics are keyed by (name, ((label, value), ...)).
+        self.counters = {}   # { key -> Counter }
+        self.histograms = {} # { key -> Histogram }
+        self.gauges = {}     # { key -> function returning a number }
+
+    def msgtype_table(self, version, side):
+        """Return the MsgTypeStats of a protocol version's side, by msgtype."""
+        return self.tables[(version, side)]
+
+    def counter(self, name, **labels):
+        """Return the Counter called name with labels, creating it if necessary."""
+        key = (name, tuple(sorted(labels.items())))
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = self.counters[key] = Counter()
+        return counter
+
+    def histogram(self, name, bounds=TIME_BUCKETS, **labels):
+        """Return the Histogram called name with labels, creating it if necessary."""
+        key = (name, tuple(sorted(labels.items())))
+        hist = self.histograms.get(key)
+        if hist is None:
+            hist = self.histograms[key] = Histogram(bounds)
+        return hist
+
+    def gauge(self, name, func, **labels):
+        """Register func, called without arguments, as the value of a gauge."""
+        self.gauges[(name, tuple(sorted(labels.items())))] = func
+
+    def merged(self, side, attr):
+        """Return a Histogram merging histogram attr of all of side's msgtypes."""
+        total = Histogram()
+        for ((version, table_side), table) in self.tables.items():
+            if table_side == side:
+                for stats in table:
+                    if stats is not None and stats.packets:
+                        total.merge(getattr(stats, attr))
+        return total
+
+    def snapshot(self):
+        """Return the current metrics as plain data.
+
+        Message type statistics are summed across protocol versions, and keyed
+        by (side, msgtype); message types that saw no packets are left out.
+        The latency and plugin time of all packets from each side are
+        summarized under 'sides'. Counters, histograms and gauges are keyed
+        as in the registry.
+        """
+        totals = {}
+        for ((version, side), table) in sorted(self.tables.items()):
+            for (msgtype, stats) in enumerate(table):
+                if stats is None or not stats.packets:
+                    continue
+                total = totals.get((side, msgtype))
+                if total is None:
+                    total = totals[(side, msgtype)] = MsgTypeStats(stats.name)
+                total.name = stats.name
+                total.packets += stats.packets
+                total.bytes += stats.bytes
+                total.drops += stats.drops
+                total.modified += stats.modified
+                total.parse_time.merge(stats.parse_time)
+                total.emit_time.merge(stats.emit_time)
+                total.plugin_time.merge(stats.plugin_time)
+                total.latency.merge(stats.latency)
+        msgtypes = {}
+        for (key, total) in totals.items():
+            msgtypes[key] = {'name': total.name, 'packets': total.packets,
+                             'bytes': total.bytes, 'drops': total.drops,
+                             'modified': total.modified,
+                             'parse_time': total.parse_time.snapshot(),
+                             'emit_time': total.emit_time.snapshot(),
+                             'plugin_time': total.plugin_time.snapshot(),
+                             'latency': total.latency.snapshot()}
+        sides = {}
+        for side in SIDES:
+            sides[side] = {'latency': self.merged(side, 'latency').snapshot(),
+                           'plugin_time': self.merged(side, 'plugin_time').snapshot()}
+        return {'time': time(), 'uptime': time() - self.start_time,
+                'msgtypes': msgtypes, 'sides': sides,
+                'counters': dict([(key, c.value) for (key, c) in self.counters.items()]),
+                'histograms': dict([(key, h.snapshot())
+                                    for (key, h) in self.histograms.items()]),
+                'gauges': dict([(key, func()) for (key, func) in self.gauges.items()])}
+
+
+registry = Registry()
+
+def snapshot():
+    """Return a snapshot of the process-wide registry's metrics."""
+    return registry.snapshot()
+
+
+### Prometheus exposition format ###
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, _escape(v)) for (k, v) in pairs])
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+def _render_histogram(lines, name, pairs, hist):
+    seen = 0
+    for (bound, n) in zip(list(hist['bounds']) + [float('inf')], hist['buckets']):
+        seen += n
+        lines.append('%s_bucket%s %d' % (name, _labels(pairs + (('le', _number(bound)),)),
+                                          seen))
+    lines.append('%s_sum%s %s' % (name, _labels(pairs), _number(hist['sum'])))
+    lines.append('%s_count%s %d' % (name, _labels(pairs), hist['count']))
+
+def render(snap, prefix='mc3p_'):
+    """Return a snapshot in the Prometheus text exposition format."""
+    lines = []
+    typed = set()
+    def declare(name, type):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE %s %s' % (name, type))
+
+    msgtypes = sorted(snap['msgtypes'].items())
+    for (metric, key) in (('packets_total', 'packets'), ('bytes_total', 'bytes'),
+                          ('dropped_packets_total', 'drops'),
+                          ('modified_packets_total', 'modified')):
+        declare(prefix + metric, 'counter')
+        for ((side, msgtype), stats) in msgtypes:
+            pairs = (('side', side), ('msgtype', '0x%02x' % msgtype),
+                     ('name', stats['name']))
+            lines.append('%s%s%s %d' % (prefix, metric, _labels(pairs), stats[key]))
+    for (metric, key) in (('parse_seconds', 'parse_time'), ('emit_seconds', 'emit_time'),
+                          ('plugin_seconds', 'plugin_time'),
+                          ('latency_seconds', 'latency')):
+        declare(prefix + metric, 'histogram')
+        for ((side, msgtype), stats) in msgtypes:
+            _render_histogram(lines, prefix + metric,
+                              (('side', side), ('msgtype', '0x%02x' % msgtype)),
+                              stats[key])
+    for ((name, pairs), value) in sorted(snap['counters'].items()):
+        declare(prefix + name, 'counter')
+        lines.append('%s%s%s %d' % (prefix, name, _labels(pairs), value))
+    for ((name, pairs), value) in sorted(snap['gauges'].items()):
+        declare(prefix + name, 'gauge')
+        lines.append('%s%s%s %s' % (prefix, name, _labels(pairs), _number(value)))
+    for ((name, pairs), hist) in sorted(snap['histograms'].items()):
+        declare(prefix + name, 'histogram')
+        _render_histogram(lines, prefix + name, pairs, hist)
+    return '\n'.join(lines) + '\n'
+
+
+### HTTP endpoint ###
+
+# Seconds between renderings of the metrics page.
+REFRESH_INTERVAL = 5.0
+# Requests longer than MAX_REQUEST_SIZE bytes, or not received within
+# REQUEST_TIMEOUT seconds, are dropped.
+MAX_REQUEST_SIZE = 8192
+REQUEST_TIMEOUT = 10.0
+
+def listen_socket(host, port):
+    """Return a socket listening for metrics requests on host:port."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(16)
+    logger.info("metrics listener bound to %s:%d" % (host, port))
+    return sock
+
+class MetricsListener(eventloop.Dispatcher):
+    """Serve the process's metrics over HTTP, from the event loop.
+
+    Requests are answered with a page rendered in advance, and re-rendered
+    every refresh_interval seconds, so that a scrape costs no more than
+    sending the page.
+    """
+
+    def __init__(self, sock, refresh_interval=REFRESH_INTERVAL):
+        eventloop.Dispatcher.__init__(self)
+        self.refresh_interval = refresh_interval
+        self.page = ''
+        self.timer = None
+        sock.setblocking(0)
+        self.set_socket(sock)
+        self.accepting = True
+        self.refresh()
+
+    def refresh(self):
+        """Render the metrics page, and schedule the next rendering."""
+        try:
+            self.page = render(registry.snapshot())
+        except Exception:
+            logger.error("Could not render metrics:\n%s" % traceback.format_exc())
+        self.timer = eventloop.call_later(self.refresh_interval, self.refresh)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            MetricsRequest(pair[0], self)
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+        eventloop.Dispatcher.close(self)
+
+class MetricsRequest(eventloop.Dispatcher):
+    """An HTTP request to a MetricsListener."""
+
+    def __init__(self, sock, listener):
+        eventloop.Dispatcher.__init__(self, sock)
+        self.listener = listener
+        self.request = ''
+        self.response = None
+        self.timer = eventloop.call_later(REQUEST_TIMEOUT, self.close)
+
+    def handle_read(self):
+        self.request += self.recv(MAX_REQUEST_SIZE)
+        if '\r\n\r\n' in self.request or '\n\n' in self.request:
+            self.respond(self.request.split('\n', 1)[0].split())
+        elif len(self.request) > MAX_REQUEST_SIZE:
+            self.close()
+
+    def respond(self, request_line):
+        """Queue the response to the request with the given request line."""
+        method = request_line[0] if request_line else None
+        if len(request_line) < 2 or method not in ('GET', 'HEAD'):
+            (status, body) = ('405 Method Not Allowed', 'Method not allowed\n')
+        elif request_line[1].split('?')[0] not in ('/', '/metrics'):
+            (status, body) = ('404 Not Found', 'Not found\n')
+        else:
+            (status, body) = ('200 OK', self.listener.page)
+        headers = ('HTTP/1.0 %s\r\n' % status +
+                   'Content-Type: text/plain; version=0.0.4\r\n' +
+                   'Content-Length: %d\r\n' % len(body) +
+                   'Connection: close\r\n\r\n')
+        if method == 'HEAD':
+            body = ''
+        self.response = memoryview(headers + body)
+
+    def readable(self):
+        return self.response is None
+
+    def writable(self):
+        return self.response is not None
+
+    def handle_write(self):
+        sent = self.send(self.response)
+        self.response = self.response[sent:]
+        if not len(self.response):
+            self.close()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        self.timer.cancel()
+        eventloop.Dispatcher.close(self)
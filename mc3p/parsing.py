@@ -17,21 +17,49 @@
 
 import sys, struct, logging, inspect
 
+from util import Reader
+
 logger = logging.getLogger('parsing')
 
 class Parsem(object):
-    """Parser/emitter."""
+    """Parser/emitter.
+
+    Besides parse and emit, a Parsem has a skip operation that advances a
+    stream past a value without decoding it. If no skipper is given, skip
+    parses the value and discards it.
+
+    size is the encoded size in bytes of every value, or None if values
+    vary in size. Fixed-width primitives also have a struct format character,
+    fmt, which lets defmsg decode runs of them with a single struct.Struct.
+    """
 
-    def __init__(self,parser,emitter, name=None):
+    def __init__(self,parser,emitter, name=None, skipper=None, size=None, fmt=None):
         self.name = name
+        if fmt is not None and size is None:
+            size = struct.calcsize('>' + fmt)
+        self.size = size
+        self.fmt = fmt
         setattr(self,'parse',parser)
         setattr(self,'emit',emitter)
+        if skipper is None:
+            skipper = skip_fixed(size) if size is not None else parser
+        setattr(self,'skip',skipper)
+
+def skip_fixed(n):
+    """Return a skipper for values that are always n bytes long."""
+    def skip(stream):
+        stream.skip(n)
+    return skip
+
+# Precompiled codecs for primitive types.
+BYTE, UNSIGNED_BYTE, SHORT, INT, LONG, FLOAT, DOUBLE = [
+    struct.Struct(fmt) for fmt in ('>b', '>B', '>h', '>i', '>q', '>f', '>d')]
 
 def parse_byte(stream):
-    return struct.unpack_from(">b",stream.read(1))[0]
+    return BYTE.unpack_from(stream.read(1))[0]
 
 def emit_byte(b):
-    return struct.pack(">b",b)
+    return BYTE.pack(b)
 
 
 def with_defaults(tuple):
@@ -44,17 +72,157 @@ def with_defaults(tuple):
     else:
         return tuple
 
+def compile_fields(pairs, prefix=''):
+    """Compile (name,Parsem) pairs into a list of codec segments.
+
+    Each run of adjacent fields that have a struct format is merged into
+    one segment (names, struct.Struct, None), which decodes the whole run
+    with a single unpack. Every other field becomes a segment
+    (name, None, Parsem). The struct format characters in prefix are
+    prepended to the first segment, which is then always a struct segment;
+    emitters use this to pack the message header along with the first run.
+    """
+    segments = []
+    fmt, names = prefix, []
+    for (name,parsem) in pairs:
+        if parsem.fmt is not None:
+            fmt += parsem.fmt
+            names.append(name)
+            continue
+        if fmt:
+            segments.append((tuple(names), struct.Struct('>' + fmt), None))
+            fmt, names = '', []
+        segments.append((name, None, parsem))
+    if fmt:
+        segments.append((tuple(names), struct.Struct('>' + fmt), None))
+    return segments
+
+def parse_fields(stream, segments, msg):
+    """Parse fields described by compile_fields() segments into msg."""
+    for (names, codec, parsem) in segments:
+        if codec is not None:
+            msg.update(zip(names, codec.unpack_from(stream.read(codec.size))))
+        else:
+            msg[names] = parsem.parse(stream)
+
+def emit_fields(msg, segments, header):
+    """Emit fields described by compile_fields() segments.
+
+    header is a tuple of the values for the format characters that prefix
+    the first segment.
+    """
+    (names, codec, parsem) = segments[0]
+    parts = [codec.pack(*(header + tuple([msg[name] for name in names])))]
+    for (names, codec, parsem) in segments[1:]:
+        if codec is not None:
+            parts.append(codec.pack(*[msg[name] for name in names]))
+        else:
+            parts.append(parsem.emit(msg[names]))
+    return ''.join(parts)
+
+def index_fields(stream, segments):
+    """Skip over fields described by compile_fields() segments.
+
+    Returns the offset of each segment, relative to the start of the packet.
+    """
+    offsets = []
+    for (names, codec, parsem) in segments:
+        offsets.append(stream.i)
+        if codec is not None:
+            stream.skip(codec.size)
+        else:
+            parsem.skip(stream)
+    return offsets
+
+def segment_decoder(segment):
+    """Return a function decoding a compile_fields() segment into a message.
+
+    The function takes the message, its raw bytes and the offset of the
+    segment in them, and sets the segment's fields, except for those that
+    are already set.
+    """
+    (names, codec, parsem) = segment
+    if codec is not None:
+        def decode(msg, raw_bytes, offset):
+            for (name, value) in zip(names, codec.unpack_from(raw_bytes, offset)):
+                dict.setdefault(msg, name, value)
+    else:
+        def decode(msg, raw_bytes, offset):
+            dict.setdefault(msg, names, parsem.parse(Reader(raw_bytes, offset)))
+    return decode
+
+def patch_fields(parsem, raw_bytes, offsets, msg, names):
+    """Return raw_bytes, with the fields in names set to their values in msg.
+
+    parsem is the message's Parsem, built by defmsg(), and offsets holds the
+    offset of each of its segments in raw_bytes. Only fixed-width fields
+    can be patched; if names includes any other key, returns None.
+    """
+    fixed_fields = parsem.fixed_fields
+    patched = bytearray(raw_bytes)
+    for name in names:
+        field = fixed_fields.get(name)
+        if field is None:
+            return None
+        (idx, pos, codec) = field
+        codec.pack_into(patched, offsets[idx] + pos, msg[name])
+    return str(patched)
+
 def defmsg(msgtype, name, pairs):
-    """Build a Parsem for a message out of (name,Parsem) pairs."""
+    """Build a Parsem for a message out of (name,Parsem) pairs.
+
+    Besides parse, emit and skip, message Parsems describe the layout of
+    their fields, for decoding fields one at a time: segments is the list of
+    compile_fields() segments, and field_segments maps each field name to
+    the index of its segment. fixed_fields maps the name of each fixed-width
+    field to (segment index, offset in segment, struct.Struct). For messages
+    of fixed size, offsets lists the offset of each segment from the start
+    of the packet; for the others, index(stream) skips over a message and
+    returns them, like index_fields(). decoders holds a segment_decoder()
+    for each segment. codegen.install() replaces index and decoders with
+    generated code, along with parse and emit.
+    """
+    parse_segments = compile_fields(pairs)
+    emit_segments = compile_fields(pairs, 'B')
+    header = (msgtype,)
     def parse(stream):
         msg = {'msgtype': msgtype}
-        for (name,parsem) in pairs:
-            msg[name] = parsem.parse(stream)
+        parse_fields(stream, parse_segments, msg)
         return msg
     def emit(msg):
-        return ''.join([emit_unsigned_byte(msgtype),
-                        ''.join([parsem.emit(msg[name]) for (name,parsem) in pairs])])
-    return Parsem(parse,emit,name)
+        return emit_fields(msg, emit_segments, header)
+    def skip(stream):
+        for (name,parsem) in pairs:
+            parsem.skip(stream)
+    def index(stream):
+        return index_fields(stream, parse_segments)
+    sizes = [field.size for (field_name, field) in pairs]
+    size = None if None in sizes else sum(sizes)
+    parsem = Parsem(parse,emit,name,skip,size)
+    parsem.msgtype = msgtype
+    parsem.fields = pairs
+    parsem.segments = parse_segments
+    parsem.index = index
+    parsem.decoders = [segment_decoder(segment) for segment in parse_segments]
+    parsem.field_segments = {}
+    parsem.fixed_fields = {}
+    fields = dict(pairs)
+    for (idx, (names, codec, field)) in enumerate(parse_segments):
+        if codec is None:
+            parsem.field_segments[names] = idx
+            continue
+        pos = 0
+        for name in names:
+            parsem.field_segments[name] = idx
+            field_codec = struct.Struct('>' + fields[name].fmt)
+            parsem.fixed_fields[name] = (idx, pos, field_codec)
+            pos += field_codec.size
+    parsem.offsets = None
+    if size is not None:
+        parsem.offsets = [1]
+        for (names, codec, field) in parse_segments[:-1]:
+            parsem.offsets.append(parsem.offsets[-1] + (codec or field).size)
+    return parsem
 
 def defloginmsg(tuples):
     """One-off used to define login message.
@@ -65,72 +233,85 @@ def defloginmsg(tuples):
        protocol version. For the remaining fields, min_version and max_version
        (inclusive) define the range of versions in which the field is present.
        """
+    tuples = map(with_defaults, tuples)
+    compiled = {} # { proto_version -> (parse segments, emit segments) }
+    def segments(proto_version):
+        if proto_version in compiled:
+            return compiled[proto_version]
+        pairs = version_fields(tuples, proto_version)
+        segs = (compile_fields(pairs), compile_fields(pairs, 'Bi'))
+        # Don't let clients claiming arbitrary versions fill the cache.
+        if len(compiled) < 64:
+            compiled[proto_version] = segs
+        return segs
     def parse(stream):
         msg = {'msgtype': 0x01}
         proto_version = parse_int(stream)
         msg['proto_version'] = proto_version
-        for (name,parsem,min,max) in map(with_defaults, tuples):
-            if min <= proto_version <= max:
-                msg[name] = parsem.parse(stream)
+        parse_fields(stream, segments(proto_version)[0], msg)
         return msg
     def emit(msg):
         proto_version = msg['proto_version']
-        pairs = ((name,parsem) for (name,parsem,x,y) in map(with_defaults, tuples)
-                               if x <= proto_version <= y)
-        return ''.join([emit_unsigned_byte(0x01),
-                        emit_int(msg['proto_version']),
-                        ''.join([parsem.emit(msg[name]) for (name,parsem) in pairs])])
-    return Parsem(parse, emit)
+        return emit_fields(msg, segments(proto_version)[1], (0x01, proto_version))
+    parsem = Parsem(parse, emit, "Login packet")
+    parsem.msgtype = 0x01
+    parsem.versioned_fields = tuples
+    return parsem
+
+def version_fields(tuples, proto_version):
+    """Return the (name,Parsem) pairs of a login message in a protocol version."""
+    return [(name,parsem) for (name,parsem,min,max) in tuples
+                          if min <= proto_version <= max]
 
-MC_byte = Parsem(parse_byte,emit_byte)
+MC_byte = Parsem(parse_byte,emit_byte,fmt='b')
 
 def parse_unsigned_byte(stream):
-    return struct.unpack(">B",stream.read(1))[0]
+    return UNSIGNED_BYTE.unpack_from(stream.read(1))[0]
 
 def emit_unsigned_byte(b):
-    return struct.pack(">B",b)
+    return UNSIGNED_BYTE.pack(b)
 
-MC_unsigned_byte = Parsem(parse_unsigned_byte, emit_unsigned_byte)
+MC_unsigned_byte = Parsem(parse_unsigned_byte, emit_unsigned_byte, fmt='B')
 
 def parse_short(stream):
-    return struct.unpack_from(">h",stream.read(2))[0]
+    return SHORT.unpack_from(stream.read(2))[0]
 
 def emit_short(s):
-    return struct.pack(">h",s)
+    return SHORT.pack(s)
 
-MC_short = Parsem(parse_short, emit_short)
+MC_short = Parsem(parse_short, emit_short, fmt='h')
 
 def parse_int(stream):
-    return struct.unpack_from(">i",stream.read(4))[0]
+    return INT.unpack_from(stream.read(4))[0]
 
 def emit_int(i):
-    return struct.pack(">i",i)
+    return INT.pack(i)
 
-MC_int = Parsem(parse_int, emit_int)
+MC_int = Parsem(parse_int, emit_int, fmt='i')
 
 def parse_long(stream):
-    return struct.unpack_from(">q",stream.read(8))[0]
+    return LONG.unpack_from(stream.read(8))[0]
 
 def emit_long(l):
-    return struct.pack(">q",l)
+    return LONG.pack(l)
 
-MC_long = Parsem(parse_long, emit_long)
+MC_long = Parsem(parse_long, emit_long, fmt='q')
 
 def parse_float(stream):
-    return struct.unpack_from(">f",stream.read(4))[0]
+    return FLOAT.unpack_from(stream.read(4))[0]
 
 def emit_float(f):
-    return struct.pack(">f",f)
+    return FLOAT.pack(f)
 
-MC_float = Parsem(parse_float, emit_float)
+MC_float = Parsem(parse_float, emit_float, fmt='f')
 
 def parse_double(stream):
-    return struct.unpack_from(">d",stream.read(8))[0]
+    return DOUBLE.unpack_from(stream.read(8))[0]
 
 def emit_double(d):
-    return struct.pack(">d",d)
+    return DOUBLE.pack(d)
 
-MC_double = Parsem(parse_double, emit_double)
+MC_double = Parsem(parse_double, emit_double, fmt='d')
 
 def parse_string(stream):
     n = parse_short(stream)
@@ -141,21 +322,27 @@ def parse_string(stream):
 def emit_string(s):
     return ''.join([emit_short(len(s)), s.encode("utf-16-be")])
 
-MC_string = Parsem(parse_string, emit_string)
+def skip_string(stream):
+    stream.skip(2*parse_short(stream))
+
+MC_string = Parsem(parse_string, emit_string, skipper=skip_string)
 
 def parse_string8(stream):
     n = parse_short(stream)
     if n == 0:
         return ''
-    return stream.read(n)
+    return str(stream.read(n))
 
 def emit_string8(s):
     return ''.join([emit_short(len(s)),s])
 
-MC_string8 = Parsem(parse_string8, emit_string8)
+def skip_string8(stream):
+    stream.skip(parse_short(stream))
+
+MC_string8 = Parsem(parse_string8, emit_string8, skipper=skip_string8)
 
 def parse_bool(stream):
-    b = struct.unpack_from(">B",stream.read(1))[0]
+    b = UNSIGNED_BYTE.unpack_from(stream.read(1))[0]
     if b==0:
         return False
     else:
@@ -167,7 +354,7 @@ def emit_bool(b):
     else:
         return emit_unsigned_byte(0)
 
-MC_bool = Parsem(parse_bool, emit_bool)
+MC_bool = Parsem(parse_bool, emit_bool, fmt='?')
 
 def parse_metadata(stream):
     data=[]
@@ -189,7 +376,7 @@ def parse_metadata(stream):
             data.append(parse_byte(stream))
             data.append(parse_short(stream))
         else:
-            logger.error(repr(stream.buf[:parse.i]))
+            logger.error(repr(stream.peek()[:stream.i]))
             raise Exception("Unknown metadata type %d" % type)
         type = parse_byte(stream)
     return data
@@ -197,7 +384,22 @@ def parse_metadata(stream):
 def emit_metadata(md):
     raise NotImplementedError
 
-MC_metadata = Parsem(parse_metadata, emit_metadata)
+# Sizes of metadata values by type; strings (type 4) are variable-length.
+METADATA_SIZES = {0: 1, 1: 2, 2: 4, 3: 4, 5: 5}
+
+def skip_metadata(stream):
+    type = parse_unsigned_byte(stream)
+    while (type != 127):
+        type = type >> 5
+        if type == 4:
+            skip_string(stream)
+        elif type in METADATA_SIZES:
+            stream.skip(METADATA_SIZES[type])
+        else:
+            raise Exception("Unknown metadata type %d" % type)
+        type = parse_byte(stream)
+
+MC_metadata = Parsem(parse_metadata, emit_metadata, skipper=skip_metadata)
 
 def parse_inventory(stream):
     n = parse_short(stream)
@@ -209,7 +411,11 @@ def emit_inventory(inv):
     slotstr = ''.join([emit_slot_update(slot) for slot in inv['slots']])
     return ''.join([emit_short(inv['count']),slotstr])
 
-MC_inventory = Parsem(parse_inventory,emit_inventory)
+def skip_inventory(stream):
+    for i in xrange(0,parse_short(stream)):
+        skip_slot_update(stream)
+
+MC_inventory = Parsem(parse_inventory,emit_inventory,skipper=skip_inventory)
 
 def parse_slot_update(stream):
     id = parse_short(stream)
@@ -222,7 +428,11 @@ def emit_slot_update(update):
         return emit_short(-1)
     return ''.join([emit_short(update['item_id']), emit_byte(update['count']), emit_short(update['uses'])])
 
-MC_slot_update = Parsem(parse_slot_update, emit_slot_update)
+def skip_slot_update(stream):
+    if parse_short(stream) != -1:
+        stream.skip(3)
+
+MC_slot_update = Parsem(parse_slot_update, emit_slot_update, skipper=skip_slot_update)
 
 SLOT_UPDATE_2_ITEM_IDS = set([
     0x103, #Flint and steel
@@ -253,7 +463,7 @@ def parse_slot_update2(stream):
         n = parse_short(stream)
         r['nbt_size'] = n
         if n > 0:
-            r['nbt_data'] = stream.read(n)
+            r['nbt_data'] = str(stream.read(n))
         else:
             r['nbt_data'] = None
     return r
@@ -270,7 +480,16 @@ def emit_slot_update2(update):
         s = ''.join([s, nbtdata])
     return s
 
-MC_slot_update2 = Parsem(parse_slot_update2, emit_slot_update2)
+def skip_slot_update2(stream):
+    id = parse_short(stream)
+    if id != -1:
+        stream.skip(3)
+        if id in SLOT_UPDATE_2_ITEM_IDS:
+            n = parse_short(stream)
+            if n > 0:
+                stream.skip(n)
+
+MC_slot_update2 = Parsem(parse_slot_update2, emit_slot_update2, skipper=skip_slot_update2)
 
 def parse_inventory2(stream):
     n = parse_short(stream)
@@ -282,26 +501,37 @@ def emit_inventory2(inv):
     slotstr = ''.join([emit_slot_update2(slot) for slot in inv['slots']])
     return ''.join([emit_short(inv['count']),slotstr])
 
-MC_inventory2 = Parsem(parse_inventory2,emit_inventory2)
+def skip_inventory2(stream):
+    for i in xrange(0,parse_short(stream)):
+        skip_slot_update2(stream)
+
+MC_inventory2 = Parsem(parse_inventory2,emit_inventory2,skipper=skip_inventory2)
 
 def parse_chunk(stream):
     n = parse_int(stream)
-    return { 'size': n, 'data': stream.read(n) }
+    return { 'size': n, 'data': str(stream.read(n)) }
 
 def emit_chunk(ch):
     return ''.join([emit_int(ch['size']), ch['data']])
 
-MC_chunk = Parsem(parse_chunk, emit_chunk)
+def skip_chunk(stream):
+    stream.skip(parse_int(stream))
+
+MC_chunk = Parsem(parse_chunk, emit_chunk, skipper=skip_chunk)
 
 def parse_chunk2(stream):
     n = parse_int(stream)
     parse_int(stream)
-    return { 'size': n, 'data': stream.read(n) }
+    return { 'size': n, 'data': str(stream.read(n)) }
 
 def emit_chunk2(ch):
     return ''.join([emit_int(ch['size']), emit_int(0), ch['data']])
 
-MC_chunk2 = Parsem(parse_chunk2, emit_chunk2)
+def skip_chunk2(stream):
+    n = parse_int(stream)
+    stream.skip(4 + n)
+
+MC_chunk2 = Parsem(parse_chunk2, emit_chunk2, skipper=skip_chunk2)
 
 def parse_multi_block_change(stream):
     n = parse_short(stream)
@@ -315,7 +545,11 @@ def emit_multi_block_change(changes):
                     ''.join([emit_byte(x)  for x in changes['type_array']]),
                     ''.join([emit_byte(x)  for x in changes['metadata_array']])])
 
-MC_multi_block_change = Parsem(parse_multi_block_change, emit_multi_block_change)
+def skip_multi_block_change(stream):
+    stream.skip(4*max(0, parse_short(stream)))
+
+MC_multi_block_change = Parsem(parse_multi_block_change, emit_multi_block_change,
+                               skipper=skip_multi_block_change)
 
 def parse_multi_block_change2(stream):
     n = parse_int(stream)/4
@@ -325,7 +559,11 @@ def emit_multi_block_change2(changes):
     return ''.join([emit_int(len(changes)*4),
            ''.join([emit_int(c) for c in changes])])
 
-MC_multi_block_change2 = Parsem(parse_multi_block_change2, emit_multi_block_change2)
+def skip_multi_block_change2(stream):
+    stream.skip(4*max(0, parse_int(stream)/4))
+
+MC_multi_block_change2 = Parsem(parse_multi_block_change2, emit_multi_block_change2,
+                                skipper=skip_multi_block_change2)
 
 def parse_explosion_records(stream):
     n = parse_int(stream)
@@ -338,7 +576,11 @@ def emit_explosion_records(msg):
                     ''.join([(emit_byte(rec[0]), emit_byte(rec[1]), emit_byte(rec[2]))
                              for rec in msg['data']])])
 
-MC_explosion_records = Parsem(parse_explosion_records, emit_explosion_records)
+def skip_explosion_records(stream):
+    stream.skip(3*max(0, parse_int(stream)))
+
+MC_explosion_records = Parsem(parse_explosion_records, emit_explosion_records,
+                              skipper=skip_explosion_records)
 
 def parse_vehicle_data(stream):
     x = parse_int(stream)
@@ -356,19 +598,26 @@ def emit_vehicle_data(data):
         str = ''.join([str, emit_int(data['unknown2']), emit_int(data['unknown3']), emit_int(data['unknown4'])])
     return str
 
-MC_vehicle_data = Parsem(parse_vehicle_data, emit_vehicle_data)
+def skip_vehicle_data(stream):
+    if parse_int(stream) > 0:
+        stream.skip(6)
+
+MC_vehicle_data = Parsem(parse_vehicle_data, emit_vehicle_data, skipper=skip_vehicle_data)
 
 def parse_item_data(stream):
     n = parse_unsigned_byte(stream)
     if n == 0:
         return ''
-    return stream.read(n)
+    return str(stream.read(n))
 
 def emit_item_data(s):
     assert len(s) < 265
     return ''.join([emit_unsigned_byte(len(s)),s])
 
-MC_item_data = Parsem(parse_item_data, emit_item_data)
+def skip_item_data(stream):
+    stream.skip(parse_unsigned_byte(stream))
+
+MC_item_data = Parsem(parse_item_data, emit_item_data, skipper=skip_item_data)
 
 def parse_fireball_data(stream):
     data = {}
@@ -387,4 +636,9 @@ def emit_fireball_data(data):
                            emit_short(data['u3']))
     return str
 
-MC_fireball_data = Parsem(parse_fireball_data, emit_fireball_data)
+def skip_fireball_data(stream):
+    if parse_int(stream) > 0:
+        stream.skip(6)
+
+MC_fireball_data = Parsem(parse_fireball_data, emit_fireball_data,
+                          skipper=skip_fireball_data)
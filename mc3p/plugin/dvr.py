@@ -54,6 +54,7 @@ class DVROptParser(optparse.OptionParser):
         raise PluginError(msg)
 
 class DVRPlugin(MC3Plugin):
+    observe_only = True
 
     def init(self, args):
         self.cli_msgs = set()
@@ -122,7 +123,7 @@ class DVRPlugin(MC3Plugin):
         return True
 
     def record_msg(self, msg, file):
-        t = time.time() - self.t0
+        t = getattr(msg, 'time', time.time()) - self.t0
         bytes = msg['raw_bytes']
         hdr = struct.pack("<If", len(bytes), t)
         file.write(hdr)
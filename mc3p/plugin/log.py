@@ -26,6 +26,8 @@ IGNORE = ['mgstype']
 SHORTEN = ['chunk', 'raw_bytes']
 
 class LogPlugin(MC3Plugin):
+    observe_only = True
+
     def default_handler(self, msg, source):
         line = []
         msgs = srv_msgs # TODO
@@ -23,10 +23,15 @@ import logging
 import traceback
 import imp
 import inspect
-import multiprocessing
-import Queue
+import collections
+import threading
 import messages
+import metrics
+import eventloop
+import isolation
 import traceback
+from time import time
+from eventloop import Deferred
 
 from util import Stream, PartialPacketException
 from parsing import *
@@ -35,6 +40,22 @@ from parsing import *
 
 logger = logging.getLogger(__name__)
 
+# Default number of seconds a plugin's message handler may take on one
+# message before a warning is logged.
+SLOW_HANDLER_THRESHOLD = 0.05
+
+# Default number of seconds the proxy waits for the verdict of an isolated
+# plugin instance, before forwarding the message unmodified.
+ISOLATION_DEADLINE = 0.1
+
+# Default number of seconds the proxy waits for a verdict a message handler
+# returned as a Deferred.
+ASYNC_TIMEOUT = 1.0
+
+# Most bytes of messages waiting to be delivered to observe-only plugins;
+# messages beyond that are not delivered.
+MAX_TAP_QUEUE_BYTES = 64 * 1024 * 1024
+
 
 ### Exceptions ###
 class ConfigError(Exception):
@@ -57,10 +78,13 @@ class PluginError(Exception):
 class PluginConfig(object):
     """Store plugin configuration"""
     def __init__(self):
+        # Handler calls taking longer than this many seconds are logged.
+        self.slow_handler_threshold = SLOW_HANDLER_THRESHOLD
         self.__ids = []
         self.__plugin_names = {}  # { id -> plugin_name }
         self.__argstrs = {}       # { id -> argstr }
         self.__orderings = {}     # { msgtype -> [id1, id2, ...] }
+        self.__isolated = {}      # { id -> deadline }
 
     def __default_id(self, plugin_name):
         id = plugin_name
@@ -89,6 +113,17 @@ class PluginConfig(object):
         self.__orderings[msgtype] = id_list
         return self
 
+    def isolate(self, id, deadline=ISOLATION_DEADLINE):
+        """Run instance id in a process of its own.
+
+        Messages whose verdict takes longer than deadline seconds are
+        forwarded unmodified.
+        """
+        if not id in self.__ids:
+            raise ConfigError("No such id: '%s'" % id)
+        self.__isolated[id] = deadline
+        return self
+
     @property
     def ids(self):
         """List of instance ids."""
@@ -109,6 +144,11 @@ class PluginConfig(object):
         """Map of ids to argument strings."""
         return dict(self.__argstrs)
 
+    @property
+    def isolated(self):
+        """Map of the ids of isolated instances to their deadlines."""
+        return dict(self.__isolated)
+
     def ordering(self, msgtype):
         """Return a total ordering of instance ids for this msgtype."""
         if not msgtype in self.__orderings:
@@ -121,6 +161,199 @@ class PluginConfig(object):
             return o
 
 
+class InjectionQueue(object):
+    """Thread-safe queue of encoded messages injected by plugins.
+
+    put() may be called from any thread. The first message put after the
+    queue was last drained schedules on_ready() to run from the event loop,
+    waking it if necessary, so that messages are sent even if no traffic
+    arrives from their source.
+    """
+
+    def __init__(self, on_ready=None):
+        self.msgs = collections.deque()
+        self.on_ready = on_ready
+        self.scheduled = False
+        self.closed = False
+
+    def put(self, msgbytes):
+        """Queue msgbytes for injection."""
+        if self.closed:
+            logger.debug('Dropping message injected after session end')
+            return
+        self.msgs.append(msgbytes)
+        if self.on_ready and not self.scheduled:
+            self.scheduled = True
+            eventloop.call_from_thread(self._ready)
+
+    def _ready(self):
+        self.scheduled = False
+        if not self.closed:
+            self.on_ready()
+
+    def drain(self):
+        """Remove all queued messages, and return them joined, or None."""
+        msgs = self.msgs
+        if not msgs:
+            return None
+        batch = []
+        try:
+            while True:
+                batch.append(msgs.popleft())
+        except IndexError:
+            pass
+        return ''.join(batch)
+
+    def close(self):
+        self.closed = True
+
+
+class MessageSnapshot(collections.Mapping):
+    """A read-only view of a forwarded message, as observe-only plugins get it.
+
+    Only msgtype and raw_bytes are at hand; the message is parsed, as a
+    LazyMessage, when another key is first looked up, and each field is
+    decoded when it is first read. time is when the message was forwarded.
+    """
+
+    def __init__(self, raw_bytes, msg_spec, source, time):
+        self.raw_bytes = raw_bytes
+        self.msg_spec = msg_spec
+        self.source = source
+        self.time = time
+        self.msg = None
+
+    def _message(self):
+        if self.msg is None:
+            # proxy imports this module.
+            from proxy import parse_packet
+            stream = Stream()
+            stream.append(self.raw_bytes)
+            self.msg = parse_packet(stream, self.msg_spec, self.source, lazy=True)
+        return self.msg
+
+    def __getitem__(self, key):
+        if key == 'msgtype':
+            return ord(self.raw_bytes[0])
+        elif key == 'raw_bytes':
+            return self.raw_bytes
+        return self._message()[key]
+
+    def __contains__(self, key):
+        return key in ('msgtype', 'raw_bytes') or key in self._message()
+
+    def __iter__(self):
+        return iter(self._message())
+
+    def __len__(self):
+        return len(self._message())
+
+    def __repr__(self):
+        return repr(self._message())
+
+
+class TapThread(threading.Thread):
+    """Delivers forwarded messages to observe-only plugin instances.
+
+    put() queues a message as (instances, source, protocol version, bytes,
+    time forwarded); the thread wraps it in a MessageSnapshot, shared by
+    the instances, and passes each instance the messages queued for it
+    since the last delivery to MC3Plugin.observe() in one batch. A message
+    with bytes None marks the end of a session: the instances are destroyed
+    once the messages before it are delivered.
+
+    Messages that would take the bytes queued beyond MAX_TAP_QUEUE_BYTES
+    are dropped, and counted.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self, name='mc3p-taps')
+        self.daemon = True
+        self.queue = collections.deque()
+        self.ready = threading.Event()
+        # Each counter is only updated by one thread.
+        self.bytes_put = 0   # Total bytes ever queued, by the event loop.
+        self.bytes_taken = 0 # Total bytes ever taken off the queue, by this thread.
+        self.dropped = metrics.registry.counter('tap_dropped_total')
+        metrics.registry.gauge('tap_queue_bytes', self.queued_bytes)
+
+    def queued_bytes(self):
+        return self.bytes_put - self.bytes_taken
+
+    def put(self, item):
+        raw_bytes = item[3]
+        if raw_bytes is not None:
+            if self.queued_bytes() + len(raw_bytes) > MAX_TAP_QUEUE_BYTES:
+                self.dropped.value += 1
+                return
+            self.bytes_put += len(raw_bytes)
+        self.queue.append(item)
+        if not self.ready.is_set():
+            self.ready.set()
+
+    def run(self):
+        queue = self.queue
+        while True:
+            self.ready.wait()
+            self.ready.clear()
+            batch = []
+            size = 0
+            try:
+                while True:
+                    item = queue.popleft()
+                    batch.append(item)
+                    if item[3] is not None:
+                        size += len(item[3])
+            except IndexError:
+                pass
+            self.bytes_taken += size
+            try:
+                self.deliver(batch)
+            except Exception:
+                logger.error('Error delivering messages to observe-only plugins:\n%s' %
+                             traceback.format_exc())
+
+    def deliver(self, batch):
+        msgs = collections.OrderedDict() # { instance -> [(msg, source)] }
+        for (taps, source, proto_version, raw_bytes, t) in batch:
+            if raw_bytes is None:
+                for inst in taps:
+                    self.observe(inst, msgs.pop(inst, None))
+                    try:
+                        inst._destroy()
+                    except:
+                        logger.error("Error cleaning up observe-only plugin %s:\n%s" %
+                                     (inst.__class__.__name__, traceback.format_exc()))
+                continue
+            msg_spec = messages.protocol[proto_version][0 if source == 'client' else 1]
+            msg = MessageSnapshot(raw_bytes, msg_spec, source, t)
+            for inst in taps:
+                msgs.setdefault(inst, []).append((msg, source))
+        for (inst, inst_msgs) in msgs.iteritems():
+            self.observe(inst, inst_msgs)
+
+    def observe(self, inst, msgs):
+        if msgs:
+            try:
+                inst.observe(msgs)
+            except:
+                logger.error('Error in observe() of plugin %s:\n%s' %
+                             (inst.__class__.__name__, traceback.format_exc()))
+
+
+_tap_thread = None
+_tap_thread_lock = threading.Lock()
+
+def tap_thread():
+    """Return the TapThread, starting it if necessary."""
+    global _tap_thread
+    with _tap_thread_lock:
+        if _tap_thread is None:
+            _tap_thread = TapThread()
+            _tap_thread.start()
+    return _tap_thread
+
+
 class PluginManager(object):
     """Manage plugins for an mc3p session."""
     def __init__(self, config, cli_proxy, srv_proxy):
@@ -130,6 +363,9 @@ class PluginManager(object):
         # Map of instance ID to MC3Plugin instance.
         self.__instances = {}
 
+        # Map of instance ID to observe-only MC3Plugin instance.
+        self.__taps = {}
+
         # True when a successful client-server handshake has completed.
         self.__session_active = False
 
@@ -140,25 +376,50 @@ class PluginManager(object):
         # so they can be fed to plugins after initialization.
         self.__msgbuf = []
 
+        # Likewise for the observe-only instances, the messages forwarded
+        # before the handshake completed.
+        self.__observed = []
+
         # For asynchronously injecting messages from the client or server.
-        self.__from_client_q = multiprocessing.Queue()
-        self.__from_server_q = multiprocessing.Queue()
+        self.__from_client_q = InjectionQueue(self.__injected_from_client)
+        self.__from_server_q = InjectionQueue(self.__injected_from_server)
+        self.__cli_proxy = cli_proxy
+        self.__srv_proxy = srv_proxy
 
         # Plugin configuration.
         self.__config = config
 
-    def next_injected_msg_from(self, source):
-        """Return the Queue containing source's messages to be injected."""
+        # Message types handled by some plugin instance, or None for all.
+        self.__msgtypes = None
+
+        # Map of instance ID to histogram of its filter() times.
+        self.__filter_times = {}
+
+        # For each msgtype, a tuple of (handler, filter time histogram) pairs
+        # for the instances that handle it, in order.
+        self.__chains = [()] * 256
+
+        # For each msgtype, a tuple of the observe-only instances that
+        # handle it, in order.
+        self.__tap_chains = [()] * 256
+
+    def injected_from(self, source):
+        """Remove and return the messages injected as if from source, or None.
+
+        The messages are returned joined, and must be sent at a packet boundary.
+        """
         if source == 'client':
-            q = self.__from_client_q
+            return self.__from_client_q.drain()
         elif source == 'server':
-            q = self.__from_server_q
+            return self.__from_server_q.drain()
         else:
             raise Exception('Unrecognized source ' + source)
-        try:
-            return q.get(block=False)
-        except Queue.Empty:
-            return None
+
+    def __injected_from_client(self):
+        self.__cli_proxy.send_injected()
+
+    def __injected_from_server(self):
+        self.__srv_proxy.send_injected()
 
     def _load_plugins(self):
         """Load or reload all plugins."""
@@ -190,6 +451,61 @@ class PluginManager(object):
                 continue
             else:
                 self._instantiate_one(id, pname)
+        self.__msgtypes = self._collect_msgtypes()
+        self.__chains = self._build_chains()
+        self.__tap_chains = self._build_tap_chains()
+
+    def _build_chains(self):
+        """Return the handler chain of each msgtype, indexed by msgtype.
+
+        Only instances with a handler for a msgtype, or a default_handler,
+        are part of its chain, so most chains are empty.
+        """
+        chains = []
+        for msgtype in xrange(256):
+            chain = []
+            for id in self.__config.ordering(msgtype):
+                inst = self.__instances.get(id)
+                if inst is None:
+                    continue
+                handler = inst._handler_for(msgtype)
+                if handler is not None:
+                    chain.append((handler, self.__filter_times[id]))
+            chains.append(tuple(chain))
+        return chains
+
+    def _build_tap_chains(self):
+        """Return the observe-only instances handling each msgtype, indexed by msgtype."""
+        chains = []
+        for msgtype in xrange(256):
+            chains.append(tuple([self.__taps[id] for id in self.__config.ordering(msgtype)
+                                 if id in self.__taps and
+                                    self.__taps[id]._handler_for(msgtype) is not None]))
+        return chains
+
+    def _collect_msgtypes(self):
+        """Return the msgtypes handled by any instance, or None for all."""
+        msgtypes = set()
+        for inst in self.__instances.values():
+            inst_msgtypes = inst._msgtypes()
+            if inst_msgtypes is None:
+                return None
+            msgtypes.update(inst_msgtypes)
+        return msgtypes
+
+    @property
+    def decoded_msgtypes(self):
+        """Set of msgtypes that must be decoded for filtering, or None for all.
+
+        Until the handshake completes, all messages are decoded, since they
+        are replayed to the plugins once they are instantiated. Afterwards,
+        a message type that no plugin instance handles need not be decoded
+        or filtered at all. Observe-only instances decode messages on their
+        own thread.
+        """
+        if self.__session_active:
+            return self.__msgtypes
+        return None
 
     def _find_plugin_class(self, pname):
         """Return the subclass of MC3Plugin in pmod."""
@@ -215,11 +531,27 @@ class PluginManager(object):
             return
         try:
             logger.debug("  Instantiating plugin '%s' as '%s'" % (pname, id))
-            inst = clazz(self.__proto_version,
-                         self.__from_client_q,
-                         self.__from_server_q)
-            inst.init(self.__config.argstr[id])
+            isolated = self.__config.isolated
+            if id in isolated:
+                inst = isolation.IsolatedPlugin(id, clazz, clazz._handled_msgtypes(),
+                                                self.__config.argstr[id],
+                                                self.__proto_version,
+                                                self.__from_client_q,
+                                                self.__from_server_q,
+                                                isolated[id],
+                                                self.__config.slow_handler_threshold)
+            else:
+                inst = clazz(self.__proto_version,
+                             self.__from_client_q,
+                             self.__from_server_q)
+                inst._set_id(id, self.__config.slow_handler_threshold)
+                inst.init(self.__config.argstr[id])
+                if clazz.observe_only:
+                    self.__taps[id] = inst
+                    return
             self.__instances[id] = inst
+            self.__filter_times[id] = \
+                metrics.registry.histogram('plugin_filter_seconds', plugin=id)
         except Exception as e:
             logger.error("Failed to instantiate '%s': %s" % (id, str(e)))
 
@@ -238,11 +570,18 @@ class PluginManager(object):
                                  (iname, self.__config.plugin[iname]))
                     logger.error(traceback.format_exc())
             self.__instances = {}
+            if self.__taps:
+                # Destroyed by the tap thread, once it delivered their messages.
+                tap_thread().put((tuple(self.__taps.values()), None, None, None, None))
+                self.__taps = {}
+        self.__from_client_q.close()
+        self.__from_server_q.close()
 
     def filter(self, msg, source):
         """Filter msg through the configured plugins.
 
-        Returns True if msg should be forwarded, False otherwise.
+        Returns True if msg should be forwarded, False otherwise, or a
+        Deferred for that verdict if a handler returned one.
         """
         if self.__session_active:
             if self.__msgbuf:
@@ -267,11 +606,46 @@ class PluginManager(object):
             self.__msgbuf.append((msg, source))
             return True
 
-    def _call_plugins(self, msg, source):
-        msgtype = msg['msgtype']
-        for id in self.__config.ordering(msgtype):
-            inst = self.__instances.get(id, None)
-            if inst and not inst.filter(msg, source):
+    def observe(self, msg, source):
+        """Pass msg, which was forwarded, on to the observe-only instances.
+
+        The messages are delivered on the tap thread, so msg['raw_bytes'] must
+        hold its final bytes. Messages forwarded before the handshake
+        completed are passed on once it has.
+        """
+        if self.__observed is not None:
+            if not self.__session_active:
+                self.__observed.append((msg, source))
+                return
+            observed, self.__observed = self.__observed, None
+            for (_msg, _source) in observed:
+                self.observe(_msg, _source)
+        taps = self.__tap_chains[msg['msgtype']]
+        if taps:
+            raw_bytes = msg.get('raw_bytes')
+            if raw_bytes is None:
+                cli_msgs, srv_msgs = messages.protocol[self.__proto_version]
+                msg_spec = cli_msgs if source == 'client' else srv_msgs
+                raw_bytes = msg_spec[msg['msgtype']].emit(msg)
+            tap_thread().put((taps, source, self.__proto_version, raw_bytes, time()))
+
+    def _call_plugins(self, msg, source, start=0):
+        """Pass msg through its chain of handlers, from index start on.
+
+        If a handler returns a Deferred, the rest of the chain is called
+        once its verdict is in, and a Deferred for the final verdict is
+        returned. The time recorded for such a handler covers only the call.
+        """
+        chain = self.__chains[msg['msgtype']]
+        for i in xrange(start, len(chain)):
+            (handler, filter_times) = chain[i]
+            t = time()
+            forward = handler(msg, source)
+            filter_times.observe(time() - t)
+            if isinstance(forward, Deferred):
+                return forward.then(lambda forward:
+                    forward and self._call_plugins(msg, source, i + 1))
+            if not forward:
                 return False
         return True
 
@@ -301,12 +675,50 @@ def msghdlr(*msgtypes):
 class MC3Plugin(object):
     """Base class for mc3p plugins."""
 
+    # Set to True in plugins that never drop or modify messages. Their
+    # instances get read-only snapshots of the forwarded messages, in
+    # batches, from a thread of their own, so they do not delay forwarding.
+    observe_only = False
+
+    # A message handler may return a Deferred for its verdict, for example
+    # one from defer_to_thread(), instead of the verdict itself. Only the
+    # later messages of the session, from the same source, wait for it; for
+    # at most async_timeout seconds, after which async_default is used.
+    async_timeout = ASYNC_TIMEOUT
+    async_default = True
+
     def __init__(self, proto_version, from_client, from_server):
         self.__proto_version = proto_version
         self.__to_client = from_server
         self.__to_server = from_client
         self.__hdlrs = {}
         self._collect_msg_hdlrs()
+        self.__id = self.__class__.__name__
+        self.__slow_threshold = SLOW_HANDLER_THRESHOLD
+        self.__default_overridden = \
+            self.default_handler.im_func is not MC3Plugin.default_handler.im_func
+        # Map of msgtype to the result of _handler_for(msgtype).
+        self.__dispatch = {}
+
+    def _set_id(self, id, slow_threshold=SLOW_HANDLER_THRESHOLD):
+        """Set the instance id that handler times are reported under.
+
+        Handler calls longer than slow_threshold seconds are logged.
+        """
+        self.__id = id
+        self.__slow_threshold = slow_threshold
+        self.__dispatch = {}
+
+    def __timed(self, hist, name, msg, start):
+        """Record the time of a call to handler name on msg, begun at start."""
+        elapsed = time() - start
+        hist.observe(elapsed)
+        if elapsed > self.__slow_threshold:
+            raw_bytes = msg.get('raw_bytes')
+            size = '%d byte' % len(raw_bytes) if raw_bytes is not None else 'unknown size'
+            logger.warn("Slow handler: plugin '%s' spent %.1fms in %s on a %s "
+                        "message of type 0x%02x" % (self.__id, 1000 * elapsed, name,
+                                                    size, msg['msgtype']))
 
     def _collect_msg_hdlrs(self):
         wrappers = filter(lambda x: isinstance(x, MsgHandlerWrapper),
@@ -367,6 +779,30 @@ class MC3Plugin(object):
             return None
         return msgbytes
 
+    def defer_to_thread(self, func, *args):
+        """Call func(*args) on a pool thread, and return a Deferred for the result.
+
+        Lets a message handler do blocking I/O without holding up the proxy.
+        If func raises an exception, the result is async_default.
+        """
+        return eventloop.defer_to_thread(func, args, self.async_default)
+
+    def __async_verdict(self, d, name, msgtype):
+        """Apply the timeout to d, a verdict returned by handler name."""
+        start = time()
+        def on_verdict(forward):
+            metrics.registry.histogram('plugin_async_seconds', plugin=self.__id, handler=name,
+                                       msgtype='0x%02x' % msgtype).observe(time() - start)
+            if d.timed_out:
+                metrics.registry.counter('plugin_async_timeouts_total',
+                                         plugin=self.__id).value += 1
+                logger.warn("Plugin '%s' took more than %.1fs to decide on a message "
+                            "of type 0x%02x in %s" % (self.__id, self.async_timeout,
+                                                      msgtype, name))
+        d.add_callback(on_verdict)
+        d.set_timeout(self.async_timeout, self.async_default)
+        return d
+
     def to_server(self, msg):
         """Send msg to the server asynchronously."""
         msgbytes = self.__encode_msg('client', msg)
@@ -379,35 +815,108 @@ class MC3Plugin(object):
         if msgbytes:
             self.__to_client.put(msgbytes)
 
+    def _msgtypes(self):
+        """Return the msgtypes this plugin handles, or None for all types."""
+        if self.__default_overridden:
+            return None
+        return set(self.__hdlrs)
+
+    @classmethod
+    def _handled_msgtypes(cls):
+        """Like _msgtypes(), without instantiating the class."""
+        if cls.default_handler.im_func is not MC3Plugin.default_handler.im_func:
+            return None
+        msgtypes = set()
+        for wrapper in cls.__dict__.values():
+            if isinstance(wrapper, MsgHandlerWrapper):
+                msgtypes.update(wrapper.msgtypes)
+        return msgtypes
+
     def default_handler(self, msg, source):
         """Default message handler for all message types.
 
         Override in subclass to filter all message types."""
         return True
 
+    def observe(self, msgs):
+        """Observe a batch of forwarded messages, as (msg, source) pairs.
+
+        Called for observe-only plugins, from the tap thread. By default
+        each message is passed to filter(), and the verdict ignored.
+        """
+        for (msg, source) in msgs:
+            self.filter(msg, source)
+
     def filter(self, msg, source):
         """Filter msg via the appropriate message handler(s).
 
-        Returns True to forward msg on, False to drop it.
-        Modifications to msg are passed on to the recipient.
+        Returns True to forward msg on, False to drop it, or a Deferred
+        for that verdict. Modifications to msg are passed on to the recipient.
         """
-        msgtype = msg['msgtype']
-        try:
-            if not self.default_handler(msg, source):
-                return False
-        except:
-            logger.error('Error in default handler of plugin %s:\n%s' % \
-                         (self.__class__.__name__, traceback.format_exc()))
+        handler = self._handler_for(msg['msgtype'])
+        if handler is None:
             return True
+        return handler(msg, source)
 
-        try:
-            if msgtype in self.__hdlrs:
-                return self.__hdlrs[msgtype](self, msg, source)
-            else:
+    def _handler_for(self, msgtype):
+        """Return a function filtering messages of msgtype, like filter().
+
+        Returns None if the plugin has neither a handler for msgtype nor a
+        default_handler. The time spent in each handler is recorded in the
+        metrics registry. A handler's Deferred verdict is given the plugin's
+        timeout, and the default_handler's is followed by the msghdlr's.
+        """
+        if msgtype in self.__dispatch:
+            return self.__dispatch[msgtype]
+        default = self.default_handler if self.__default_overridden else None
+        hdlr = self.__hdlrs.get(msgtype)
+        if default is None and hdlr is None:
+            self.__dispatch[msgtype] = None
+            return None
+        def times(name):
+            return metrics.registry.histogram('plugin_handler_seconds', plugin=self.__id,
+                                              handler=name, msgtype='0x%02x' % msgtype)
+        if default is not None:
+            default_times = times('default_handler')
+        if hdlr is not None:
+            hdlr_times = times(hdlr.__name__)
+
+        def call_hdlr(msg, source):
+            start = time()
+            try:
+                forward = hdlr(self, msg, source)
+            except:
+                logger.error('Error in handler %s of plugin %s: %s' % \
+                             (hdlr.__name__, self.__class__.__name__,
+                              traceback.format_exc()))
                 return True
-        except:
-            hdlr = self.__hdlrs[msgtype]
-            logger.error('Error in handler %s of plugin %s: %s' % \
-                         (hdlr.__name__, self.__class__.__name__,
-                          traceback.format_exc()))
-            return True
+            finally:
+                self.__timed(hdlr_times, hdlr.__name__, msg, start)
+            if isinstance(forward, Deferred):
+                return self.__async_verdict(forward, hdlr.__name__, msgtype)
+            return forward
+
+        def handler(msg, source):
+            if default is not None:
+                start = time()
+                try:
+                    forward = default(msg, source)
+                except:
+                    logger.error('Error in default handler of plugin %s:\n%s' % \
+                                 (self.__class__.__name__, traceback.format_exc()))
+                    return True
+                finally:
+                    self.__timed(default_times, 'default_handler', msg, start)
+                if isinstance(forward, Deferred):
+                    forward = self.__async_verdict(forward, 'default_handler', msgtype)
+                    if hdlr is None:
+                        return forward
+                    return forward.then(lambda forward:
+                                        forward and call_hdlr(msg, source))
+                if not forward:
+                    return False
+            if hdlr is None:
+                return True
+            return call_hdlr(msg, source)
+        self.__dispatch[msgtype] = handler
+        return handler
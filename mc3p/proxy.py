@@ -17,14 +17,17 @@
 
 import logging, logging.config, os
 import asyncore, socket, sys, signal, struct, logging.config, re, os.path, inspect, imp
-import traceback, tempfile
+import traceback, tempfile, errno, collections
 from time import time, sleep
+from bisect import bisect_right
 from optparse import OptionParser
 
-import messages
-from plugins import PluginConfig, PluginManager
-from parsing import parse_unsigned_byte, parse_int
-from util import Stream, PartialPacketException
+import messages, eventloop, codegen, metrics
+from plugins import PluginConfig, PluginManager, ConfigError
+from plugins import SLOW_HANDLER_THRESHOLD, ISOLATION_DEADLINE
+from eventloop import Deferred
+from parsing import parse_unsigned_byte, parse_int, patch_fields
+from util import Stream, Reader, PartialPacketException, monotonic
 import util
 
 logger = logging.getLogger("mc3p")
@@ -38,8 +41,8 @@ def parse_args():
     """Return host and port, or print usage and exit."""
     usage = "usage: %prog [options] host [port]"
     desc = """
-Create a Minecraft proxy listening for a client connection,
-and forward that connection to <host>:<port>."""
+Create a Minecraft proxy listening for client connections,
+and forward each connection to <host>:<port>."""
     parser = OptionParser(usage=usage,
                           description=desc)
     parser.add_option("-l", "--log-level", dest="loglvl", metavar="LEVEL",
@@ -49,14 +52,58 @@ and forward that connection to <host>:<port>."""
                       help="logging configuration file (optional)")
     parser.add_option("-p", "--local-port", dest="locport", metavar="PORT", default="34343",
                       type="int", help="Listen on this port")
+    parser.add_option("--max-sessions", dest="max_sessions", metavar="N", default=0,
+                      type="int", help="Serve at most N clients at once (0 for no limit)")
+    parser.add_option("--connect-timeout", dest="connect_timeout", metavar="SECS",
+                      default=10.0, type="float",
+                      help="Give up connecting to the server after SECS seconds")
+    parser.add_option("--max-recv-size", dest="max_recv_size", metavar="BYTES",
+                      default=MAX_RECV_SIZE, type="int",
+                      help="Read at most BYTES from a socket at once (default: %d)"
+                           % MAX_RECV_SIZE)
+    parser.add_option("--workers", dest="workers", metavar="N", default=1,
+                      type="int", help="Serve clients from N worker processes")
+    parser.add_option("--engine", dest="engine", metavar="ENGINE",
+                      choices=eventloop.ENGINES, default=eventloop.DEFAULT_ENGINE,
+                      help="I/O engine, one of %s (default: %s)" %
+                           (', '.join(eventloop.ENGINES), eventloop.DEFAULT_ENGINE))
+    parser.add_option("--codegen", dest="codegen", action="store_true", default=False,
+                      help="Frame, decode and emit messages with generated code")
+    parser.add_option("--codegen-cache", dest="codegen_cache", metavar="DIR",
+                      default=os.path.join(os.path.expanduser('~'), '.mc3p', 'codegen'),
+                      help="Cache generated code in DIR ('' to disable)")
+    parser.add_option("--metrics-port", dest="metrics_port", metavar="PORT",
+                      default=0, type="int",
+                      help="Serve metrics over HTTP on PORT; with --workers, "
+                           "worker i serves them on PORT+i")
+    parser.add_option("--metrics-host", dest="metrics_host", metavar="HOST",
+                      default="127.0.0.1",
+                      help="Address to serve metrics on (default: 127.0.0.1)")
     parser.add_option("--plugin", dest="plugins", metavar="ID:PLUGIN(ARGS)", type="string",
                       action="append", help="Configure a plugin", default=[])
+    parser.add_option("--isolate", dest="isolate", metavar="ID[:MS]", type="string",
+                      action="append", default=[],
+                      help="Run plugin instance ID in a process of its own, forwarding "
+                           "messages unmodified if its verdict takes more than MS "
+                           "milliseconds (default: %d)" % (1000 * ISOLATION_DEADLINE))
+    parser.add_option("--slow-handler-ms", dest="slow_handler_ms", metavar="MS",
+                      default=1000 * SLOW_HANDLER_THRESHOLD, type="float",
+                      help="Log plugin handler calls taking longer than MS "
+                           "milliseconds (default: %default)")
     parser.add_option("--profile", dest="perf_data", metavar="FILE", default=None,
                       help="Enable profiling, save profiling data to FILE")
     (opts,args) = parser.parse_args()
 
     if not 1 <= len(args) <= 2:
         parser.error("Incorrect number of arguments.") # Calls sys.exit()
+    if opts.workers < 1:
+        parser.error("Invalid number of workers %d" % opts.workers)
+    if opts.max_recv_size < MIN_RECV_SIZE:
+        parser.error("--max-recv-size must be at least %d" % MIN_RECV_SIZE)
+    if opts.workers > 1 and not hasattr(os, 'fork'):
+        parser.error("--workers is not supported on this platform")
+    if opts.isolate and not hasattr(os, 'fork'):
+        parser.error("--isolate is not supported on this platform")
 
     host = args[0]
     port = 25565
@@ -67,6 +114,7 @@ and forward that connection to <host>:<port>."""
             parser.error("Invalid port %s" % args[1])
 
     pcfg = PluginConfig()
+    pcfg.slow_handler_threshold = opts.slow_handler_ms / 1000.0
     pregex = re.compile('((?P<id>\\w+):)?(?P<plugin_name>[\\w\\.\\d_]+)(\\((?P<argstr>.*)\\))?$')
     for pstr in opts.plugins:
         m = pregex.match(pstr)
@@ -77,78 +125,377 @@ and forward that connection to <host>:<port>."""
             parts = {'argstr': ''}
             parts.update(m.groupdict())
             pcfg.add(**parts)
+    for istr in opts.isolate:
+        (id, sep, ms) = istr.partition(':')
+        try:
+            pcfg.isolate(id, float(ms) / 1000 if sep else ISOLATION_DEADLINE)
+        except (ConfigError, ValueError) as e:
+            parser.error("Invalid --isolate option %s: %s" % (istr, e))
 
     return (host, port, opts, pcfg)
 
 
-def wait_for_client(port):
-    """Listen on port for client connection, return resulting socket."""
+def listen_socket(port):
+    """Return a socket listening for client connections on port."""
     srvsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     srvsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     srvsock.bind( ("", port) )
-    srvsock.listen(1)
+    srvsock.listen(socket.SOMAXCONN)
     logger.info("mitm_listener bound to %d" % port)
-    (sock, addr) = srvsock.accept()
-    srvsock.close()
-    logger.info("mitm_listener accepted connection from %s" % repr(addr))
-    return sock
+    return srvsock
+
+
+# Seconds between reports of the latency the proxy adds to packets.
+LATENCY_REPORT_INTERVAL = 60.0
+
+class MinecraftListener(eventloop.Dispatcher):
+    """Accept client connections, and create a MinecraftSession for each."""
+
+    def __init__(self, srvsock, pcfg, dsthost, dstport, max_sessions=0,
+                 connect_timeout=10.0, max_recv_size=None):
+        """Accept clients on srvsock, and forward them to dsthost:dstport.
+
+        srvsock is a listening socket, as returned by listen_socket(). It may
+        be shared with MinecraftListeners in other processes.
+
+        At most max_sessions client sessions are served at once; connections
+        in excess of that limit are closed immediately. A max_sessions of 0
+        places no limit on the number of sessions.
+
+        dsthost is resolved once, here, so that accepting a client never
+        blocks the event loop on a DNS lookup.
+
+        connect_timeout and max_recv_size are passed on to each session.
+        """
+        eventloop.Dispatcher.__init__(self)
+        self.pcfg = pcfg
+        self.dsthost = socket.gethostbyname(dsthost)
+        self.dstport = dstport
+        self.max_sessions = max_sessions
+        self.connect_timeout = connect_timeout
+        self.max_recv_size = max_recv_size
+        self.sessions = set()
+        metrics.registry.gauge('sessions', lambda: len(self.sessions))
+        for side in ('client', 'server'):
+            metrics.registry.gauge('output_buffer_bytes',
+                                   lambda side=side: self.output_buffer_bytes(side),
+                                   side=side)
+        self.reported_packets = {} # { side -> packets counted at last report }
+        eventloop.call_later(LATENCY_REPORT_INTERVAL, self.report_latency)
+        srvsock.setblocking(0)
+        self.set_socket(srvsock)
+        self.accepting = True
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        (sock, addr) = pair
+        if self.max_sessions and len(self.sessions) >= self.max_sessions:
+            logger.warn("mitm_listener refused connection from %s, " % repr(addr) +
+                        "%d sessions active" % len(self.sessions))
+            sock.close()
+            return
+        logger.info("mitm_listener accepted connection from %s" % repr(addr))
+        session = MinecraftSession(self.pcfg, sock, self.dsthost, self.dstport,
+                                   self.session_closed, self.connect_timeout,
+                                   self.max_recv_size)
+        if not session.closed:
+            self.sessions.add(session)
+
+    def report_latency(self):
+        """Log the latency added to packets from each side, if any were sent."""
+        eventloop.call_later(LATENCY_REPORT_INTERVAL, self.report_latency)
+        for side in ('client', 'server'):
+            latency = metrics.registry.merged(side, 'latency')
+            if latency.count == self.reported_packets.get(side, 0):
+                continue
+            self.reported_packets[side] = latency.count
+            plugin_time = metrics.registry.merged(side, 'plugin_time')
+            logger.info("%s packets: latency p50 %.3fms, p99 %.3fms, max %.3fms; "
+                        "plugin time p50 %.3fms, p99 %.3fms, max %.3fms" %
+                        ((side, ) + tuple([1000 * value for value in
+                         (latency.quantile(0.5), latency.quantile(0.99), latency.max,
+                          plugin_time.quantile(0.5), plugin_time.quantile(0.99),
+                          plugin_time.max)])))
+
+    def output_buffer_bytes(self, side):
+        """Return the bytes queued for sending to side, across all sessions."""
+        if side == 'client':
+            return sum([s.cli_proxy.out_bytes for s in self.sessions])
+        return sum([s.srv_proxy.out_bytes for s in self.sessions])
+
+    def session_closed(self, session):
+        """Called by a MinecraftSession once both of its sides have closed."""
+        self.sessions.discard(session)
+        logger.info("%d sessions active" % len(self.sessions))
 
 
 class MinecraftSession(object):
     """A client-server Minecraft session."""
 
-    def __init__(self, pcfg, clientsock, dsthost, dstport):
-        """Open connection to dsthost:dstport, and return client and server proxies."""
+    def __init__(self, pcfg, clientsock, dsthost, dstport, on_close=None,
+                 connect_timeout=10.0, max_recv_size=None):
+        """Start connecting to dsthost:dstport, and create client and server proxies.
+
+        The connection to the server is made asynchronously; until it is
+        established, messages from the client are buffered by the server
+        proxy. If the server cannot be reached within connect_timeout seconds,
+        the session is closed.
+
+        on_close, if given, is called with the session as its argument
+        when the session ends. max_recv_size is passed on to both proxies.
+        """
         logger.info("creating proxy from client to %s:%d" % (dsthost,dstport))
-        self.srv_proxy = None
-        try:
-            serversock = socket.create_connection( (dsthost,dstport) )
-            self.cli_proxy = MinecraftProxy(clientsock)
-        except Exception as e:
-            clientsock.close()
-            logger.error("Couldn't connect to %s:%d - %s", dsthost, dstport, str(e))
-            logger.info(traceback.format_exc())
-            return
-        self.srv_proxy = MinecraftProxy(serversock, self.cli_proxy)
+        self.dsthost = dsthost
+        self.dstport = dstport
+        self.on_close = on_close
+        self.closed = False
+        self.srv_connected = False
+        self.cli_proxy = MinecraftProxy(clientsock, max_recv_size=max_recv_size)
+        self.srv_proxy = MinecraftProxy(None, self.cli_proxy, max_recv_size)
         self.plugin_mgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
         self.cli_proxy.plugin_mgr = self.plugin_mgr
         self.srv_proxy.plugin_mgr = self.plugin_mgr
+        self.cli_proxy.session = self
+        self.srv_proxy.session = self
+        self.connect_timer = eventloop.call_later(connect_timeout,
+                                                  self.connect_timed_out)
+        try:
+            self.srv_proxy.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.srv_proxy.connect( (dsthost,dstport) )
+        except Exception as e:
+            self.connect_failed(str(e))
+
+    def server_connected(self):
+        """Called by the server proxy once its connection is established."""
+        self.srv_connected = True
+        self.connect_timer.cancel()
+        logger.info("connected to %s:%d" % (self.dsthost, self.dstport))
+
+    def connect_failed(self, reason):
+        logger.error("Couldn't connect to %s:%d - %s",
+                     self.dsthost, self.dstport, reason)
+        self.close()
+
+    def connect_timed_out(self):
+        if not self.srv_connected:
+            self.connect_failed("timed out")
+
+    def close(self):
+        """Close both sides of the session, and destroy its plugins."""
+        if self.closed:
+            return
+        self.closed = True
+        self.connect_timer.cancel()
+        for proxy in (self.cli_proxy, self.srv_proxy):
+            proxy.other_side = None
+            if proxy.socket is not None:
+                proxy.close()
+        logger.info("shutting down plugin manager")
+        self.plugin_mgr.destroy()
+        if self.on_close:
+            self.on_close(self)
+
+def serve(srvsock, pcfg, host, port, opts, metrics_sock=None):
+    """Serve clients connecting to srvsock until interrupted.
+
+    If metrics_sock is given, metrics are served to connections on it.
+    """
+    MinecraftListener(srvsock, pcfg, host, port, opts.max_sessions,
+                      opts.connect_timeout, opts.max_recv_size)
+    if metrics_sock is not None:
+        metrics.MetricsListener(metrics_sock)
+
+    # I/O event loop.
+    if opts.perf_data:
+        perf_data = opts.perf_data
+        if opts.workers > 1:
+            perf_data = '%s.%d' % (perf_data, os.getpid())
+        logger.warn("Profiling enabled, saving data to %s" % perf_data)
+        import cProfile
+        cProfile.runctx('eventloop.run(engine=opts.engine)',
+                        globals(), locals(), perf_data)
+    else:
+        eventloop.run(engine=opts.engine)
+
+
+# A worker that exits sooner than this after starting is restarted only
+# after a delay, so that a worker that fails at start-up cannot fork-bomb.
+MIN_WORKER_LIFETIME = 1.0
+
+def exit_reason(status):
+    """Describe how a process ended, from its os.waitpid() status."""
+    if os.WIFEXITED(status):
+        return "exited with code %d" % os.WEXITSTATUS(status)
+    elif os.WIFSIGNALED(status):
+        return "was killed by signal %d" % os.WTERMSIG(status)
+    return "ended with status %d" % status
+
+def run_workers(nworkers, srvsock, pcfg, host, port, opts, metrics_socks=None):
+    """Serve clients from nworkers processes sharing srvsock.
+
+    This process accepts no connections itself; it forks the workers,
+    and replaces any worker that exits until it is itself terminated.
+    If metrics_socks is given, worker i serves its metrics on metrics_socks[i].
+    """
+    workers = {} # { pid -> (start time, worker number) }
+
+    def start_worker(i):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                serve(srvsock, pcfg, host, port, opts,
+                      metrics_socks[i] if metrics_socks else None)
+            except SystemExit as e:
+                status = e.code or 0
+            except BaseException:
+                logger.error("Worker %d failed:\n%s" %
+                             (os.getpid(), traceback.format_exc()))
+                status = 1
+            finally:
+                logging.shutdown()
+                os._exit(status)
+        logger.info("Started worker %d" % pid)
+        workers[pid] = (time(), i)
+
+    signal.signal(signal.SIGTERM, sigint_handler)
+    try:
+        for i in range(nworkers):
+            start_worker(i)
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            if pid not in workers:
+                continue
+            (start, i) = workers.pop(pid)
+            lifetime = time() - start
+            logger.error("Worker %d %s, restarting" % (pid, exit_reason(status)))
+            if lifetime < MIN_WORKER_LIFETIME:
+                sleep(MIN_WORKER_LIFETIME - lifetime)
+            start_worker(i)
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+# Number of consecutive packets that must be framed from a candidate packet
+# boundary before a proxy that is out of sync accepts it.
+RESYNC_PACKETS = 4
+# Candidate boundaries are rejected if framing RESYNC_PACKETS packets from
+# them would take more than RESYNC_WINDOW bytes, or if the data needed to
+# frame them has not arrived within RESYNC_TIMEOUT seconds.
+RESYNC_WINDOW = 64 * 1024
+RESYNC_TIMEOUT = 1.0
 
 class UnsupportedPacketException(Exception):
     def __init__(self,pid):
         Exception.__init__(self,"Unsupported packet id 0x%x" % pid)
 
-class MinecraftProxy(asyncore.dispatcher_with_send):
+# Bounds on the number of bytes read from a socket at once. Each proxy
+# starts reading MIN_RECV_SIZE bytes at a time, doubles its read size
+# while reads fill it, and halves it again when reads come back mostly empty.
+MIN_RECV_SIZE = 4096
+MAX_RECV_SIZE = 256 * 1024
+
+# When more than HIGH_WATERMARK bytes are queued for sending to one side,
+# stop reading from the other side until the queue drains to LOW_WATERMARK.
+HIGH_WATERMARK = 1024 * 1024
+LOW_WATERMARK = 256 * 1024
+
+class MinecraftProxy(eventloop.Dispatcher):
     """Proxies a packet stream from a Minecraft client or server.
+
+    Output is held in a queue of memoryviews, so that partial sends never
+    copy the data that remains. When a side's output queue grows beyond
+    HIGH_WATERMARK bytes, the proxy stops reading from the other side,
+    bounding the memory a session uses when a peer is slow to read. Changes
+    to readable() and writable() made outside of the proxy's own event
+    handlers are reported with eventloop.interest_changed().
+
+    A packet whose verdict is a Deferred is held back until the verdict is
+    in, and so are the packets read after it, to keep them in order. Reads
+    pause while more than HIGH_WATERMARK bytes are held.
     """
 
-    def __init__(self, src_sock, other_side=None):
+    def __init__(self, src_sock, other_side=None, max_recv_size=None):
         """Proxies one side of a client-server connection.
 
         MinecraftProxy instances are created in pairs that have references to
         one another. Since a client initiates a connection, the client side of
         the pair is always created first, with other_side = None. The creator
-        of the client proxy is then responsible for connecting to the server
-        and creating a server proxy with other_side=client. Finally, the
-        proxy creator should do client_proxy.other_side = server_proxy.
+        of the client proxy then creates a server proxy with other_side=client,
+        which sets client_proxy.other_side = server_proxy. The server proxy may
+        be created with src_sock=None, and connected later with
+        create_socket() and connect().
+
+        max_recv_size bounds the size of reads, and defaults to MAX_RECV_SIZE.
         """
-        asyncore.dispatcher_with_send.__init__(self, src_sock)
+        eventloop.Dispatcher.__init__(self, src_sock)
+        self.out_queue = collections.deque()
+        self.out_bytes = 0           # Total bytes in out_queue.
+        self.reading_paused = False  # True while the other side's queue is full.
+        self.bytes_queued = 0        # Total bytes ever passed to send().
+        self.bytes_sent = 0          # Total bytes ever sent to the socket.
+        # Packets in out_queue whose latency is yet to be recorded, in batches
+        # of (bytes_queued before the batch, receive time, [end offset in
+        # batch], [MsgTypeStats]); latency_index is the first packet of the
+        # first batch still waiting to be sent.
+        self.latency_queue = collections.deque()
+        self.latency_index = 0
+        # Packets held back for a pending verdict, as (packet, MsgTypeStats,
+        # verdict, receive time), in order; data that is not filtered is
+        # held as (bytes, None, True, receive time).
+        self.held = collections.deque()
+        self.held_bytes = 0
         self.plugin_mgr = None
+        self.session = None
         self.other_side = other_side
         if other_side == None:
             self.side = 'client'
-            self.msg_spec = messages.protocol[0][0]
         else:
             self.side = 'server'
-            self.msg_spec = messages.protocol[0][1]
             self.other_side.other_side = self
+        self.set_protocol(0)
         self.stream = Stream()
+        self.recv_size = MIN_RECV_SIZE
+        self.max_recv_size = max_recv_size or MAX_RECV_SIZE
+        self.reads = 0      # Number of reads that returned data.
+        self.bytes_read = 0
+        self.packets = 0    # Number of packets parsed.
+        self.resync_attempts = 0 # Number of times the stream got out of sync.
+        self.resyncs = 0         # Number of times it was resynchronized.
+        self.resync_from = 0     # Offset at which to resume looking for a boundary.
+        self.resync_bytes = 0    # Bytes skipped so far while out of sync.
+        self.resync_wait = None  # When bytes were first held back for a candidate.
+        self.resync_timer = None # Decides the pending candidates at the timeout.
         self.last_report = 0
         self.msg_queue = []
         self.out_of_sync = False
 
+    def set_protocol(self, proto_version):
+        """Use the message definitions and statistics of proto_version."""
+        i = 0 if self.side == 'client' else 1
+        self.msg_spec = messages.protocol[proto_version][i]
+        self.packet_sizes = messages.fixed_sizes[proto_version][i]
+        self.msg_stats = metrics.registry.msgtype_table(proto_version, self.side)
+
     def handle_read(self):
         """Read all available bytes, and process as many packets as possible.
+
+        The packets forwarded or injected during one call are collected, and
+        passed on to the other side in a single send(), along with the time
+        of the read, against which their latency is measured. A packet split
+        across reads is timed from the read that completed it.
         """
         t = time()
         if self.last_report + 5 < t and self.stream.tot_bytes > 0:
@@ -156,83 +503,607 @@ class MinecraftProxy(asyncore.dispatcher_with_send):
             logger.debug("%s: total/wasted bytes is %d/%d (%f wasted)" % (
                  self.side, self.stream.tot_bytes, self.stream.wasted_bytes,
                  100 * float(self.stream.wasted_bytes) / self.stream.tot_bytes))
-        self.stream.append(self.recv(4092))
+            logger.debug("%s: %d reads, %.0f bytes/read, %.2f reads/packet, "
+                         "read size %d" % (self.side, self.reads,
+                         float(self.bytes_read) / max(1, self.reads),
+                         float(self.reads) / max(1, self.packets), self.recv_size))
+            if self.resync_attempts:
+                logger.debug("%s: out of sync %d times, resynchronized %d times" %
+                             (self.side, self.resync_attempts, self.resyncs))
+        n = self.recv_into_stream(self.recv_size)
+        if n == 0:
+            return
+        received = monotonic()
+        self.reads += 1
+        self.bytes_read += n
+        self.adapt_recv_size(n)
+        self.process_stream(received)
 
-        if self.out_of_sync:
-            data = self.stream.read(len(self.stream))
-            self.stream.packet_finished()
-            if self.other_side:
-                self.other_side.send(data)
+    def process_stream(self, received):
+        """Process as many packets as possible from the stream, and send them on.
+
+        received is the time the data was read.
+        """
+        out = []
+        ends = []  # Offset of the end of each forwarded packet in out.
+        stats = [] # MsgTypeStats of each forwarded packet.
+        while True:
+            if self.out_of_sync:
+                data = self.resync()
+                if self.held:
+                    if data:
+                        self.hold(data, None, True, received)
+                else:
+                    out.append(data)
+                if self.out_of_sync:
+                    break
+            try:
+                self.process_packets(out, ends, stats, received)
+                break # The session was closed.
+            except PartialPacketException:
+                break # Not all data for the current packet is available.
+            except Exception:
+                logger.error("MinecraftProxy for %s caught exception, out of sync" % self.side)
+                logger.error(traceback.format_exc())
+                logger.debug("Current stream buffer: %s" % repr(self.stream.peek()))
+                self.out_of_sync = True
+                self.resync_attempts += 1
+                metrics.registry.counter('out_of_sync_total', side=self.side).value += 1
+                self.resync_from = 1
+                self.stream.reset()
+        if out and self.other_side:
+            self.other_side.send(''.join(out), received, ends, stats)
+        if self.held:
+            self.release_held()
+
+    def process_packets(self, out, ends, sent_stats, received=None):
+        """Parse and filter packets, appending the bytes to send to out.
+
+        For each forwarded packet, the offset of its end in the data of out
+        is appended to ends, and its MsgTypeStats to sent_stats.
+
+        Returns once the session is closed, or raises PartialPacketException
+        once no complete packet is left in the stream. Each packet is counted
+        in the metrics registry; its parse time covers framing it, since
+        LazyMessage fields are decoded when plugins access them.
+
+        From the first packet whose verdict is pending on, packets are held
+        back rather than appended to out, stamped with the time received.
+        """
+        pos = sum([len(data) for data in out])
+        t0 = time()
+        packet = self.next_packet()
+        while packet != None:
+            t1 = time()
+            self.packets += 1
+            stats = self.msg_stats[packet['msgtype']]
+            stats.packets += 1
+            stats.bytes += len(packet['raw_bytes'])
+            stats.parse_time.observe(t1 - t0)
+            if packet['msgtype'] == 0x01 and self.side == 'client':
+                # Determine which protocol message definitions to use.
+                proto_version = packet['proto_version']
+                logger.info('Client requests protocol version %d' % proto_version)
+                if not proto_version in messages.protocol:
+                    logger.error("Unsupported protocol version %d" % proto_version)
+                    self.handle_close()
+                    return
+                self.set_protocol(proto_version)
+                self.other_side.set_protocol(proto_version)
+            forwarding = True
+            if self.plugin_mgr and packet.decoded:
+                t1 = time()
+                forwarding = self.plugin_mgr.filter(packet, self.side)
+                stats.plugin_time.observe(time() - t1)
+            if self.held or isinstance(forwarding, Deferred):
+                self.hold(packet, stats, forwarding, received)
+            else:
+                data = self.finish_packet(packet, stats, forwarding)
+                if data is not None:
+                    out.append(data)
+                    pos += len(data)
+                    ends.append(pos)
+                    sent_stats.append(stats)
+            # Since we know we're at a message boundary, we can inject
+            # any messages in the queue.
+            if self.plugin_mgr:
+                msgbytes = self.plugin_mgr.injected_from(self.side)
+                if msgbytes:
+                    out.append(msgbytes)
+                    pos += len(msgbytes)
+
+            # Attempt to parse the next packet.
+            t0 = time()
+            packet = self.next_packet()
+
+    def finish_packet(self, packet, stats, forwarding):
+        """Return the bytes to send for a filtered packet, or None to drop it.
+
+        A forwarded packet is passed on to the observe-only plugins.
+        """
+        if not forwarding:
+            stats.drops += 1
+            return None
+        if packet.modified:
+            stats.modified += 1
+            t = time()
+            packet['raw_bytes'] = encode_message(packet, self.msg_spec)
+            stats.emit_time.observe(time() - t)
+        if self.plugin_mgr:
+            self.plugin_mgr.observe(packet, self.side)
+        return packet['raw_bytes']
+
+    def hold(self, packet, stats, verdict, received):
+        """Hold packet back until verdict is in, behind the packets already held."""
+        self.held.append((packet, stats, verdict, received))
+        self.held_bytes += len(packet['raw_bytes'] if stats else packet)
+        if isinstance(verdict, Deferred) and not verdict.called:
+            verdict.add_callback(self.verdict_ready)
+
+    def verdict_ready(self, verdict):
+        # Packets are only held between reads.
+        self.release_held()
+
+    def release_held(self):
+        """Send the held packets whose verdicts are in, up to the first pending one.
+
+        Packets from the same read are sent together, and timed from it.
+        """
+        held = self.held
+        was_full = self.held_bytes > HIGH_WATERMARK
+        batches = [] # [receive time, [bytes], [end offset], [MsgTypeStats], size]
+        while held:
+            (packet, stats, verdict, received) = held[0]
+            if isinstance(verdict, Deferred):
+                if not verdict.called:
+                    break
+                verdict = verdict.result
+            held.popleft()
+            if stats is None:
+                self.held_bytes -= len(packet)
+                data = packet
+            else:
+                self.held_bytes -= len(packet['raw_bytes'])
+                data = self.finish_packet(packet, stats, verdict)
+                if data is None:
+                    continue
+            if not batches or batches[-1][0] != received:
+                batches.append([received, [], [], [], 0])
+            batch = batches[-1]
+            batch[1].append(data)
+            batch[4] += len(data)
+            if stats is not None:
+                batch[2].append(batch[4])
+                batch[3].append(stats)
+        if self.other_side:
+            for (received, out, ends, stats, size) in batches:
+                self.other_side.send(''.join(out), received, ends, stats)
+        if was_full and self.held_bytes <= HIGH_WATERMARK:
+            eventloop.interest_changed(self)
+
+    def send_injected(self):
+        """Send the messages plugins injected as if from this side.
+
+        Called from the event loop when messages are injected, which is
+        always between reads, when the data sent to the other side ends at
+        a packet boundary; unless this side is out of sync, in which case
+        the messages wait until it has resynchronized.
+        """
+        if self.out_of_sync or not self.other_side or not self.plugin_mgr:
             return
+        msgbytes = self.plugin_mgr.injected_from(self.side)
+        if msgbytes:
+            self.other_side.send(msgbytes)
+
+    def resync(self):
+        """Look for a packet boundary in the stream, after a parse failure.
+
+        Candidate boundaries are accepted once RESYNC_PACKETS consecutive
+        packets can be framed from them. Returns the bytes before the
+        boundary, which are forwarded as they are; if no boundary was
+        found, all bytes that cannot start one are returned, and the proxy
+        stays out of sync. A candidate that needs more data to be decided
+        holds back the bytes from it on for at most RESYNC_TIMEOUT seconds;
+        a timer then rejects the undecided candidates, even if no more data
+        arrives.
+        """
+        data = self.stream.peek()
+        pos = self.resync_from
+        now = time()
+        expired = self.resync_wait is not None and now - self.resync_wait >= RESYNC_TIMEOUT
+        waiting = False
+        while pos < len(data):
+            found = frame_packets(data, pos, self.msg_spec, self.packet_sizes,
+                                  RESYNC_PACKETS)
+            if found is None and not expired:
+                waiting = True
+                break # Wait for more data to decide.
+            if found:
+                self.out_of_sync = False
+                self.resyncs += 1
+                metrics.registry.counter('resyncs_total', side=self.side).value += 1
+                logger.warn("%s resynchronized after skipping %d bytes" %
+                            (self.side, self.resync_bytes + pos))
+                self.resync_bytes = 0
+                break
+            pos += 1
+        if waiting:
+            if self.resync_wait is None:
+                self.resync_wait = now
+                self.resync_timer = eventloop.call_later(RESYNC_TIMEOUT,
+                                                         self.resync_timed_out)
+        else:
+            self.cancel_resync_wait()
+        self.resync_from = 0
+        self.stream.reset()
+        self.stream.skip(pos)
+        if self.out_of_sync:
+            self.resync_bytes += pos
+        return self.stream.packet_finished()
+
+    def resync_timed_out(self):
+        """Forward the bytes held back for undecided candidate boundaries."""
+        self.resync_timer = None
+        if self.out_of_sync and self.resync_wait is not None:
+            self.process_stream(monotonic())
 
+    def cancel_resync_wait(self):
+        self.resync_wait = None
+        if self.resync_timer is not None:
+            self.resync_timer.cancel()
+            self.resync_timer = None
+
+    def adapt_recv_size(self, n):
+        """Adjust the read size, after a read of n bytes."""
+        if n == self.recv_size and self.recv_size < self.max_recv_size:
+            self.recv_size = min(2 * self.recv_size, self.max_recv_size)
+        elif n < self.recv_size // 4 and self.recv_size > MIN_RECV_SIZE:
+            self.recv_size = max(self.recv_size // 2, MIN_RECV_SIZE)
+            # Give back stream memory left over from bulk transfers.
+            self.stream.shrink(2 * self.recv_size)
+
+    def next_packet(self):
+        """Parse the next packet from self.stream.
+
+        Only packets of the types the session's plugins handle are decoded,
+        lazily; the rest are framed, and forwarded without being filtered.
+        """
+        decoded_types = None
+        if self.plugin_mgr:
+            decoded_types = self.plugin_mgr.decoded_msgtypes
+        return parse_packet(self.stream, self.msg_spec, self.side,
+                            decoded_types, self.packet_sizes, lazy=True)
+
+    def recv_into_stream(self, buffer_size):
+        """Receive up to buffer_size bytes directly into self.stream.
+
+        Returns the number of bytes received. Like asyncore.dispatcher.recv(),
+        calls handle_close() if the connection was closed.
+        """
         try:
-            packet = parse_packet(self.stream, self.msg_spec, self.side)
-            while packet != None:
-                if packet['msgtype'] == 0x01 and self.side == 'client':
-                    # Determine which protocol message definitions to use.
-                    proto_version = packet['proto_version']
-                    logger.info('Client requests protocol version %d' % proto_version)
-                    if not proto_version in messages.protocol:
-                        logger.error("Unsupported protocol version %d" % proto_version)
-                        self.handle_close()
-                        return
-                    self.msg_spec, self.other_side.msg_spec = messages.protocol[proto_version]
-                forward = True
-                if self.plugin_mgr:
-                    forwarding = self.plugin_mgr.filter(packet, self.side)
-                    if forwarding and packet.modified:
-                        packet['raw_bytes'] = self.msg_spec[packet['msgtype']].parse(packet)
-                if forwarding and self.other_side:
-                    self.other_side.send(packet['raw_bytes'])
-                # Since we know we're at a message boundary, we can inject
-                # any messages in the queue.
-                msgbytes = self.plugin_mgr.next_injected_msg_from(self.side)
-                while self.other_side and msgbytes is not None:
-                    self.other_side.send(msgbytes)
-                    msgbytes = self.plugin_mgr.next_injected_msg_from(self.side)
-
-                # Attempt to parse the next packet.
-                packet = parse_packet(self.stream,self.msg_spec, self.side)
-        except PartialPacketException:
-            pass # Not all data for the current packet is available.
-        except Exception:
-            logger.error("MinecraftProxy for %s caught exception, out of sync" % self.side)
-            logger.error(traceback.format_exc())
-            logger.debug("Current stream buffer: %s" % repr(self.stream.buf))
-            self.out_of_sync = True
-            self.stream.reset()
+            n = self.stream.recv_into(self.socket, buffer_size)
+        except socket.error as why:
+            if why.args[0] in asyncore._DISCONNECTED:
+                self.handle_close()
+                return 0
+            elif why.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return 0
+            else:
+                raise
+        if n == 0:
+            self.handle_close()
+        return n
+
+    def send(self, data, received=None, ends=None, stats=None):
+        """Queue data for sending, holding it until the socket is connected.
+
+        If data holds packets read at time received, ends lists the offset
+        of the end of each packet in data, and stats its MsgTypeStats. The
+        latency of each packet is recorded once its last byte is sent.
+        """
+        if not data:
+            return
+        if ends:
+            self.latency_queue.append((self.bytes_queued, received, ends, stats))
+        was_empty = not self.out_queue
+        self.out_queue.append(memoryview(data))
+        self.out_bytes += len(data)
+        self.bytes_queued += len(data)
+        if self.connected:
+            self.initiate_send()
+        if was_empty and self.out_queue:
+            eventloop.interest_changed(self)
+        if self.out_bytes > HIGH_WATERMARK and self.other_side \
+           and not self.other_side.reading_paused:
+            logger.debug("%s output queue full, pausing reads from %s" %
+                         (self.side, self.other_side.side))
+            self.other_side.reading_paused = True
+            eventloop.interest_changed(self.other_side)
+
+    def initiate_send(self):
+        """Send queued data until the queue is empty or the socket is full."""
+        out_queue = self.out_queue
+        while out_queue:
+            data = out_queue[0]
+            num_sent = eventloop.Dispatcher.send(self, data)
+            self.out_bytes -= num_sent
+            self.bytes_sent += num_sent
+            if num_sent < len(data):
+                out_queue[0] = data[num_sent:]
+                break
+            out_queue.popleft()
+        if self.latency_queue:
+            self.record_latency()
+        if self.out_bytes <= LOW_WATERMARK and self.other_side \
+           and self.other_side.reading_paused:
+            logger.debug("%s output queue drained, resuming reads from %s" %
+                         (self.side, self.other_side.side))
+            self.other_side.reading_paused = False
+            eventloop.interest_changed(self.other_side)
+
+    handle_write = initiate_send
+
+    def record_latency(self):
+        """Record the latency of the queued packets that have been sent.
+
+        All packets of a batch that are sent at once have the same latency,
+        so each run of packets of one type is recorded in one observation.
+        """
+        now = monotonic()
+        sent = self.bytes_sent
+        latency_queue = self.latency_queue
+        while latency_queue:
+            (base, received, ends, stats) = latency_queue[0]
+            i = self.latency_index
+            j = bisect_right(ends, sent - base, i)
+            if j > i:
+                latency = now - received
+                run_stats, n = stats[i], 0
+                for k in xrange(i, j):
+                    if stats[k] is not run_stats:
+                        run_stats.latency.observe(latency, n)
+                        run_stats, n = stats[k], 0
+                    n += 1
+                run_stats.latency.observe(latency, n)
+            if j < len(ends):
+                self.latency_index = j
+                break
+            latency_queue.popleft()
+            self.latency_index = 0
+
+    def readable(self):
+        return not self.reading_paused and self.held_bytes <= HIGH_WATERMARK
+
+    def writable(self):
+        return not self.connected or self.out_bytes > 0
+
+    def handle_connect(self):
+        """Called once the connection to the server is established."""
+        err = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err != 0:
+            raise socket.error(err, os.strerror(err))
+        if self.session is not None:
+            self.session.server_connected()
+
+    def handle_error(self):
+        if self.session is not None and not self.session.srv_connected:
+            self.session.connect_failed(str(sys.exc_info()[1]))
+        else:
+            logger.error("%s proxy caught exception:\n%s" %
+                         (self.side, traceback.format_exc()))
+            self.handle_close()
+
+    def close(self):
+        """Close the socket, dropping the data held back or queued for it."""
+        self.held.clear()
+        self.held_bytes = 0
+        self.out_queue.clear()
+        self.out_bytes = 0
+        self.latency_queue.clear()
+        self.latency_index = 0
+        self.cancel_resync_wait()
+        eventloop.Dispatcher.close(self)
 
     def handle_close(self):
         """Call shutdown handler."""
         logger.info("%s socket closed.", self.side)
-        self.close()
-        if self.other_side is not None:
+        if self.session is not None:
             logger.info("shutting down other side")
-            self.other_side.other_side = None
-            self.other_side.close()
-            self.other_side = None
-            logger.info("shutting down plugin manager")
-            self.plugin_mgr.destroy()
+            self.session.close()
+        else:
+            self.close()
 
 
 class Message(dict):
-    def __init__(self, d):
+    def __init__(self, d, decoded=True):
         super(Message, self).__init__(d)
         self.modified = False
+        # Keys whose values were changed.
+        self.changed = set()
+        # False if only msgtype and raw_bytes are present.
+        self.decoded = decoded
 
     def __setitem__(self, key, val):
         if key in self and self[key] != val:
             self.modified = True
+            self.changed.add(key)
         return super(Message, self).__setitem__(key, val)
 
-def parse_packet(stream, msg_spec, side):
-    """Parse a single packet out of stream, and return it."""
+def encode_message(msg, msg_spec):
+    """Return the bytes of a modified Message.
+
+    If a message has variable-length fields, and only fixed-width fields
+    were changed, the changes are patched into a copy of msg['raw_bytes'].
+    Otherwise the whole message is emitted again; for messages of fixed
+    size that is a single struct.pack(), and cheaper than patching.
+    """
+    parsem = msg_spec[msg['msgtype']]
+    offsets = getattr(msg, 'offsets', None)
+    if offsets is not None and parsem.size is None:
+        data = patch_fields(parsem, msg['raw_bytes'], offsets, msg, msg.changed)
+        if data is not None:
+            return data
+    return parsem.emit(msg)
+
+class LazyMessage(Message):
+    """A Message whose fields are decoded from raw_bytes when first accessed.
+
+    parsem is the message's Parsem, built by defmsg(), and offsets holds the
+    offset in raw_bytes of each of its field segments. Decoding a field
+    decodes the other fields of its segment too, and caches them all.
+
+    The dict methods decode fields as needed, but code that reads a dict's
+    storage directly, like dict(msg), only sees decoded fields; call
+    decode_all() first.
+    """
+    def __init__(self, msgtype, raw_bytes, parsem, offsets):
+        super(LazyMessage, self).__init__({'msgtype': msgtype, 'raw_bytes': raw_bytes})
+        self.parsem = parsem
+        self.offsets = offsets
+        self.decoded_segments = 0 # Bit mask of decoded segments.
+
+    def _decode(self, idx):
+        """Decode the fields of segment idx, unless they were set already."""
+        self.decoded_segments |= 1 << idx
+        self.parsem.decoders[idx](self, dict.__getitem__(self, 'raw_bytes'),
+                                  self.offsets[idx])
+
+    def _pending(self, key):
+        """Return the segment holding field key if it is not decoded, else None."""
+        idx = self.parsem.field_segments.get(key)
+        if idx is None or self.decoded_segments & (1 << idx):
+            return None
+        return idx
+
+    def decode_all(self):
+        """Decode all fields."""
+        for idx in xrange(len(self.parsem.segments)):
+            if not self.decoded_segments & (1 << idx):
+                self._decode(idx)
+
+    def __missing__(self, key):
+        idx = self._pending(key)
+        if idx is None:
+            raise KeyError(key)
+        self._decode(idx)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or self._pending(key) is not None
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __delitem__(self, key):
+        if self._pending(key) is not None:
+            self[key]
+        super(LazyMessage, self).__delitem__(key)
+
+    def pop(self, key, *default):
+        if self._pending(key) is not None:
+            self[key]
+        return super(LazyMessage, self).pop(key, *default)
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        return super(LazyMessage, self).setdefault(key, default)
+
+    def copy(self):
+        self.decode_all()
+        return dict(self)
+
+    def __eq__(self, other):
+        self.decode_all()
+        if isinstance(other, LazyMessage):
+            other.decode_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self.decode_all()
+        return super(LazyMessage, self).__repr__()
+
+    def __nonzero__(self):
+        return True
+
+def _decoding(method):
+    def wrapper(self, *args):
+        self.decode_all()
+        return method(self, *args)
+    wrapper.__name__ = method.__name__
+    return wrapper
+
+for name in ('__iter__', '__len__', 'keys', 'values', 'items', 'iterkeys',
+             'itervalues', 'iteritems', 'popitem', 'viewkeys', 'viewvalues',
+             'viewitems'):
+    setattr(LazyMessage, name, _decoding(getattr(dict, name)))
+
+def frame_packets(data, pos, msg_spec, packet_sizes, count):
+    """Check that count packets can be framed from offset pos of data.
+
+    Returns True if they can, False if they cannot, and None if more data
+    is needed to decide.
+    """
+    reader = Reader(data, pos)
+    try:
+        for i in xrange(count):
+            msgtype = parse_unsigned_byte(reader)
+            if not msg_spec[msgtype]:
+                return False
+            size = packet_sizes[msgtype]
+            if size is not None:
+                reader.skip(size - 1)
+            else:
+                msg_spec[msgtype].skip(reader)
+    except PartialPacketException:
+        if reader.need - pos > RESYNC_WINDOW:
+            return False
+        return None
+    except Exception:
+        return False
+    return True
+
+def parse_packet(stream, msg_spec, side, decoded_types=None, packet_sizes=None,
+                 lazy=False):
+    """Parse a single packet out of stream, and return it.
+
+    If decoded_types is not None, packets whose msgtype is not in it are
+    skipped over rather than decoded, and returned as Messages containing
+    only 'msgtype' and 'raw_bytes'. packet_sizes, a table from
+    messages.fixed_sizes, lets fixed-size packets be skipped in one step.
+    If lazy is True, messages that support it are returned as LazyMessages.
+    """
+    if not stream.has_needed():
+        raise PartialPacketException()
     # read Packet ID
     msgtype = parse_unsigned_byte(stream)
     if not msg_spec[msgtype]:
         raise UnsupportedPacketException(msgtype)
-    logger.debug("%s trying to parse message type %x" % (side, msgtype))
     msg_parser = msg_spec[msgtype]
+    if decoded_types is not None and msgtype not in decoded_types:
+        size = packet_sizes[msgtype] if packet_sizes else None
+        if size is not None:
+            stream.skip(size - 1)
+        else:
+            msg_parser.skip(stream)
+        return Message({'msgtype': msgtype,
+                        'raw_bytes': stream.packet_finished()}, False)
+    logger.debug("%s trying to parse message type %x" % (side, msgtype))
+    if lazy and hasattr(msg_parser, 'segments'):
+        offsets = msg_parser.offsets
+        if offsets is None:
+            offsets = msg_parser.index(stream)
+        else:
+            stream.skip(msg_parser.size)
+        return LazyMessage(msgtype, stream.packet_finished(), msg_parser, offsets)
     msg = msg_parser.parse(stream)
     msg['raw_bytes'] = stream.packet_finished()
     return Message(msg)
@@ -251,18 +1122,16 @@ if __name__ == "__main__":
     # Install signal handler.
     signal.signal(signal.SIGINT, sigint_handler)
 
-    while True:
-        cli_sock = wait_for_client(opts.locport)
+    if opts.codegen:
+        codegen.install(messages.protocol, opts.codegen_cache or None)
 
-        # Set up client/server main-in-the-middle.
-        sleep(0.05)
-        MinecraftSession(pcfg, cli_sock, host, port)
-
-        # I/O event loop.
-        if opts.perf_data:
-            logger.warn("Profiling enabled, saving data to %s" % opts.perf_data)
-            import cProfile
-            cProfile.run('asyncore.loop()', opts.perf_data)
-        else:
-            asyncore.loop()
+    srvsock = listen_socket(opts.locport)
+    metrics_socks = None
+    if opts.metrics_port:
+        metrics_socks = [metrics.listen_socket(opts.metrics_host, opts.metrics_port + i)
+                         for i in range(opts.workers)]
+    if opts.workers > 1:
+        run_workers(opts.workers, srvsock, pcfg, host, port, opts, metrics_socks)
+    else:
+        serve(srvsock, pcfg, host, port, opts, metrics_socks and metrics_socks[0])
 
@@ -15,7 +15,34 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import os.path, logging, logging.config
+import os.path, sys, logging, logging.config, time
+
+def _monotonic_clock():
+    """Return a function returning the time in seconds of a monotonic clock.
+
+    Python 2 has no time.monotonic(), so on Linux clock_gettime() is called
+    through ctypes. Elsewhere, time.time() is used instead.
+    """
+    if not sys.platform.startswith('linux'):
+        return time.time
+    try:
+        import ctypes, ctypes.util
+        librt = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1')
+        clock_gettime = librt.clock_gettime
+    except (ImportError, OSError, AttributeError):
+        return time.time
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+    CLOCK_MONOTONIC = 1
+    byref = ctypes.byref
+    def monotonic():
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, byref(ts)) != 0:
+            return time.time()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+monotonic = _monotonic_clock()
 
 class PartialPacketException(Exception):
     """Thrown during parsing when not a complete packet is not available."""
@@ -23,31 +50,109 @@ class PartialPacketException(Exception):
 
 
 class Stream(object):
-    """Represent a stream of bytes."""
+    """Represent a stream of bytes.
 
-    def __init__(self):
+    The bytes are held in a preallocated bytearray. The current packet
+    starts at offset start, and the stream ends at offset end; new data is
+    appended (or received directly) after end. Space before start is only
+    reclaimed, by moving the remaining bytes to the front of the buffer,
+    when there is not enough room left after end.
+    """
+
+    def __init__(self, capacity=16384):
         """Initialize the stream."""
-        self.buf = ""
-        self.i = 0
+        self.buf = bytearray(capacity)
+        self.start = 0 # Offset of the first byte of the current packet.
+        self.end = 0   # Offset just past the last byte in the stream.
+        self.i = 0     # Read position, relative to start.
+        self.need = 0  # Bytes known to be needed to complete the packet.
         self.tot_bytes = 0
         self.wasted_bytes = 0
 
+    def _reserve(self, n):
+        """Make room for at least n more bytes after end."""
+        if len(self.buf) - self.end >= n:
+            return
+        size = self.end - self.start
+        if self.start > 0:
+            self.buf[:size] = self.buf[self.start:self.end]
+            self.start, self.end = 0, size
+        if len(self.buf) - size < n:
+            self.buf.extend(bytearray(max(n, len(self.buf))))
+
     def append(self,str):
         """Append a string to the stream."""
-        self.buf += str
+        n = len(str)
+        self._reserve(n)
+        self.buf[self.end:self.end+n] = str
+        self.end += n
+
+    def shrink(self, capacity):
+        """Reallocate the buffer with the given capacity, if it is larger.
+
+        Nothing is done if the stream holds more than capacity bytes.
+        """
+        size = self.end - self.start
+        if len(self.buf) <= capacity or size > capacity:
+            return
+        buf = bytearray(capacity)
+        buf[:size] = self.buf[self.start:self.end]
+        self.buf = buf
+        self.start, self.end = 0, size
+
+    def recv_into(self, sock, n):
+        """Receive up to n bytes from sock into the stream.
+
+        Returns the number of bytes received, as sock.recv_into() does.
+        """
+        self._reserve(n)
+        nbytes = sock.recv_into(memoryview(self.buf)[self.end:], n)
+        self.end += nbytes
+        return nbytes
 
     def read(self,n):
-        """Read n bytes, returned as a string."""
-        if self.i + n > len(self.buf):
-            self.wasted_bytes += self.i
-            self.i = 0
-            raise PartialPacketException()
-        str = self.buf[self.i:self.i+n]
+        """Read n bytes, returned as a read-only buffer.
+
+        The buffer is a view of the stream's storage, and is only valid until
+        the stream is next modified; use str() on it to keep a copy.
+        """
+        pos = self.start + self.i
+        if pos + n > self.end:
+            self._partial(n)
+        self.i += n
+        return buffer(self.buf, pos, n)
+
+    def skip(self, n):
+        """Advance past n bytes without returning them."""
+        if n < 0:
+            raise ValueError("Cannot skip %d bytes" % n)
+        if self.start + self.i + n > self.end:
+            self._partial(n)
         self.i += n
-        return str
+
+    def _partial(self, n):
+        """Abandon the current packet after a failed read of n bytes."""
+        self.wasted_bytes += self.i
+        self.need = self.i + n
+        self.i = 0
+        raise PartialPacketException()
+
+    def has_needed(self):
+        """Return False if the current packet is known to be incomplete.
+
+        When a read fails, the stream records how many bytes the packet
+        needs at minimum (e.g. the size given by a length prefix), so that
+        parsing need not be retried until at least that many have arrived.
+        """
+        return self.end - self.start >= self.need
+
+    def peek(self):
+        """Return all unconsumed bytes, from the start of the current packet."""
+        return str(buffer(self.buf, self.start, self.end - self.start))
 
     def reset(self):
         self.i = 0
+        self.need = 0
 
     def packet_finished(self):
         """Mark the completion of a packet, and return its bytes as a string."""
@@ -55,14 +160,53 @@ class Stream(object):
         # and reset i.
         data = ""
         if self.i > 0:
-            data = self.buf[:self.i]
-            self.buf = self.buf[self.i:]
+            data = str(buffer(self.buf, self.start, self.i))
+            self.start += self.i
             self.tot_bytes += self.i
             self.i = 0
+            self.need = 0
+            if self.start == self.end:
+                self.start = self.end = 0
         return data
 
     def __len__(self):
-        return len(self.buf) - self.i
+        return self.end - self.start - self.i
+
+
+class Reader(object):
+    """Read fields out of a complete packet held in a string.
+
+    A Reader supports the Stream operations used by parsers, so that single
+    fields can be decoded from a packet's raw bytes, starting at offset i.
+    Like a Stream, it raises PartialPacketException on reads past the end of
+    the data, and sets need to the offset the read required.
+    """
+
+    def __init__(self, data, i=0):
+        self.data = data
+        self.i = i
+        self.need = 0
+
+    def read(self, n):
+        """Read n bytes, returned as a read-only buffer."""
+        pos = self.i
+        self.skip(n)
+        return buffer(self.data, pos, n)
+
+    def skip(self, n):
+        """Advance past n bytes without returning them."""
+        if n < 0:
+            raise ValueError("Cannot skip %d bytes" % n)
+        if self.i + n > len(self.data):
+            self.need = self.i + n
+            raise PartialPacketException()
+        self.i += n
+
+    def peek(self):
+        return self.data
+
+    def __len__(self):
+        return len(self.data) - self.i
 
 def write_default_logging_file(lpath):
     """Write a default logging.conf."""
@@ -0,0 +1,172 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, shutil, tempfile, os
+
+from mc3p import messages, codegen
+from mc3p.parsing import *
+from mc3p.proxy import parse_packet
+from mc3p.util import Stream
+
+# Encoded sample values for each field type.
+SAMPLES = {
+    MC_byte: '\xfb',
+    MC_unsigned_byte: '\xc8',
+    MC_short: '\xfe\xd4',
+    MC_int: '\x00\x01\xe2\x40',
+    MC_long: '\x00\x00\x01\x00\x00\x00\x00\x00',
+    MC_float: '\x3f\x00\x00\x00',
+    MC_double: '\x3f\xf4\x00\x00\x00\x00\x00\x00',
+    MC_bool: '\x01',
+    MC_string: '\x00\x02\x00h\x00i',
+    MC_string8: '\x00\x03abc',
+    MC_metadata: '\x00\x05\x40\x00\x00\x00\x09\x7f',
+    MC_slot_update: '\x00\x03\x02\x00\x00',
+    MC_slot_update2: '\x00\x03\x02\x00\x00',
+    MC_inventory: '\x00\x02\x00\x03\x02\x00\x00\xff\xff',
+    MC_inventory2: '\x00\x02\x00\x03\x02\x00\x00\xff\xff',
+    MC_chunk: '\x00\x00\x00\x03xyz',
+    MC_chunk2: '\x00\x00\x00\x03\x00\x00\x00\x00xyz',
+    MC_multi_block_change: '\x00\x01\x00\x05\x01\x02',
+    MC_multi_block_change2: '\x00\x00\x00\x08\x00\x00\x00\x01\x00\x00\x00\x02',
+    MC_explosion_records: '\x00\x00\x00\x01\x01\x02\x03',
+    MC_vehicle_data: '\x00\x00\x00\x00',
+    MC_item_data: '\x02ab',
+    MC_fireball_data: '\x00\x00\x00\x00',
+}
+
+def parse(parse, raw):
+    s = Stream()
+    s.append(raw[1:])
+    msg = parse(s)
+    assert len(s) == 0
+    return msg
+
+def index(index, raw):
+    """Return the segment offsets index finds in the message raw."""
+    s = Stream()
+    s.append(raw)
+    s.read(1)
+    offsets = index(s)
+    assert len(s) == 0
+    return offsets
+
+def emit(emit, msg):
+    """Return emit(msg), or the type of the exception it raised."""
+    try:
+        return emit(msg)
+    except Exception as e:
+        return type(e)
+
+
+class TestCodegen(unittest.TestCase):
+
+    def setUp(self):
+        self.codecs = codegen.compile_codecs(messages.protocol)
+
+    def testRoundTrip(self):
+        self.assertEqual(85, len(self.codecs))
+        for (parsem, gen_parse, gen_emit, lazy) in self.codecs:
+            if hasattr(parsem, 'versioned_fields'):
+                continue
+            raw = chr(parsem.msgtype) + ''.join([SAMPLES[field]
+                                                 for (name, field) in parsem.fields])
+            msg = parse(parsem.parse, raw)
+            self.assertEqual(msg, parse(gen_parse, raw), parsem.name)
+            self.assertEqual(emit(parsem.emit, msg), emit(gen_emit, msg), parsem.name)
+
+    def testLazy(self):
+        for (parsem, gen_parse, gen_emit, lazy) in self.codecs:
+            if lazy is None:
+                continue
+            (gen_index, gen_decoders) = lazy
+            raw = chr(parsem.msgtype) + ''.join([SAMPLES[field]
+                                                 for (name, field) in parsem.fields])
+            self.assertEqual(parsem.offsets is None, gen_index is not None)
+            if gen_index is None:
+                offsets = parsem.offsets
+            else:
+                offsets = index(parsem.index, raw)
+                self.assertEqual(offsets, index(gen_index, raw), parsem.name)
+            msg, gen_msg = {'msgtype': parsem.msgtype}, {'msgtype': parsem.msgtype}
+            for (decode, gen_decode, offset) in zip(parsem.decoders, gen_decoders, offsets):
+                decode(msg, raw, offset)
+                gen_decode(gen_msg, raw, offset)
+            self.assertEqual(parse(parsem.parse, raw), msg, parsem.name)
+            self.assertEqual(msg, gen_msg, parsem.name)
+        # Fields that are set already are left alone.
+        msg = {'msgtype': 0x03, 'chat_msg': u'set'}
+        (parsem, gen_parse, gen_emit, lazy) = [codec for codec in self.codecs
+                                               if codec[0] is messages.protocol[29][0][0x03]][0]
+        lazy[1][0](msg, '\x03' + SAMPLES[MC_string], 1)
+        self.assertEqual(u'set', msg['chat_msg'])
+
+    def testInstall(self):
+        chat = defmsg(0x03, "Chat", [('chat_msg', MC_string)])
+        move = defmsg(0x1f, "Entity relative move", [('eid', MC_int), ('dx', MC_byte),
+                                                      ('dy', MC_byte), ('dz', MC_byte)])
+        msg_spec = [None] * 256
+        msg_spec[0x03], msg_spec[0x1f] = chat, move
+        saved = codegen._installed
+        codegen._installed = False
+        try:
+            codegen.install({29: (msg_spec, [None] * 256)})
+        finally:
+            codegen._installed = saved
+        # Lazily parsed messages are framed and decoded by generated code.
+        for func in [chat.index, chat.parse, move.parse] + chat.decoders + move.decoders:
+            self.assertEqual('<mc3p generated codecs>', func.func_code.co_filename)
+        calls = []
+        gen_decode = chat.decoders[0]
+        chat.decoders[0] = lambda *args: calls.append(args) or gen_decode(*args)
+        stream = Stream()
+        stream.append(chat.emit({'msgtype': 0x03, 'chat_msg': u'hi'}) +
+                      move.emit({'msgtype': 0x1f, 'eid': 7, 'dx': 1, 'dy': 2, 'dz': 3}))
+        msg = parse_packet(stream, msg_spec, 'client', lazy=True)
+        self.assertEqual(u'hi', msg['chat_msg'])
+        self.assertEqual(1, len(calls))
+        msg = parse_packet(stream, msg_spec, 'client', lazy=True)
+        self.assertEqual((7, 3), (msg['eid'], msg['dz']))
+
+    def testLogin(self):
+        (parsem, gen_parse, gen_emit, lazy) = [codec for codec in self.codecs
+            if hasattr(codec[0], 'versioned_fields')][0]
+        # Version 99 has no generated code.
+        for version in sorted(messages.protocol) + [99]:
+            raw = ''.join(['\x01', emit_int(version)] +
+                          [SAMPLES[field] for (name, field)
+                           in version_fields(parsem.versioned_fields, version)])
+            msg = parse(parsem.parse, raw)
+            self.assertEqual(msg, parse(gen_parse, raw))
+            self.assertEqual(raw, gen_emit(msg))
+            self.assertEqual(raw, parsem.emit(msg))
+
+    def testCache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            for i in range(2):
+                codecs = codegen.compile_codecs(messages.protocol, cache_dir)
+                self.assertEqual(2, len(os.listdir(cache_dir)))
+                (parsem, gen_parse, gen_emit, lazy) = codecs[-1]
+                msg = {'msgtype': parsem.msgtype, 'invulnerable': True,
+                       'flying': False, 'allow_flying': True, 'instant_destroy': False}
+                self.assertEqual(parsem.emit(msg), gen_emit(msg))
+        finally:
+            shutil.rmtree(cache_dir)
+
+if __name__ == "__main__":
+    unittest.main()
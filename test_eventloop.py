@@ -0,0 +1,175 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, socket, asyncore, select, threading, time
+
+from mc3p import eventloop
+
+class CountingDispatcher(eventloop.Dispatcher):
+    """Counts calls to readable(), and reads when its flag says so."""
+
+    def __init__(self, sock, map):
+        eventloop.Dispatcher.__init__(self, sock, map)
+        self.checks = 0
+        self.reading = True
+        self.data = ''
+
+    def readable(self):
+        self.checks += 1
+        return self.reading
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.data += self.recv(4096)
+
+
+class TestEpollPoller(unittest.TestCase):
+
+    def setUp(self):
+        if 'epoll' not in eventloop.ENGINES:
+            self.skipTest('epoll is not available')
+        self.map = {}
+        self.poll = eventloop.make_poller('epoll')
+        self.peers = []
+        self.dispatchers = []
+        for i in range(20):
+            (a, b) = socket.socketpair()
+            self.peers.append(b)
+            self.dispatchers.append(CountingDispatcher(a, self.map))
+
+    def tearDown(self):
+        for obj in self.map.values():
+            obj.close()
+        for peer in self.peers:
+            peer.close()
+        eventloop._epoll_poller = None
+
+    def checks(self):
+        counts = [d.checks for d in self.dispatchers]
+        for d in self.dispatchers:
+            d.checks = 0
+        return counts
+
+    def testIdle(self):
+        self.poll(0, self.map)
+        self.assertEqual([1] * 20, self.checks())
+        # Idle dispatchers are not looked at again.
+        self.poll(0, self.map)
+        self.assertEqual([0] * 20, self.checks())
+        self.peers[3].send('x')
+        self.poll(0, self.map)
+        self.assertEqual('x', self.dispatchers[3].data)
+        self.poll(0, self.map)
+        self.assertEqual([0, 0, 0, 1] + [0] * 16, self.checks())
+
+    def testInterestChanged(self):
+        self.poll(0, self.map)
+        d = self.dispatchers[5]
+        d.reading = False
+        eventloop.interest_changed(d)
+        self.peers[5].send('x')
+        self.poll(0, self.map)
+        self.assertEqual('', d.data)
+        d.reading = True
+        eventloop.interest_changed(d)
+        self.poll(0, self.map)
+        self.assertEqual('x', d.data)
+
+    def testAddRemove(self):
+        self.poll(0, self.map)
+        poller = eventloop._epoll_poller
+        self.dispatchers[0].close()
+        (a, b) = socket.socketpair()
+        self.peers.append(b)
+        added = CountingDispatcher(a, self.map)
+        self.poll(0, self.map)
+        self.assertEqual(20, len(poller.registered))
+        self.assertFalse(self.dispatchers[0] in poller.fds)
+        b.send('x')
+        self.poll(0, self.map)
+        self.assertEqual('x', added.data)
+
+    def testPlainDispatcher(self):
+        self.poll(0, self.map)
+        self.checks()
+        (a, b) = socket.socketpair()
+        self.peers.append(b)
+        plain = asyncore.dispatcher(a, self.map)
+        # Dispatchers that do not report changes are found by a rescan.
+        self.poll(0, self.map)
+        self.assertEqual([1] * 20, self.checks())
+        self.assertEqual(select.EPOLLIN | select.EPOLLPRI | select.EPOLLOUT,
+                         eventloop._epoll_poller.registered[a.fileno()][1])
+
+class TestCallFromThread(unittest.TestCase):
+
+    def setUp(self):
+        self.map = {}
+        (a, self.peer) = socket.socketpair()
+        self.idle = CountingDispatcher(a, self.map)
+
+    def tearDown(self):
+        for obj in self.map.values():
+            obj.close()
+        self.peer.close()
+        eventloop._waker = None
+        eventloop._epoll_poller = None
+
+    def runIdle(self, engine):
+        """Run the loop with no traffic, and return how long a call from a
+        thread made 0.1s in took to run."""
+        called = []
+        def callback(t):
+            called.append(time.time() - t)
+            self.idle.close()
+        def thread_main():
+            time.sleep(0.1)
+            eventloop.call_from_thread(callback, time.time())
+        # Bounds the test if the wakeup is lost.
+        timer = eventloop.call_later(3.0, self.idle.close)
+        threading.Thread(target=thread_main).start()
+        eventloop.run(self.map, engine)
+        timer.cancel()
+        eventloop.run_timers()
+        self.assertEqual(1, len(called))
+        return called[0]
+
+    def testWake(self):
+        for engine in eventloop.ENGINES:
+            self.assertTrue(self.runIdle(engine) < 0.5, engine)
+            eventloop._waker.close()
+            eventloop._waker = None
+            self.peer.close()
+            (a, self.peer) = socket.socketpair()
+            self.idle = CountingDispatcher(a, self.map)
+
+    def testQueuedBeforeRun(self):
+        called = []
+        def callback():
+            called.append(1)
+            self.idle.close()
+        eventloop.call_from_thread(callback)
+        timer = eventloop.call_later(3.0, self.idle.close)
+        eventloop.run(self.map)
+        timer.cancel()
+        eventloop.run_timers()
+        self.assertEqual([1], called)
+
+if __name__ == "__main__":
+    unittest.main()
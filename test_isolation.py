@@ -0,0 +1,127 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, asyncore, os
+from time import time, sleep
+
+from mc3p import messages, eventloop
+from mc3p.isolation import ShmRing, IsolatedPlugin
+from mc3p.plugins import MC3Plugin, InjectionQueue, msghdlr
+from mc3p.proxy import parse_packet
+from mc3p.util import Stream
+
+cli_msgs = messages.protocol[29][0]
+
+def chat(text):
+    return cli_msgs[0x03].emit({'msgtype': 0x03, 'chat_msg': text})
+
+def chat_msg(text):
+    stream = Stream()
+    stream.append(chat(text))
+    return parse_packet(stream, cli_msgs, 'client', lazy=True)
+
+def wait(d, timeout=5.0):
+    """Run the event loop until d is called."""
+    end = time() + timeout
+    while not d.called and time() < end:
+        asyncore.loop(timeout=0.01, count=1)
+        eventloop.run_timers()
+    return d.result
+
+
+class ChatPlugin(MC3Plugin):
+    @msghdlr(0x03)
+    def handle_chat(self, msg, source):
+        text = msg['chat_msg']
+        if text == 'drop':
+            return False
+        elif text == 'slow':
+            sleep(0.5)
+        elif text == 'pid':
+            self.to_client({'msgtype': 0x03, 'chat_msg': unicode(os.getpid())})
+        elif text == 'exit':
+            os._exit(0)
+        msg['chat_msg'] = text.upper()
+        return True
+
+
+class TestShmRing(unittest.TestCase):
+
+    def testWrap(self):
+        ring = ShmRing(64)
+        for i in range(20):
+            self.assertTrue(ring.write('x' * (i % 7)))
+            self.assertTrue(ring.write(str(i) * 10))
+            self.assertEqual(['x' * (i % 7), str(i) * 10], ring.read())
+        self.assertEqual([], ring.read())
+
+    def testFull(self):
+        ring = ShmRing(64)
+        self.assertTrue(ring.write('a' * 30))
+        self.assertFalse(ring.write('b' * 30))
+        self.assertEqual(['a' * 30], ring.read())
+        self.assertTrue(ring.write('b' * 30))
+
+
+class TestIsolatedPlugin(unittest.TestCase):
+
+    def setUp(self):
+        self.to_client = InjectionQueue()
+        self.plugin = IsolatedPlugin('chat', ChatPlugin, ChatPlugin._handled_msgtypes(),
+                                     '', 29, InjectionQueue(), self.to_client,
+                                     0.2, 1.0)
+
+    def tearDown(self):
+        self.plugin.shutdown()
+
+    def testVerdicts(self):
+        self.assertEqual(set([0x03]), self.plugin._msgtypes())
+        self.assertEqual(None, self.plugin._handler_for(0x04))
+        msg = chat_msg(u'hello')
+        self.assertTrue(wait(self.plugin.submit(msg, 'client')))
+        self.assertTrue(msg.modified)
+        self.assertEqual(u'HELLO', msg['chat_msg'])
+        self.assertFalse(wait(self.plugin.submit(chat_msg(u'drop'), 'client')))
+
+    def testInjection(self):
+        self.assertTrue(wait(self.plugin.submit(chat_msg(u'pid'), 'client')))
+        end = time() + 5
+        while not self.to_client.msgs and time() < end:
+            asyncore.loop(timeout=0.01, count=1)
+        self.assertEqual(chat(unicode(self.plugin.pid)), self.to_client.drain())
+
+    def testDeadline(self):
+        msg = chat_msg(u'slow')
+        self.assertTrue(wait(self.plugin.submit(msg, 'client')))
+        self.assertFalse(msg.modified)
+        # The late verdict is ignored.
+        end = time() + 0.6
+        while time() < end:
+            asyncore.loop(timeout=0.01, count=1)
+        self.assertFalse(self.plugin.pending)
+        self.assertFalse(msg.modified)
+
+    def testChildExit(self):
+        d = self.plugin.submit(chat_msg(u'exit'), 'client')
+        self.assertTrue(wait(d))
+        end = time() + 5
+        while not self.plugin.dead and time() < end:
+            asyncore.loop(timeout=0.01, count=1)
+        self.assertEqual(True, self.plugin.submit(chat_msg(u'a'), 'client'))
+
+if __name__ == "__main__":
+    unittest.main()
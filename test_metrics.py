@@ -0,0 +1,184 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, socket, asyncore, errno
+
+from mc3p import metrics, messages
+from mc3p.metrics import Histogram, Registry
+from mc3p.proxy import MinecraftProxy
+from mc3p.plugins import PluginManager
+
+class TestHistogram(unittest.TestCase):
+
+    def testObserve(self):
+        h = Histogram((1, 2, 4, 8))
+        for v in (0.5, 1, 3, 3, 3, 7, 100):
+            h.observe(v)
+        self.assertEqual([2, 0, 3, 1, 1], h.buckets)
+        self.assertEqual(7, h.count)
+        self.assertEqual(100, h.max)
+        self.assertEqual(4, h.quantile(0.5))
+        self.assertEqual(100, h.quantile(0.99))
+        self.assertEqual(0.0, Histogram().quantile(0.5))
+
+    def testMerge(self):
+        a, b = Histogram((1, 2)), Histogram((1, 2))
+        a.observe(0.5)
+        b.observe(1.5)
+        b.observe(1.7)
+        a.merge(b)
+        self.assertEqual([1, 2, 0], a.buckets)
+        self.assertEqual(3, a.count)
+        self.assertEqual(1.7, a.max)
+
+class DropPlugins(object):
+    """Stands in for a PluginManager; drops chat messages, and modifies
+    player positions."""
+    decoded_msgtypes = set([0x03, 0x0b])
+
+    def filter(self, msg, side):
+        if msg['msgtype'] == 0x03:
+            return False
+        msg['x'] += 1
+        return True
+
+    def injected_from(self, side):
+        return None
+
+    def observe(self, msg, side):
+        pass
+
+class TestRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = metrics.registry
+        metrics.registry = Registry()
+
+    def tearDown(self):
+        metrics.registry = self.saved
+
+    def testTables(self):
+        cli_table = metrics.registry.msgtype_table(29, 'client')
+        self.assertEqual(256, len(cli_table))
+        self.assertEqual('Chat', cli_table[0x03].name)
+        self.assertEqual('Login packet', cli_table[0x01].name)
+        self.assertEqual(None, cli_table[0x04])
+
+    def testProxyStats(self):
+        cli_sock, cli_peer = socket.socketpair()
+        srv_sock, srv_peer = socket.socketpair()
+        try:
+            cli_proxy = MinecraftProxy(cli_sock)
+            srv_proxy = MinecraftProxy(srv_sock, cli_proxy)
+            cli_proxy.set_protocol(29)
+            cli_proxy.plugin_mgr = DropPlugins()
+            cli_msgs = messages.protocol[29][0]
+            chat = cli_msgs[0x03].emit({'msgtype': 0x03, 'chat_msg': u'hi'})
+            pos = cli_msgs[0x0b].emit({'msgtype': 0x0b, 'x': 1.0, 'y': 64.0,
+                                       'stance': 65.6, 'z': 2.0, 'on_ground': True})
+            keepalive = cli_msgs[0x00].emit({'msgtype': 0x00, 'id': 7})
+            cli_peer.sendall(chat + pos + pos + keepalive)
+            cli_proxy.handle_read()
+            snap = metrics.snapshot()['msgtypes']
+            self.assertEqual(set([('client', 0x00), ('client', 0x03), ('client', 0x0b)]),
+                             set(snap))
+            self.assertEqual((1, len(chat), 1, 0),
+                             tuple([snap[('client', 0x03)][k] for k in
+                                    ('packets', 'bytes', 'drops', 'modified')]))
+            self.assertEqual((2, 2 * len(pos), 0, 2),
+                             tuple([snap[('client', 0x0b)][k] for k in
+                                    ('packets', 'bytes', 'drops', 'modified')]))
+            self.assertEqual(2, snap[('client', 0x0b)]['parse_time']['count'])
+            self.assertEqual(2, snap[('client', 0x0b)]['emit_time']['count'])
+            self.assertEqual(0, snap[('client', 0x00)]['emit_time']['count'])
+            self.assertEqual(2, snap[('client', 0x0b)]['latency']['count'])
+            self.assertEqual(0, snap[('client', 0x03)]['latency']['count'])
+            self.assertEqual(1, snap[('client', 0x03)]['plugin_time']['count'])
+            self.assertEqual(0, snap[('client', 0x00)]['plugin_time']['count'])
+            self.assertEqual(3, metrics.snapshot()['sides']['client']['latency']['count'])
+        finally:
+            cli_proxy.close()
+            srv_proxy.close()
+            for s in (cli_peer, srv_peer):
+                s.close()
+
+class TestExposition(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = metrics.registry
+        metrics.registry = Registry()
+        stats = metrics.registry.msgtype_table(29, 'server')[0x03]
+        stats.packets, stats.bytes = 3, 60
+        stats.parse_time.observe(3e-6)
+        metrics.registry.counter('out_of_sync_total', side='client').value = 2
+        metrics.registry.gauge('sessions', lambda: 5)
+
+    def tearDown(self):
+        metrics.registry = self.saved
+
+    def testRender(self):
+        lines = metrics.render(metrics.snapshot()).splitlines()
+        for line in ('# TYPE mc3p_packets_total counter',
+                     'mc3p_packets_total{side="server",msgtype="0x03",name="%s"} 3'
+                     % messages.protocol[29][1][0x03].name,
+                     'mc3p_parse_seconds_bucket{side="server",msgtype="0x03",le="2e-06"} 0',
+                     'mc3p_parse_seconds_bucket{side="server",msgtype="0x03",le="4e-06"} 1',
+                     'mc3p_parse_seconds_bucket{side="server",msgtype="0x03",le="+Inf"} 1',
+                     'mc3p_parse_seconds_count{side="server",msgtype="0x03"} 1',
+                     'mc3p_out_of_sync_total{side="client"} 2',
+                     '# TYPE mc3p_sessions gauge',
+                     'mc3p_sessions 5'):
+            self.assertTrue(line in lines, line)
+
+    def get(self, listener, request):
+        """Send request to listener, and return the response."""
+        client = socket.create_connection(listener.socket.getsockname())
+        client.setblocking(0)
+        client.sendall(request)
+        response = []
+        for i in range(100):
+            asyncore.loop(timeout=0.01, count=1)
+            try:
+                data = client.recv(65536)
+            except socket.error as e:
+                if e.args[0] != errno.EAGAIN:
+                    raise
+                continue
+            if not data:
+                break
+            response.append(data)
+        client.close()
+        return ''.join(response)
+
+    def testServe(self):
+        listener = metrics.MetricsListener(metrics.listen_socket('127.0.0.1', 0))
+        try:
+            metrics.registry.gauge('sessions', lambda: 6)
+            response = self.get(listener, 'GET /metrics HTTP/1.0\r\n\r\n')
+            self.assertTrue(response.startswith('HTTP/1.0 200 OK\r\n'))
+            # The page is only rendered on refresh.
+            self.assertTrue('\nmc3p_sessions 5\n' in response)
+            listener.refresh()
+            response = self.get(listener, 'GET / HTTP/1.1\r\nHost: x\r\n\r\n')
+            self.assertTrue('\nmc3p_sessions 6\n' in response)
+            response = self.get(listener, 'GET /other HTTP/1.0\r\n\r\n')
+            self.assertTrue(response.startswith('HTTP/1.0 404 Not Found\r\n'))
+        finally:
+            listener.close()
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,251 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, socket, logging
+
+from mc3p import messages
+from mc3p.util import Stream, PartialPacketException
+from mc3p.proxy import parse_packet, encode_message, LazyMessage
+
+cli_msgs, srv_msgs = messages.protocol[29]
+
+def chunk_msg(n):
+    return {'msgtype': 0x33, 'x': 1, 'z': 2, 'continuous': True,
+            'chunk_bitmap': 1, 'add_bitmap': 0,
+            'chunk': {'size': n, 'data': 'x' * n}}
+
+
+class TestStream(unittest.TestCase):
+
+    def testReadAndFinish(self):
+        s = Stream()
+        s.append('abcdef')
+        self.assertEqual('ab', str(s.read(2)))
+        self.assertEqual('cd', str(s.read(2)))
+        self.assertEqual('abcd', s.packet_finished())
+        self.assertEqual(2, len(s))
+        self.assertEqual(4, s.tot_bytes)
+
+    def testPartialRead(self):
+        s = Stream()
+        s.append('abc')
+        s.read(2)
+        self.assertRaises(PartialPacketException, s.read, 2)
+        self.assertEqual(0, s.i)
+        self.assertEqual(2, s.wasted_bytes)
+        self.assertEqual(3, len(s))
+
+    def testBufferIsReused(self):
+        s = Stream(capacity=64)
+        s.append('789')
+        for i in range(1000):
+            s.append('0123456789')
+            self.assertEqual('7890123456', str(s.read(10)))
+            s.packet_finished()
+        self.assertEqual(64, len(s.buf))
+        self.assertEqual('789', s.peek())
+
+    def testGrow(self):
+        s = Stream(capacity=16)
+        s.append('x' * 100)
+        self.assertEqual('x' * 100, str(s.read(100)))
+
+    def testShrink(self):
+        s = Stream(capacity=16)
+        s.append('x' * 100)
+        s.read(90)
+        s.packet_finished()
+        size = len(s.buf)
+        s.shrink(8)
+        self.assertEqual(size, len(s.buf))
+        s.shrink(32)
+        self.assertEqual(32, len(s.buf))
+        self.assertEqual('x' * 10, s.peek())
+
+    def testRecvInto(self):
+        a, b = socket.socketpair()
+        try:
+            a.sendall('hello')
+            s = Stream(capacity=4)
+            s.append('>')
+            self.assertEqual(5, s.recv_into(b, 5))
+            self.assertEqual('>hello', str(s.read(6)))
+        finally:
+            a.close()
+            b.close()
+
+
+class TestParsePacket(unittest.TestCase):
+
+    def testParseInPieces(self):
+        raw = srv_msgs[0x33].emit(chunk_msg(5000))
+        s = Stream(capacity=128)
+        for i in range(0, len(raw) - 1000, 1000):
+            s.append(raw[i:i+1000])
+            self.assertRaises(PartialPacketException,
+                              parse_packet, s, srv_msgs, 'server')
+        s.append(raw[i+1000:])
+        msg = parse_packet(s, srv_msgs, 'server')
+        self.assertEqual(raw, msg['raw_bytes'])
+        self.assertEqual('x' * 5000, msg['chunk']['data'])
+        self.assertEqual(0, len(s))
+
+    def testNoReparseUntilComplete(self):
+        raw = srv_msgs[0x33].emit(chunk_msg(5000))
+        s = Stream()
+        s.append(raw[:100])
+        self.assertRaises(PartialPacketException,
+                          parse_packet, s, srv_msgs, 'server')
+        self.assertEqual(len(raw), s.need)
+        wasted = s.wasted_bytes
+        for i in range(100, len(raw) - 100, 100):
+            s.append(raw[i:i+100])
+            self.assertRaises(PartialPacketException,
+                              parse_packet, s, srv_msgs, 'server')
+        self.assertEqual(wasted, s.wasted_bytes)
+        s.append(raw[i+100:])
+        self.assertEqual(raw, parse_packet(s, srv_msgs, 'server')['raw_bytes'])
+        self.assertEqual(0, s.need)
+
+    def testFramingOnly(self):
+        # Mob spawn with metadata: a string, an int and a byte.
+        mob_spawn = ''.join(['\x18', '\x00\x00\x00\x07', '\x05',
+                             '\x00' * 12, '\x01\x02\x03',
+                             '\x80\x00\x02\x00a\x00b',
+                             '\x40\x00\x00\x00\x09', '\x00\x05', '\x7f'])
+        chat = srv_msgs[0x03].emit({'msgtype': 0x03, 'chat_msg': u'hi'})
+        chunk = srv_msgs[0x33].emit(chunk_msg(100))
+        s = Stream()
+        s.append(mob_spawn + chunk + chat)
+        for raw in (mob_spawn, chunk):
+            msg = parse_packet(s, srv_msgs, 'server', set([0x03]))
+            self.assertFalse(msg.decoded)
+            self.assertEqual({'msgtype': ord(raw[0]), 'raw_bytes': raw}, msg)
+        msg = parse_packet(s, srv_msgs, 'server', set([0x03]))
+        self.assertTrue(msg.decoded)
+        self.assertEqual(u'hi', msg['chat_msg'])
+
+    def testFixedSizes(self):
+        cli_sizes, srv_sizes = messages.fixed_sizes[29]
+        self.assertEqual(5, cli_sizes[0x00])
+        self.assertEqual(8, srv_sizes[0x1f])
+        self.assertEqual(34, cli_sizes[0x0b])
+        self.assertEqual(None, srv_sizes[0x33])
+        self.assertEqual(None, srv_sizes[0x02])
+        self.assertEqual(None, srv_sizes[0xf0])
+        move = srv_msgs[0x1f].emit({'msgtype': 0x1f, 'eid': 1,
+                                    'dx': 1, 'dy': 2, 'dz': 3})
+        self.assertEqual(len(move), srv_sizes[0x1f])
+        s = Stream()
+        s.append(move + move[:3])
+        msg = parse_packet(s, srv_msgs, 'server', set(), srv_sizes)
+        self.assertEqual(move, msg['raw_bytes'])
+        self.assertRaises(PartialPacketException,
+                          parse_packet, s, srv_msgs, 'server', set(), srv_sizes)
+        self.assertEqual(8, s.need)
+
+
+class TestLazyMessage(unittest.TestCase):
+
+    def parse(self, raw, lazy=True):
+        s = Stream()
+        s.append(raw)
+        return parse_packet(s, srv_msgs, 'server', None, None, lazy)
+
+    def testMatchesEager(self):
+        chat = srv_msgs[0x03].emit({'msgtype': 0x03, 'chat_msg': u'hi'})
+        move = srv_msgs[0x1f].emit({'msgtype': 0x1f, 'eid': 1,
+                                    'dx': 1, 'dy': 2, 'dz': 3})
+        for raw in (chat, move, srv_msgs[0x33].emit(chunk_msg(100))):
+            msg = self.parse(raw)
+            self.assertTrue(isinstance(msg, LazyMessage))
+            self.assertEqual(self.parse(raw, False), msg)
+            self.assertEqual(dict(self.parse(raw, False)), dict(msg))
+            self.assertEqual(sorted(self.parse(raw, False).items()),
+                             sorted(self.parse(raw).iteritems()))
+
+    def testDecodeOnAccess(self):
+        raw = srv_msgs[0x33].emit(chunk_msg(100))
+        msg = self.parse(raw)
+        self.assertEqual(0, msg.decoded_segments)
+        self.assertEqual(0x33, msg['msgtype'])
+        self.assertTrue('chunk' in msg)
+        self.assertFalse('nonexistent' in msg)
+        self.assertEqual(0, msg.decoded_segments)
+        self.assertEqual(2, msg['z'])
+        # Only the fixed-size fields before 'chunk' were decoded.
+        self.assertEqual(7, dict.__len__(msg))
+        self.assertFalse(dict.__contains__(msg, 'chunk'))
+        self.assertEqual(None, msg.get('nonexistent'))
+        self.assertRaises(KeyError, lambda: msg['nonexistent'])
+        self.assertEqual('x' * 100, msg.get('chunk')['data'])
+        self.assertEqual(8, len(msg))
+
+    def testModify(self):
+        move = srv_msgs[0x1f].emit({'msgtype': 0x1f, 'eid': 1,
+                                    'dx': 1, 'dy': 2, 'dz': 3})
+        msg = self.parse(move)
+        msg['dy'] = 2
+        self.assertFalse(msg.modified)
+        msg['dx'] = 5
+        self.assertTrue(msg.modified)
+        self.assertEqual(5, msg['dx'])
+        self.assertEqual(3, msg['dz'])
+        del msg['eid']
+        self.assertFalse('eid' in msg)
+        self.assertEqual(['dx', 'dy', 'dz', 'msgtype', 'raw_bytes'], sorted(msg))
+
+class TestEncodeMessage(unittest.TestCase):
+
+    def parse(self, raw, lazy=True):
+        s = Stream()
+        s.append(raw)
+        return parse_packet(s, srv_msgs, 'server', None, None, lazy)
+
+    def testPatchFixedFields(self):
+        msg = chunk_msg(100)
+        raw = srv_msgs[0x33].emit(msg)
+        packet = self.parse(raw)
+        packet['z'] = -7
+        packet['continuous'] = False
+        self.assertEqual(set(['z', 'continuous']), packet.changed)
+        msg.update({'z': -7, 'continuous': False})
+        self.assertEqual(srv_msgs[0x33].emit(msg), encode_message(packet, srv_msgs))
+        # The chunk was never decoded.
+        self.assertFalse(dict.__contains__(packet, 'chunk'))
+
+    def testPatchAfterVariableField(self):
+        msg = {'msgtype': 0x14, 'eid': 1, 'name': u'player', 'x': 1, 'y': 2,
+               'z': 3, 'rotation': 4, 'pitch': 5, 'curr_item': 6}
+        raw = srv_msgs[0x14].emit(msg)
+        for lazy in (True, False):
+            packet = self.parse(raw, lazy)
+            packet['y'] = 64
+            msg['y'] = 64
+            self.assertEqual(srv_msgs[0x14].emit(msg), encode_message(packet, srv_msgs))
+
+    def testFullEmit(self):
+        msg = chunk_msg(100)
+        packet = self.parse(srv_msgs[0x33].emit(msg))
+        packet['chunk'] = {'size': 3, 'data': 'abc'}
+        packet['x'] = 10
+        msg.update({'chunk': {'size': 3, 'data': 'abc'}, 'x': 10})
+        self.assertEqual(srv_msgs[0x33].emit(msg), encode_message(packet, srv_msgs))
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
@@ -15,9 +15,12 @@
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
 
-import sys, unittest, shutil, tempfile, os, os.path, logging, imp
+import sys, unittest, shutil, tempfile, os, os.path, logging, imp, time, asyncore
 
-from mc3p.plugins import PluginConfig, PluginManager, MC3Plugin, msghdlr
+from mc3p import metrics, eventloop
+from mc3p.eventloop import Deferred
+from mc3p import plugins, messages
+from mc3p.plugins import PluginConfig, PluginManager, MC3Plugin, msghdlr, ConfigError
 
 MOCK_PLUGIN_CODE = """
 from mc3p.plugins import MC3Plugin, msghdlr
@@ -225,6 +228,260 @@ class TestPluginManager(unittest.TestCase):
         p1.drop_next_msg = True
         self.assertTrue(self.pmgr.filter({'msgtype': 0x04, 'time': 42}, 'client'))
 
+    def testDecodedMsgtypes(self):
+        mockplugin = self._write_and_load('mockplugin', MOCK_PLUGIN_CODE)
+        pcfg = PluginConfig().add('mockplugin', 'p1')
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        self.assertEqual(None, self.pmgr.decoded_msgtypes)
+        self.pmgr.filter(self.__class__.handshake_msg1, 'client')
+        self.pmgr.filter(self.__class__.handshake_msg2, 'server')
+        self.assertEqual(set([0x03]), self.pmgr.decoded_msgtypes)
+
+    def testHandlerChains(self):
+        mockplugin = self._write_and_load('mockplugin', MOCK_PLUGIN_CODE)
+        pcfg = PluginConfig().add('mockplugin', 'p1').add('mockplugin', 'p2')
+        pcfg.order(0x03, ['p2', 'p1'])
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        self.pmgr.filter(self.__class__.handshake_msg1, 'client')
+        self.pmgr.filter(self.__class__.handshake_msg2, 'server')
+        chains = getattr(self.pmgr, '_PluginManager__chains')
+        self.assertEqual(2, len(chains[0x03]))
+        self.assertEqual((), chains[0x04])
+        (p1, p2) = mockplugin.instances
+        p2.drop_next_msg = True
+        self.assertFalse(self.pmgr.filter({'msgtype': 0x03, 'chat_msg': 'foo!'}, 'client'))
+        self.assertEqual(None, p1.last_msg)
+        self.assertTrue(self.pmgr.filter({'msgtype': 0x03, 'chat_msg': 'foo!'}, 'client'))
+        self.assertEqual('foo!', p1.last_msg['chat_msg'])
+
+    def testIsolatedChain(self):
+        mockplugin = self._write_and_load('mockplugin', MOCK_PLUGIN_CODE)
+        pcfg = PluginConfig().add('mockplugin', 'p1').add('mockplugin', 'p2')
+        pcfg.isolate('p1', 1.0)
+        self.assertRaises(ConfigError, pcfg.isolate, 'p3')
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        self.pmgr.filter(self.__class__.handshake_msg1, 'client')
+        self.pmgr.filter(self.__class__.handshake_msg2, 'server')
+        self.assertEqual(set([0x03]), self.pmgr.decoded_msgtypes)
+        # Only p2 is instantiated in this process.
+        (p2,) = mockplugin.instances
+        d = self.pmgr.filter({'msgtype': 0x03, 'chat_msg': u'foo!'}, 'client')
+        self.assertEqual(None, p2.last_msg)
+        end = time.time() + 5
+        while not d.called and time.time() < end:
+            asyncore.loop(timeout=0.01, count=1)
+        self.assertTrue(d.result)
+        self.assertEqual(u'foo!', p2.last_msg['chat_msg'])
+
+    def testObserveOnly(self):
+        code = MOCK_PLUGIN_CODE.replace("class MockPlugin(MC3Plugin):", """
+observed = []
+
+class MockPlugin(MC3Plugin):
+    observe_only = True
+
+    def observe(self, msgs):
+        observed.append(msgs)
+        MC3Plugin.observe(self, msgs)
+""")
+        tapplugin = self._write_and_load('tapplugin', code)
+        pcfg = PluginConfig().add('tapplugin', 'p1')
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        self.pmgr.filter(self.__class__.handshake_msg1, 'client')
+        self.pmgr.filter(self.__class__.handshake_msg2, 'server')
+        self.assertEqual(set(), self.pmgr.decoded_msgtypes)
+        (p1,) = tapplugin.instances
+        msg = {'msgtype': 0x03, 'chat_msg': u'foo!'}
+        self.assertTrue(self.pmgr.filter(msg, 'client'))
+        self.assertEqual(None, p1.last_msg)
+        for text in (u'foo!', u'bar'):
+            self.pmgr.observe({'msgtype': 0x03, 'chat_msg': text}, 'client')
+        self.pmgr.destroy()
+        self.pmgr = None
+        end = time.time() + 5
+        while not p1.destroyed and time.time() < end:
+            time.sleep(0.01)
+        self.assertTrue(p1.destroyed)
+        self.assertEqual(u'bar', p1.last_msg['chat_msg'])
+        def modify(msg):
+            msg['chat_msg'] = u'baz'
+        self.assertRaises(TypeError, modify, p1.last_msg)
+        self.assertEqual([u'foo!', u'bar'],
+                         [m['chat_msg'] for batch in tapplugin.observed for (m, src) in batch])
+
+    def testDefaultHandlerDecodesAll(self):
+        code = MOCK_PLUGIN_CODE + """
+    def default_handler(self, msg, source):
+        return True
+"""
+        mockplugin = self._write_and_load('mockplugin', code)
+        pcfg = PluginConfig().add('mockplugin', 'p1')
+        self.pmgr = PluginManager(pcfg, self.cli_proxy, self.srv_proxy)
+        self.pmgr.filter(self.__class__.handshake_msg1, 'client')
+        self.pmgr.filter(self.__class__.handshake_msg2, 'server')
+        self.assertEqual(None, self.pmgr.decoded_msgtypes)
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class TestHandlerTiming(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = metrics.registry
+        metrics.registry = metrics.Registry()
+        self.log = ListHandler()
+        logging.getLogger('mc3p.plugins').addHandler(self.log)
+
+    def tearDown(self):
+        metrics.registry = self.saved
+        logging.getLogger('mc3p.plugins').removeHandler(self.log)
+
+    def testTiming(self):
+        class A(MC3Plugin):
+            def default_handler(self, msg, dir):
+                return True
+            @msghdlr(0x03)
+            def handle_chat(self, msg, dir):
+                if msg['chat_msg'] == 'slow':
+                    time.sleep(0.02)
+                return True
+        a = A(21, None, None)
+        a._set_id('a1', 0.01)
+        for text in ('fast', 'fast', 'slow'):
+            self.assertTrue(a.filter({'msgtype': 0x03, 'chat_msg': text,
+                                      'raw_bytes': 'x' * 11}, 'client'))
+        a.filter({'msgtype': 0x0b, 'x': 0}, 'client')
+        hists = metrics.snapshot()['histograms']
+        def count(handler, msgtype):
+            key = ('plugin_handler_seconds', (('handler', handler), ('msgtype', msgtype),
+                                              ('plugin', 'a1')))
+            return hists[key]['count'] if key in hists else 0
+        self.assertEqual(3, count('handle_chat', '0x03'))
+        self.assertEqual(3, count('default_handler', '0x03'))
+        self.assertEqual(1, count('default_handler', '0x0b'))
+        self.assertEqual(0, count('handle_chat', '0x0b'))
+        self.assertEqual(1, len(self.log.messages))
+        for part in ("'a1'", 'handle_chat', '11 byte', '0x03'):
+            self.assertTrue(part in self.log.messages[0], part)
+
+    def testDefaultHandlerNotTimed(self):
+        class B(MC3Plugin):
+            @msghdlr(0x03)
+            def handle_chat(self, msg, dir):
+                return False
+        b = B(21, None, None)
+        self.assertFalse(b.filter({'msgtype': 0x03, 'chat_msg': 'hi'}, 'client'))
+        self.assertEqual([('plugin_handler_seconds', (('handler', 'handle_chat'),
+                           ('msgtype', '0x03'), ('plugin', 'B')))],
+                         metrics.snapshot()['histograms'].keys())
+
+class TestTapThread(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (metrics.registry, plugins.MAX_TAP_QUEUE_BYTES)
+        metrics.registry = metrics.Registry()
+
+    def tearDown(self):
+        (metrics.registry, plugins.MAX_TAP_QUEUE_BYTES) = self.saved
+
+    def testLazySnapshot(self):
+        cli_msgs = messages.protocol[21][0]
+        raw_bytes = cli_msgs[0x03].emit({'msgtype': 0x03, 'chat_msg': u'hi'})
+        snap = plugins.MessageSnapshot(raw_bytes, cli_msgs, 'client', 1.0)
+        self.assertEqual(0x03, snap['msgtype'])
+        self.assertEqual(raw_bytes, snap['raw_bytes'])
+        self.assertEqual(None, snap.msg)
+        self.assertEqual(u'hi', snap['chat_msg'])
+        self.assertEqual(u'hi', snap.get('chat_msg'))
+        self.assertEqual(None, snap.get('nope'))
+        self.assertEqual(set(['msgtype', 'raw_bytes', 'chat_msg']), set(snap))
+
+    def testQueueBytes(self):
+        plugins.MAX_TAP_QUEUE_BYTES = 25
+        tap = plugins.TapThread()
+        for i in range(3):
+            tap.put(((), 'client', 21, 'x' * 10, 1.0))
+        # The end of a session is queued whatever the size.
+        tap.put(((), None, None, None, None))
+        self.assertEqual(3, len(tap.queue))
+        snapshot = metrics.snapshot()
+        self.assertEqual(1, snapshot['counters'][('tap_dropped_total', ())])
+        self.assertEqual(20, snapshot['gauges'][('tap_queue_bytes', ())])
+
+def wait(d, timeout=5.0):
+    """Run the event loop until d is called, and return its result.
+
+    Like eventloop.run(), each iteration blocks until there is I/O or a
+    timer is due, so a result set from another thread must wake the loop.
+    """
+    eventloop.start_waker()
+    end = time.time() + timeout
+    delay = eventloop.run_timers()
+    while not d.called and time.time() < end:
+        asyncore.loop(timeout=min(delay, end - time.time()), count=1)
+        delay = eventloop.run_timers()
+    return d.result
+
+class TestAsyncHandlers(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = metrics.registry
+        metrics.registry = metrics.Registry()
+
+    def tearDown(self):
+        metrics.registry = self.saved
+
+    def testDeferToThread(self):
+        class C(MC3Plugin):
+            @msghdlr(0x03)
+            def handle_chat(self, msg, dir):
+                def lookup(text):
+                    if text == 'error':
+                        raise Exception('Failure!')
+                    return text != 'blocked'
+                return self.defer_to_thread(lookup, msg['chat_msg'])
+        c = C(21, None, None)
+        results = [wait(c.filter({'msgtype': 0x03, 'chat_msg': text}, 'client'))
+                   for text in ('allowed', 'blocked', 'error')]
+        self.assertEqual([True, False, True], results)
+        self.assertFalse(('plugin_async_timeouts_total', (('plugin', 'C'),))
+                         in metrics.snapshot()['counters'])
+        key = ('plugin_async_seconds', (('handler', 'handle_chat'), ('msgtype', '0x03'),
+                                        ('plugin', 'C')))
+        self.assertEqual(3, metrics.snapshot()['histograms'][key]['count'])
+
+    def testTimeout(self):
+        class D(MC3Plugin):
+            async_timeout = 0.05
+            async_default = False
+            def default_handler(self, msg, dir):
+                return Deferred()
+            @msghdlr(0x03)
+            def handle_chat(self, msg, dir):
+                self.chats += 1
+                return True
+        d = D(21, None, None)
+        d.chats = 0
+        verdict = d.filter({'msgtype': 0x03, 'chat_msg': 'hi'}, 'client')
+        self.assertFalse(wait(verdict))
+        self.assertEqual(0, d.chats)
+        self.assertEqual(1, metrics.snapshot()['counters'][
+            ('plugin_async_timeouts_total', (('plugin', 'D'),))])
+        # The msghdlr is called once the default_handler's verdict is in.
+        deferred = Deferred()
+        d.default_handler = lambda msg, dir: deferred
+        d._set_id('d1')
+        verdict = d.filter({'msgtype': 0x03, 'chat_msg': 'hi'}, 'client')
+        self.assertFalse(verdict.called)
+        deferred.callback(True)
+        self.assertTrue(verdict.result)
+        self.assertEqual(1, d.chats)
+
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
     unittest.main()
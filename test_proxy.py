@@ -0,0 +1,431 @@
+# This source file is part of mc3p, the Minecraft Protocol Parsing Proxy.
+#
+# Copyright (C) 2011 Matthew J. McGill
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License v2 as published by
+# the Free Software Foundation.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+import unittest, socket, errno, asyncore, threading, os, signal
+from time import time, sleep
+
+from mc3p import proxy, messages, metrics, eventloop
+from mc3p.proxy import MinecraftProxy
+from mc3p.plugins import PluginConfig, PluginManager
+from mc3p.metrics import MsgTypeStats
+from mc3p.util import monotonic
+from mc3p.eventloop import Deferred
+
+def drain(sock):
+    """Read everything available from a non-blocking socket."""
+    data = []
+    while True:
+        try:
+            chunk = sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                break
+            raise
+        if not chunk:
+            break
+        data.append(chunk)
+    return ''.join(data)
+
+
+class TestOutputQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.cli_sock, self.cli_peer = socket.socketpair()
+        self.srv_sock, self.srv_peer = socket.socketpair()
+        self.cli_peer.setblocking(0)
+        self.cli_proxy = MinecraftProxy(self.cli_sock)
+        self.srv_proxy = MinecraftProxy(self.srv_sock, self.cli_proxy)
+
+    def tearDown(self):
+        self.cli_proxy.close()
+        self.srv_proxy.close()
+        self.cli_peer.close()
+        self.srv_peer.close()
+
+    def testPartialSends(self):
+        data = ''.join([chr(i % 251) for i in xrange(200000)])
+        self.cli_proxy.send(data[:150000])
+        self.cli_proxy.send(data[150000:])
+        received = []
+        while self.cli_proxy.writable():
+            received.append(drain(self.cli_peer))
+            self.cli_proxy.handle_write()
+        received.append(drain(self.cli_peer))
+        self.assertEqual(data, ''.join(received))
+        self.assertEqual(0, self.cli_proxy.out_bytes)
+
+    def testBackpressure(self):
+        block = 'x' * 65536
+        while not self.srv_proxy.reading_paused:
+            self.assertTrue(self.srv_proxy.readable())
+            self.cli_proxy.send(block)
+        self.assertFalse(self.srv_proxy.readable())
+        self.assertTrue(self.cli_proxy.readable())
+        self.assertTrue(self.cli_proxy.out_bytes > proxy.HIGH_WATERMARK)
+        while self.cli_proxy.out_bytes > proxy.LOW_WATERMARK:
+            self.assertTrue(self.srv_proxy.reading_paused)
+            drain(self.cli_peer)
+            self.cli_proxy.handle_write()
+        self.assertTrue(self.srv_proxy.readable())
+
+    def testLatency(self):
+        stats = [MsgTypeStats('test') for i in range(3)]
+        size = 150000
+        self.cli_proxy.send('x' * 3 * size, monotonic(),
+                            [(i + 1) * size for i in range(3)], stats)
+        while self.cli_proxy.writable():
+            # A packet's latency is recorded once all of it was sent.
+            sent = self.cli_proxy.bytes_sent
+            self.assertEqual([int(sent >= (i + 1) * size) for i in range(3)],
+                             [s.latency.count for s in stats])
+            drain(self.cli_peer)
+            self.cli_proxy.handle_write()
+        self.assertEqual([1, 1, 1], [s.latency.count for s in stats])
+        self.assertFalse(self.cli_proxy.latency_queue)
+
+class TestInjection(unittest.TestCase):
+
+    def setUp(self):
+        self.cli_sock, self.cli_peer = socket.socketpair()
+        self.srv_sock, self.srv_peer = socket.socketpair()
+        self.cli_peer.setblocking(0)
+        self.cli_proxy = MinecraftProxy(self.cli_sock)
+        self.srv_proxy = MinecraftProxy(self.srv_sock, self.cli_proxy)
+        self.plugin_mgr = PluginManager(PluginConfig(), self.cli_proxy, self.srv_proxy)
+        self.cli_proxy.plugin_mgr = self.srv_proxy.plugin_mgr = self.plugin_mgr
+
+    def tearDown(self):
+        self.cli_proxy.close()
+        self.srv_proxy.close()
+        self.cli_peer.close()
+        self.srv_peer.close()
+
+    def testIdleInjection(self):
+        to_client = getattr(self.plugin_mgr, '_PluginManager__from_server_q')
+        thread = threading.Thread(target=lambda: [to_client.put(m) for m in ('a', 'b', 'c')])
+        thread.start()
+        thread.join()
+        # Nothing arrives from the server, but one loop iteration sends the messages.
+        asyncore.loop(timeout=1, count=1)
+        self.assertEqual('abc', drain(self.cli_peer))
+
+    def testOutOfSync(self):
+        to_client = getattr(self.plugin_mgr, '_PluginManager__from_server_q')
+        self.srv_proxy.out_of_sync = True
+        to_client.put('a')
+        asyncore.loop(timeout=0.01, count=1)
+        self.assertEqual('', drain(self.cli_peer))
+        self.srv_proxy.out_of_sync = False
+        self.srv_proxy.send_injected()
+        self.assertEqual('a', drain(self.cli_peer))
+
+class TestResync(unittest.TestCase):
+
+    def setUp(self):
+        self.cli_sock, self.cli_peer = socket.socketpair()
+        self.srv_sock, self.srv_peer = socket.socketpair()
+        self.srv_peer.setblocking(0)
+        self.cli_proxy = MinecraftProxy(self.cli_sock)
+        self.srv_proxy = MinecraftProxy(self.srv_sock, self.cli_proxy)
+        self.cli_msgs = messages.protocol[29][0]
+        self.cli_proxy.set_protocol(29)
+
+    def tearDown(self):
+        self.cli_proxy.close()
+        self.srv_proxy.close()
+        self.cli_peer.close()
+        self.srv_peer.close()
+
+    def chat(self, text):
+        return self.cli_msgs[0x03].emit({'msgtype': 0x03, 'chat_msg': text})
+
+    def forward(self, data):
+        self.cli_peer.sendall(data)
+        self.cli_proxy.handle_read()
+        return drain(self.srv_peer)
+
+    def testResync(self):
+        good = ''.join([self.chat(u'message %d' % i) for i in range(10)])
+        data = good + '\xee\xee\xee' + good
+        self.assertEqual(data, self.forward(data))
+        self.assertEqual(1, self.cli_proxy.resync_attempts)
+        self.assertEqual(1, self.cli_proxy.resyncs)
+        self.assertEqual(20, self.cli_proxy.packets)
+        self.assertFalse(self.cli_proxy.out_of_sync)
+
+    def testResyncAcrossReads(self):
+        good = ''.join([self.chat(u'message %d' % i) for i in range(10)])
+        self.assertEqual('\xee\xee', self.forward('\xee\xee'))
+        self.assertTrue(self.cli_proxy.out_of_sync)
+        # Candidate boundaries wait for enough packets to be framed.
+        self.assertEqual('\xee', self.forward('\xee' + good[:30]))
+        self.assertTrue(self.cli_proxy.out_of_sync)
+        self.assertEqual(good, self.forward(good[30:]))
+        self.assertFalse(self.cli_proxy.out_of_sync)
+        self.assertEqual(10, self.cli_proxy.packets)
+        self.assertEqual(None, self.cli_proxy.resync_timer)
+
+    def testResyncTimeout(self):
+        saved = proxy.RESYNC_TIMEOUT
+        proxy.RESYNC_TIMEOUT = 0.1
+        try:
+            good = ''.join([self.chat(u'message %d' % i) for i in range(10)])
+            start = time()
+            self.assertEqual('\xee', self.forward('\xee' + good[:30]))
+            # No more data arrives, but the held bytes are forwarded at the timeout.
+            received = []
+            end = start + 5
+            while len(''.join(received)) < 30 and time() < end:
+                eventloop.run_timers()
+                received.append(drain(self.srv_peer))
+            self.assertEqual(good[:30], ''.join(received))
+            self.assertTrue(time() - start >= 0.1)
+            self.assertTrue(self.cli_proxy.out_of_sync)
+            self.assertEqual(None, self.cli_proxy.resync_timer)
+        finally:
+            proxy.RESYNC_TIMEOUT = saved
+
+class DeferringPlugins(object):
+    """Stands in for a PluginManager; defers the verdict on chat messages
+    starting with 'hold'."""
+    decoded_msgtypes = set([0x03])
+
+    def __init__(self):
+        self.verdicts = []
+
+    def filter(self, msg, side):
+        if not msg['chat_msg'].startswith('hold'):
+            return True
+        d = Deferred()
+        self.verdicts.append(d)
+        return d
+
+    def injected_from(self, side):
+        return None
+
+    def observe(self, msg, side):
+        pass
+
+class TestHoldBack(TestResync):
+
+    def setUp(self):
+        TestResync.setUp(self)
+        self.cli_proxy.plugin_mgr = DeferringPlugins()
+
+    def testOrder(self):
+        verdicts = self.cli_proxy.plugin_mgr.verdicts
+        self.assertEqual(self.chat(u'a'),
+                         self.forward(''.join([self.chat(t) for t in
+                                               (u'a', u'hold 1', u'b', u'hold 2', u'c')])))
+        self.assertEqual(2, len(verdicts))
+        # Packets are released in order, as far as the verdicts are in.
+        verdicts[1].callback(True)
+        self.assertEqual('', drain(self.srv_peer))
+        verdicts[0].callback(False)
+        self.assertEqual(self.chat(u'b') + self.chat(u'hold 2') + self.chat(u'c'),
+                         drain(self.srv_peer))
+        self.assertEqual(1, self.cli_proxy.msg_stats[0x03].drops)
+        self.assertFalse(self.cli_proxy.held)
+        self.assertEqual(0, self.cli_proxy.held_bytes)
+
+    def testResyncWhileHeld(self):
+        verdicts = self.cli_proxy.plugin_mgr.verdicts
+        data = self.chat(u'hold') + '\xee\xee\xee' + ''.join([self.chat(u'message %d' % i)
+                                                             for i in range(10)])
+        self.assertEqual('', self.forward(data))
+        verdicts[0].callback(True)
+        self.assertEqual(data, drain(self.srv_peer))
+
+def loop_until(cond, timeout=5.0):
+    """Run the event loop until cond() is true, or timeout seconds pass."""
+    end = time() + timeout
+    while not cond() and time() < end:
+        asyncore.loop(timeout=0.01, count=1)
+        eventloop.run_timers()
+    return cond()
+
+
+class TestListener(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = metrics.registry
+        metrics.registry = metrics.Registry()
+        self.upstream = proxy.listen_socket(0)
+        self.listener = proxy.MinecraftListener(proxy.listen_socket(0), PluginConfig(),
+                                                '127.0.0.1',
+                                                self.upstream.getsockname()[1],
+                                                max_sessions=2)
+        self.clients = []
+
+    def tearDown(self):
+        for session in list(self.listener.sessions):
+            session.close()
+        self.listener.close()
+        self.upstream.close()
+        for client in self.clients:
+            client.close()
+        metrics.registry = self.saved
+
+    def connect(self):
+        client = socket.create_connection(('127.0.0.1', self.listener.socket.getsockname()[1]))
+        client.setblocking(0)
+        self.clients.append(client)
+        return client
+
+    def closed(self, sock):
+        try:
+            return sock.recv(1) == ''
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            return True
+
+    def testMaxSessions(self):
+        gauge = metrics.registry.gauges[('sessions', ())]
+        for i in range(2):
+            self.connect()
+            self.assertTrue(loop_until(lambda: len(self.listener.sessions) == i + 1))
+        extra = self.connect()
+        self.assertTrue(loop_until(lambda: self.closed(extra)))
+        self.assertEqual(2, len(self.listener.sessions))
+        self.assertFalse(any([self.closed(c) for c in self.clients[:2]]))
+        self.assertEqual(2, gauge())
+        list(self.listener.sessions)[0].close()
+        self.assertEqual(1, gauge())
+
+
+class TestSession(unittest.TestCase):
+
+    def setUp(self):
+        self.cli_sock, self.cli_peer = socket.socketpair()
+        self.cli_peer.setblocking(0)
+        self.ended = []
+
+    def tearDown(self):
+        self.cli_peer.close()
+
+    def session(self, port, connect_timeout=10.0):
+        return proxy.MinecraftSession(PluginConfig(), self.cli_sock, '127.0.0.1', port,
+                                      self.ended.append, connect_timeout)
+
+    def testRefused(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        session = self.session(port)
+        try:
+            # Data from the client waits for the connection.
+            self.cli_peer.sendall(messages.protocol[0][0][0x02].emit(
+                {'msgtype': 0x02, 'username': u'player'}))
+            session.cli_proxy.handle_read()
+            self.assertTrue(session.srv_proxy.out_bytes > 0)
+            self.assertTrue(loop_until(lambda: session.closed))
+            self.assertEqual([session], self.ended)
+            self.assertEqual(0, session.srv_proxy.out_bytes)
+            self.assertFalse(session.srv_proxy.out_queue)
+            self.assertEqual('', drain(self.cli_peer))
+        finally:
+            session.close()
+
+    def testTimeout(self):
+        # A listening socket with a full backlog never completes a connection.
+        upstream = socket.socket()
+        upstream.bind(('127.0.0.1', 0))
+        upstream.listen(0)
+        queued = socket.create_connection(upstream.getsockname())
+        session = self.session(upstream.getsockname()[1], connect_timeout=0.2)
+        try:
+            start = time()
+            self.assertTrue(loop_until(lambda: session.closed))
+            self.assertTrue(time() - start >= 0.2)
+            self.assertFalse(session.srv_connected)
+            self.assertEqual([session], self.ended)
+            self.assertFalse(session.srv_proxy in asyncore.socket_map.values())
+        finally:
+            session.close()
+            queued.close()
+            upstream.close()
+
+
+class TestWorkers(unittest.TestCase):
+
+    def testExitReason(self):
+        pid = os.fork()
+        if pid == 0:
+            os._exit(3)
+        self.assertEqual('exited with code 3', proxy.exit_reason(os.waitpid(pid, 0)[1]))
+        pid = os.fork()
+        if pid == 0:
+            sleep(10)
+            os._exit(0)
+        os.kill(pid, signal.SIGKILL)
+        self.assertEqual('was killed by signal %d' % signal.SIGKILL,
+                         proxy.exit_reason(os.waitpid(pid, 0)[1]))
+
+    def testRestartThrottle(self):
+        (r, w) = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Run the supervisor with workers that exit as soon as they start.
+            try:
+                os.close(r)
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, 1)
+                os.dup2(devnull, 2)
+                proxy.serve = lambda *args: os.write(w, 'x')
+                proxy.MIN_WORKER_LIFETIME = 0.2
+                proxy.run_workers(1, None, None, None, None, None)
+            finally:
+                os._exit(0)
+        os.close(w)
+        sleep(1.0)
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        starts = []
+        while True:
+            data = os.read(r, 4096)
+            if not data:
+                break
+            starts.append(data)
+        os.close(r)
+        # A worker is started every MIN_WORKER_LIFETIME seconds at most.
+        self.assertTrue(3 <= len(''.join(starts)) <= 6, len(''.join(starts)))
+
+
+class TestRecvSize(unittest.TestCase):
+
+    def testAdapt(self):
+        a, b = socket.socketpair()
+        try:
+            p = MinecraftProxy(a, max_recv_size=6 * proxy.MIN_RECV_SIZE)
+            sizes = []
+            for i in range(5):
+                p.adapt_recv_size(p.recv_size)
+                sizes.append(p.recv_size / proxy.MIN_RECV_SIZE)
+            self.assertEqual([2, 4, 6, 6, 6], sizes)
+            p.adapt_recv_size(p.recv_size // 2)
+            self.assertEqual(6 * proxy.MIN_RECV_SIZE, p.recv_size)
+            for i in range(5):
+                p.adapt_recv_size(10)
+            self.assertEqual(proxy.MIN_RECV_SIZE, p.recv_size)
+            p.close()
+        finally:
+            b.close()
+
+if __name__ == "__main__":
+    unittest.main()